@@ -10,6 +10,7 @@ import json
 
 import appengine_config
 from oauth_dropins.webutil import handlers
+import models
 from models import BlogPost, Response, Source
 import util
 
@@ -80,6 +81,53 @@ class SourcesHandler(handlers.TemplateHandler):
     }
 
 
+class CircuitBreakersHandler(handlers.TemplateHandler):
+  """Shows the state of each silo's circuit breaker and recently opened ones."""
+
+  def template_file(self):
+    return 'templates/admin_circuit_breakers.html'
+
+  def template_vars(self):
+    names = sorted(name for name in models.sources if name)
+    names += [name for name in util.CircuitBreaker.recent_names()
+              if name not in names]
+
+    breakers = []
+    for name in names:
+      breaker = util.CircuitBreaker(name)
+      opened = breaker.opened()
+      breakers.append({
+        'name': name,
+        'state': breaker.state(),
+        'opened': (datetime.datetime.utcfromtimestamp(opened)
+                   if opened is not None else None),
+      })
+
+    return {'breakers': breakers}
+
+
+class HostShardsHandler(handlers.TemplateHandler):
+  """Shows the webmention target hosts with the biggest recent backlogs."""
+
+  def template_file(self):
+    return 'templates/admin_host_shards.html'
+
+  def template_vars(self):
+    hosts = []
+    for host in util.HostShard.recent_hosts():
+      shard = util.HostShard(host)
+      leased = shard.leased()
+      hosts.append({
+        'host': host,
+        'backlog': shard.backlog(),
+        'leased': (datetime.datetime.utcfromtimestamp(leased)
+                   if leased is not None else None),
+      })
+
+    hosts.sort(key=lambda h: h['backlog'], reverse=True)
+    return {'hosts': hosts}
+
+
 class MarkCompleteHandler(util.Handler):
   def post(self):
     entities = ndb.get_multi(ndb.Key(urlsafe=u)
@@ -93,5 +141,7 @@ class MarkCompleteHandler(util.Handler):
 application = webapp2.WSGIApplication([
     ('/admin/responses', ResponsesHandler),
     ('/admin/sources', SourcesHandler),
+    ('/admin/circuit_breakers', CircuitBreakersHandler),
+    ('/admin/host_shards', HostShardsHandler),
     ('/admin/mark_complete', MarkCompleteHandler),
     ], debug=appengine_config.DEBUG)
@@ -40,7 +40,6 @@ import tumblr
 import twitter
 import wordpress_rest
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.stats import KindStat, KindPropertyNameStat
 import webapp2
@@ -594,7 +593,7 @@ class RetryHandler(util.Handler):
     entity.put()
 
     # clear any cached webmention endpoints
-    memcache.delete_multi(util.webmention_endpoint_cache_key(url) for url in targets)
+    models.WebmentionEndpointCache.delete_multi(targets)
 
     if entity.key.kind() == 'Response':
       util.add_propagate_task(entity)
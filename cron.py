@@ -3,19 +3,21 @@
 
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
+import collections
 import datetime
-import itertools
 import json
 import logging
 
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import appengine_config
 
 import models
 from models import Source
 from instagram import Instagram
-from twitter import Twitter
 from flickr import Flickr
+from twitter import Twitter
 import util
 import webapp2
 
@@ -24,31 +26,202 @@ TWITTER_USERS_PER_LOOKUP = 100  # max # of users per API call
 
 
 class ReplacePollTasks(webapp2.RequestHandler):
-  """Finds sources missing their poll tasks and adds new ones."""
+  """Finds sources missing their poll tasks and adds new ones.
+
+  The cron job GET fans out to one task per silo. Each task POSTs back here,
+  queries the Source.next_poll_due index for that silo's overdue sources one
+  page at a time, and adds another task for the next page if there is one.
+  """
+  PAGE_SIZE = 100
 
   def get(self):
+    for short_name in models.sources:
+      if short_name:
+        taskqueue.add(url='/cron/replace_poll_tasks',
+                      params={'source_type': short_name})
+
+  def post(self):
+    source_type = self.request.get('source_type')
+    cls = models.sources.get(source_type)
+    if not cls or not source_type:
+      self.abort(400, 'Unknown source type %r' % source_type)
+
     now = datetime.datetime.now()
-    queries = [cls.query(Source.features == 'listen', Source.status == 'enabled')
-               for cls in models.sources.values()]
-    for source in itertools.chain(*queries):
-      age = now - source.last_poll_attempt
-      if age > max(source.poll_period() * 2, datetime.timedelta(hours=2)):
+    query = cls.query(Source.features == 'listen', Source.status == 'enabled',
+                      Source.next_poll_due < now)
+    cursor = self.request.get('cursor')
+    keys, next_cursor, more = query.fetch_page(
+      self.PAGE_SIZE, keys_only=True,
+      start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    for source in ndb.get_multi(keys):
+      # the index is eventually consistent, so double check
+      if source and source.next_poll_due < now:
         logging.info('%s last polled %s ago. Adding new poll task.',
-                     source.bridgy_url(self), age)
+                     source.bridgy_url(self), now - source.last_poll_attempt)
         util.add_poll_task(source)
 
+    if more and next_cursor:
+      taskqueue.add(url='/cron/replace_poll_tasks',
+                    params={'source_type': source_type,
+                            'cursor': next_cursor.urlsafe()})
+
+
+class BackfillNextPollDue(webapp2.RequestHandler):
+  """One-off backfill of Source.next_poll_due. Remove once it has run.
+
+  Sources that haven't been put since next_poll_due was added don't have it in
+  the index, so ReplacePollTasks's query can't find them. This re-puts them
+  with next_poll_due set. Fans out and pages like ReplacePollTasks.
+
+  This isn't in cron.yaml. Run it once by hand after deploying, by visiting
+  /cron/backfill_next_poll_due as an admin.
+  """
+  PAGE_SIZE = 100
+
+  def get(self):
+    for short_name in models.sources:
+      if short_name:
+        taskqueue.add(url='/cron/backfill_next_poll_due',
+                      params={'source_type': short_name})
+
+  def post(self):
+    source_type = self.request.get('source_type')
+    cls = models.sources.get(source_type)
+    if not cls or not source_type:
+      self.abort(400, 'Unknown source type %r' % source_type)
+
+    query = cls.query(Source.features == 'listen', Source.status == 'enabled')
+    cursor = self.request.get('cursor')
+    keys, next_cursor, more = query.fetch_page(
+      self.PAGE_SIZE, keys_only=True,
+      start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+
+    # only open transactions for the sources that still need it
+    for source in ndb.get_multi(keys):
+      if source and source.next_poll_due == util.EPOCH:
+        self.backfill(source.key)
+
+    if more and next_cursor:
+      taskqueue.add(url='/cron/backfill_next_poll_due',
+                    params={'source_type': source_type,
+                            'cursor': next_cursor.urlsafe()})
+
+  @staticmethod
+  @ndb.transactional
+  def backfill(key):
+    source = key.get()
+    if source and source.next_poll_due == util.EPOCH:
+      source.next_poll_due = source.calculate_next_poll_due()
+      source.put()
+
 
 class UpdatePictures(webapp2.RequestHandler):
-  """Finds sources whose profile pictures have changed and
-  updates them."""
+  """Finds sources whose profile pictures have changed and updates them.
+
+  Pages through sources with a projection query, fetches their actors
+  concurrently, and writes each page's new pictures with a single put_multi().
+  """
   SOURCE_CLS = None
+  PAGE_SIZE = 100
 
   def get(self):
-    for source in self.SOURCE_CLS.query():
+    # deleted sources have no features, so they're not in this query's index
+    query = self.SOURCE_CLS.query(
+      Source.status == 'enabled',
+      projection=[Source.auth_entity, Source.features, Source.picture])
+
+    updated = False
+    cursor = None
+    while True:
+      results, cursor, more = query.fetch_page(self.PAGE_SIZE,
+                                               start_cursor=cursor)
+      # projecting a repeated property returns one result per value
+      sources = collections.OrderedDict((s.key, s) for s in results).values()
+      if sources:
+        updated |= self.update_pictures(sources, self.get_pictures(sources))
+      if not more or not cursor:
+        break
+
+    if updated:
+      util.CachedPage.invalidate('/users')
+
+  def get_pictures(self, sources):
+    """Fetches the current profile picture URLs for a page of sources.
+
+    Subclasses can override this to use a silo's bulk user lookup API.
+
+    Args:
+      sources: sequence of projected Source entities
+
+    Returns: list of string URLs or None, in the same order as sources
+    """
+    # load the auth entities in one batch. gr_source needs them, and worker
+    # threads don't share this thread's ndb context cache.
+    ndb.get_multi(set(s.auth_entity for s in sources if s.auth_entity))
+    for source in sources:
+      source.gr_source
+
+    def get_picture(source):
       logging.debug('checking for updated profile pictures for: %s',
                     source.bridgy_url(self))
-      if source.features and source.status != 'disabled':
-        maybe_update_picture(source, source.gr_source.get_actor(source.key.id()), self)
+      try:
+        actor = source.gr_source.get_actor(source.key.id())
+      except BaseException, e:
+        if not util.interpret_http_exception(e)[0]:
+          raise
+        return None
+      return (actor or {}).get('image', {}).get('url')
+
+    return util.run_in_threads([lambda s=s: get_picture(s) for s in sources])
+
+  def update_pictures(self, sources, pictures):
+    """Stores new profile pictures.
+
+    Args:
+      sources: sequence of projected Source entities
+      pictures: sequence of string URLs or None, in the same order as sources
+
+    Returns: boolean, whether any pictures changed
+    """
+    changed = {source.key: pic for source, pic in zip(sources, pictures)
+               if pic and pic != source.picture}
+    if not changed:
+      return False
+
+    entities = [e for e in ndb.get_multi(changed.keys()) if e]
+    for entity in entities:
+      logging.info('Updating profile picture for %s from %s to %s',
+                   entity.bridgy_url(self), entity.picture, changed[entity.key])
+      entity.picture = changed[entity.key]
+    ndb.put_multi(entities)
+    return bool(entities)
+
+
+class UpdateTwitterPictures(UpdatePictures):
+  """Finds Twitter sources whose profile pictures have changed and updates
+  them. Looks up each page of users with a single users/lookup API call."""
+  SOURCE_CLS = Twitter
+  PAGE_SIZE = TWITTER_USERS_PER_LOOKUP
+
+  def get_pictures(self, sources):
+    # any user's credentials can look up other users
+    gr_source = sources[0].gr_source
+    try:
+      users = gr_source.urlopen(TWITTER_API_USER_LOOKUP %
+                                ','.join(s.key.id() for s in sources))
+    except BaseException, e:
+      if not util.interpret_http_exception(e)[0]:
+        raise
+      return [None] * len(sources)
+
+    # screen names are case insensitive
+    pictures = {}
+    for user in users:
+      actor = gr_source.user_to_actor(user)
+      pictures[user.get('screen_name', '').lower()] = \
+        actor.get('image', {}).get('url')
+    return [pictures.get(s.key.id().lower()) for s in sources]
 
 
 class UpdateInstagramPictures(UpdatePictures):
@@ -63,27 +236,10 @@ class UpdateFlickrPictures(UpdatePictures):
   SOURCE_CLS = Flickr
 
 
-def maybe_update_picture(source, new_actor, handler):
-  if not new_actor:
-    return
-  new_pic = new_actor.get('image', {}).get('url')
-  if not new_pic or source.picture == new_pic:
-    return
-
-  @ndb.transactional
-  def update():
-    src = source.key.get()
-    src.picture = new_pic
-    src.put()
-
-  logging.info('Updating profile picture for %s from %s to %s',
-               source.bridgy_url(handler), source.picture, new_pic)
-  update()
-  util.CachedPage.invalidate('/users')
-
-
 application = webapp2.WSGIApplication([
     ('/cron/replace_poll_tasks', ReplacePollTasks),
+    ('/cron/backfill_next_poll_due', BackfillNextPollDue),
+    ('/cron/update_twitter_pictures', UpdateTwitterPictures),
     ('/cron/update_instagram_pictures', UpdateInstagramPictures),
     ('/cron/update_flickr_pictures', UpdateFlickrPictures),
     ], debug=appengine_config.DEBUG)
@@ -44,6 +44,10 @@ class GooglePlusPage(models.Source):
   # after the randomized task ETA.
   RATE_LIMITED_POLL = datetime.timedelta(hours=30)
 
+  # Spread our calls out over the day instead of burning through the daily
+  # quota and then getting rate limited.
+  API_TOKEN_BUCKET = (100, 10000. / 24 / 60 / 60)
+
   type = ndb.StringProperty(choices=('user', 'page'))
 
   @staticmethod
@@ -81,10 +85,32 @@ class GooglePlusPage(models.Source):
     """Overridden to pass auth_entity to gr_googleplus.GooglePlus's ctor."""
     if name == 'gr_source' and self.auth_entity:
       self.gr_source = gr_googleplus.GooglePlus(auth_entity=self.auth_entity.get())
+      if self.API_TOKEN_BUCKET:
+        self.count_api_calls(self.gr_source)
       return self.gr_source
 
     return getattr(super(GooglePlusPage, self), name)
 
+  def count_api_calls(self, gr_source):
+    """Counts each HTTP request to the API.
+
+    gr_googleplus.GooglePlus calls the API with apiclient and the auth entity's
+    http(), not urlopen(). Batches are one HTTP request, so they count once.
+    """
+    auth_entity = gr_source.auth_entity
+    make_http = auth_entity.http
+
+    def http(*args, **kwargs):
+      authorized = make_http(*args, **kwargs)
+      request = authorized.request
+      def counted_request(*args, **kwargs):
+        self.api_calls += 1
+        return request(*args, **kwargs)
+      authorized.request = counted_request
+      return authorized
+
+    auth_entity.http = http
+
   def poll_period(self):
     """Returns the poll frequency for this source."""
     return (self.RATE_LIMITED_POLL if self.rate_limited
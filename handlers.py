@@ -21,6 +21,7 @@ URL paths are:
 import copy
 import json
 import logging
+import math
 import re
 import string
 
@@ -144,6 +145,17 @@ class ItemHandler(webapp2.RequestHandler):
         self.abort(404, 'Invalid id %s' % id)
 
     label = '%s:%s %s %s' % (source_short_name, string_id, type, ids)
+    wait = self.source.api_token_wait()
+    if wait:
+      self.response.status_int = 429
+      self.response.headers.update({
+        'Content-Type': 'text/plain',
+        'Retry-After': str(int(math.ceil(wait))),
+      })
+      self.response.write('%s API rate limit reached, try again later.' %
+                          self.source.GR_CLASS.NAME)
+      return
+
     logging.info('Fetching %s', label)
     try:
       obj = self.get_item(*ids)
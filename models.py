@@ -1,9 +1,11 @@
 """Datastore model classes.
 """
 
+import collections
 import datetime
 import json
 import logging
+import threading
 
 import appengine_config
 from appengine_config import HTTP_TIMEOUT
@@ -11,11 +13,11 @@ from appengine_config import HTTP_TIMEOUT
 from granary import microformats2
 from granary import source as gr_source
 from oauth_dropins.webutil.models import StringIdModel
-from webmentiontools import send
 
 import superfeedr
 import util
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 VERB_TYPES = ('post', 'comment', 'like', 'repost', 'rsvp')
@@ -94,6 +96,28 @@ class Source(StringIdModel):
   # refetch less often (this often) if it's been >2w since the last synd link
   SLOW_REFETCH = datetime.timedelta(days=2)
 
+  # adaptive polling. once we've measured this many polls' worth of response
+  # rate, poll_period() aims to find about TARGET_RESPONSES_PER_POLL new
+  # responses per poll, bounded by MIN_ADAPTIVE_POLL and SLOW_POLL (FAST_POLL
+  # during the grace period).
+  MIN_RESPONSE_RATE_SAMPLES = 10
+  TARGET_RESPONSES_PER_POLL = 1.0
+  MIN_ADAPTIVE_POLL = datetime.timedelta(minutes=15)
+  # weight of each new sample in the exponentially weighted response rates
+  RESPONSE_RATE_WEIGHT = 0.2
+
+  # when polls fail with silo server errors or connection failures, wait at
+  # least this long before the next poll, doubling for each consecutive failure,
+  # up to MAX_POLL_BACKOFF. see poll_backoff().
+  POLL_BACKOFF = datetime.timedelta(minutes=5)
+  MAX_POLL_BACKOFF = datetime.timedelta(days=1)
+
+  # (capacity, tokens per second) of the token bucket for this silo's API, shared
+  # across instances, or None for no limit. Polls, publishes, and permalink
+  # fetches each take one token up front. Polls are then charged for each extra
+  # API call they made. See api_token_wait() and charge_api_calls().
+  API_TOKEN_BUCKET = None
+
   # Maps Publish.type (e.g. 'like') to source-specific human readable type label
   # (e.g. 'favorite'). Subclasses should override this.
   TYPE_LABELS = {}
@@ -124,6 +148,13 @@ class Source(StringIdModel):
   #
   last_polled = ndb.DateTimeProperty(default=util.EPOCH)
   last_poll_attempt = ndb.DateTimeProperty(default=util.EPOCH)
+  # number of consecutive polls that failed with silo server errors or
+  # connection failures. reset on success.
+  poll_failures = ndb.IntegerProperty(default=0)
+  # if we haven't attempted a poll by this time, our poll task was probably
+  # lost. indexed so that cron can query for just these sources. see
+  # calculate_next_poll_due().
+  next_poll_due = ndb.DateTimeProperty(default=util.EPOCH)
   last_webmention_sent = ndb.DateTimeProperty()
   last_public_post = ndb.DateTimeProperty()
   recent_private_posts = ndb.IntegerProperty()
@@ -140,9 +171,21 @@ class Source(StringIdModel):
   # permalinks. background: https://github.com/snarfed/bridgy/issues/624
   last_feed_syndication_url = ndb.DateTimeProperty()
 
+  # exponentially weighted moving average of new responses per hour, overall
+  # and for each hour of the day (UTC). updated by update_response_rate().
+  response_rate = ndb.FloatProperty(indexed=False)
+  hourly_response_rates = ndb.FloatProperty(repeated=True, indexed=False)
+  response_rate_samples = ndb.IntegerProperty(default=0, indexed=False)
+
   last_activity_id = ndb.StringProperty()
   last_activities_etag = ndb.StringProperty()
+  # deprecated, replaced by ActivitiesCache. only read, to migrate sources.
   last_activities_cache_json = ndb.TextProperty()
+  # JSON dict mapping response id to util.response_fingerprint() for the
+  # responses seen in the last poll.
+  seen_responses_fingerprints_json = ndb.TextProperty(compressed=True)
+  # deprecated, replaced by seen_responses_fingerprints_json. only read, to
+  # migrate sources that haven't been polled since.
   seen_responses_cache_json = ndb.TextProperty(compressed=True)
 
   # this is set temporarily, in memory only, by the poll task when we get rate
@@ -153,6 +196,10 @@ class Source(StringIdModel):
   # datastore transactionally. set this to {} before beginning.
   updates = None
 
+  # number of API calls that gr_source has made, if this silo has an
+  # API_TOKEN_BUCKET. See count_api_calls().
+  api_calls = 0
+
   # gr_source is *not* set to None by default here, since it needs to be unset
   # for __getattr__ to run when it's accessed.
 
@@ -176,6 +223,8 @@ class Source(StringIdModel):
         token = (token,)
       kwargs = {'scrape': True} if self.key.kind() == 'Instagram' else {}
       self.gr_source = self.GR_CLASS(*token, **kwargs)
+      if self.API_TOKEN_BUCKET:
+        self.count_api_calls(self.gr_source)
       return self.gr_source
 
     return getattr(super(Source, self), name)
@@ -218,6 +267,8 @@ class Source(StringIdModel):
   def put_updates(cls, source):
     """Writes property values in source.updates to the datastore transactionally.
 
+    Also recalculates next_poll_due, unless source.updates sets it explicitly.
+
     Returns: the updated Source
     """
     if not source.updates:
@@ -236,6 +287,8 @@ class Source(StringIdModel):
       logging.warning('Resetting status from error to enabled')
       source.status = 'enabled'
 
+    if 'next_poll_due' not in updates:
+      source.next_poll_due = source.calculate_next_poll_due()
     source.put()
     return source
 
@@ -245,9 +298,27 @@ class Source(StringIdModel):
     Defaults to ~15m, depending on silo. If we've never sent a webmention for
     this source, or the last one we sent was over a month ago, we drop them down
     to ~1d after a week long grace period.
+
+    Once we've measured enough of the source's response rate, we instead poll
+    about as often as we expect to find TARGET_RESPONSES_PER_POLL new responses,
+    based on the overall rate and the rate for the current hour of the day.
     """
-    now = datetime.datetime.now()
-    if now < self.created + self.FAST_POLL_GRACE_PERIOD:
+    now = util.now_fn()
+    in_grace_period = now < self.created + self.FAST_POLL_GRACE_PERIOD
+
+    if (self.response_rate is not None and
+        self.response_rate_samples >= self.MIN_RESPONSE_RATE_SAMPLES):
+      rate = self.response_rate
+      hourly = self.hourly_response_rates
+      if len(hourly) == 24:
+        rate = (rate + hourly[self._response_rate_hour()]) / 2
+      max_poll = self.FAST_POLL if in_grace_period else self.SLOW_POLL
+      max_hours = max_poll.total_seconds() / 3600
+      hours = self.TARGET_RESPONSES_PER_POLL / rate if rate > 0 else max_hours
+      return max(datetime.timedelta(hours=min(hours, max_hours)),
+                 self.MIN_ADAPTIVE_POLL)
+
+    if in_grace_period:
       return self.FAST_POLL
     elif not self.last_webmention_sent:
       return self.SLOW_POLL
@@ -258,6 +329,118 @@ class Source(StringIdModel):
     else:
       return self.SLOW_POLL
 
+  def api_token_bucket_name(self):
+    """Returns the name of this source's API token bucket.
+
+    Defaults to one bucket per silo, since we use a single app key for each.
+    Subclasses should override this if the silo's limits are per user.
+    """
+    return self.SHORT_NAME
+
+  def api_token_wait(self):
+    """Takes a token from this silo's API token bucket, if it has one.
+
+    Returns: 0 if we can call the API now, otherwise float seconds until we can
+    """
+    if not self.API_TOKEN_BUCKET:
+      return 0
+    wait = util.take_token(self.api_token_bucket_name(), *self.API_TOKEN_BUCKET)
+    if wait:
+      logging.info('API token bucket %s is empty for another %.1fs',
+                   self.api_token_bucket_name(), wait)
+    return wait
+
+  def count_api_calls(self, gr_source):
+    """Wraps a granary source so that its API calls increment api_calls.
+
+    Defaults to wrapping gr_source.urlopen(), if it has one. Subclasses whose
+    granary source calls the API some other way should override this.
+
+    Args:
+      gr_source: granary.source.Source
+    """
+    urlopen = getattr(gr_source, 'urlopen', None)
+    if urlopen:
+      def counted_urlopen(*args, **kwargs):
+        self.api_calls += 1
+        return urlopen(*args, **kwargs)
+      gr_source.urlopen = counted_urlopen
+
+  def charge_api_calls(self):
+    """Charges this silo's API token bucket for API calls after the first.
+
+    api_token_wait() only takes one token, before the calls are made. This takes
+    one more for each additional call, even if the bucket goes into debt.
+    """
+    if self.API_TOKEN_BUCKET and self.api_calls > 1:
+      capacity, rate = self.API_TOKEN_BUCKET
+      util.take_token(self.api_token_bucket_name(), capacity, rate,
+                      tokens=self.api_calls - 1, force=True)
+
+  def poll_backoff(self):
+    """Returns the minimum delay before the next poll, as a datetime.timedelta.
+
+    Zero if the last poll didn't fail, otherwise grows exponentially with the
+    number of consecutive failures. util.add_poll_task() adds jitter.
+    """
+    if not self.poll_failures:
+      return datetime.timedelta(0)
+    # cap the exponent so that huge failure counts don't overflow timedelta
+    exponent = min(self.poll_failures - 1, 30)
+    return min(self.POLL_BACKOFF * 2 ** exponent, self.MAX_POLL_BACKOFF)
+
+  def calculate_next_poll_due(self):
+    """Returns when we should give up on this source's poll task, as a datetime.
+
+    That's twice the poll period or backoff, whichever is longer, after the
+    last poll attempt, and at least two hours after it.
+    """
+    period = max(self.poll_period(), self.poll_backoff())
+    return self.last_poll_attempt + max(period * 2, datetime.timedelta(hours=2))
+
+  def update_response_rate(self, num_responses):
+    """Adds a sample to the response rates, in self.updates.
+
+    Uses the time since the last successful poll as the sample's duration, so
+    it should be called before last_polled is updated. Does nothing on the
+    first poll, since there's no previous poll to measure from.
+
+    Args:
+      num_responses: integer, number of new or changed responses found
+    """
+    if self.last_polled == util.EPOCH:
+      return
+
+    hours = (self.last_poll_attempt - self.last_polled).total_seconds() / 3600
+    if hours <= 0:
+      return
+    sample = num_responses / hours
+
+    def ewma(old):
+      return (sample if old is None else
+              self.RESPONSE_RATE_WEIGHT * sample +
+              (1 - self.RESPONSE_RATE_WEIGHT) * old)
+
+    hourly = list(self.hourly_response_rates)
+    if len(hourly) != 24:
+      hourly = [sample] * 24
+    hour = self._response_rate_hour()
+    hourly[hour] = ewma(hourly[hour])
+
+    self.updates.update({
+      'response_rate': ewma(self.response_rate),
+      'hourly_response_rates': hourly,
+      'response_rate_samples': self.response_rate_samples + 1,
+    })
+
+  @staticmethod
+  def _response_rate_hour():
+    """Returns the index into hourly_response_rates for the current hour.
+
+    Used for both reads and writes, so that they always agree.
+    """
+    return util.now_fn().hour
+
   def should_refetch(self):
     """Returns True if we should run OPD refetch on this source now."""
     now = datetime.datetime.now()
@@ -472,19 +655,21 @@ class Source(StringIdModel):
       return False
     return True
 
-  def verify(self, force=False):
+  def verify(self, force=False, full_html=False):
     """Checks that this source is ready to be used.
 
     For blog and listen sources, this fetches their front page HTML and
-    discovers their webmention endpoint. For publish sources, this checks that
-    they have a domain.
+    discovers their webmention endpoint, unless WebmentionEndpointCache already
+    has it. For publish sources, this checks that they have a domain.
 
     May be overridden by subclasses, e.g. Tumblr.
 
     Args:
       force: if True, fully verifies (e.g. re-fetches the blog's HTML and
-        performs webmention discovery) even we already think this source is
-        verified.
+        performs webmention discovery, ignoring the cache) even we already
+        think this source is verified.
+      full_html: if True, reads the whole front page into self._fetched_html,
+        not just up to the webmention endpoint
     """
     author_urls = self.get_author_urls()
     if ((self.verified() and not force) or self.status == 'disabled' or
@@ -492,19 +677,31 @@ class Source(StringIdModel):
       return
 
     author_url = author_urls[0]
-    logging.info('Attempting to discover webmention endpoint on %s', author_url)
-    mention = send.WebmentionSend('https://brid.gy/', author_url)
-    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT,
-                               'headers': util.USER_AGENT_HEADER}
-    try:
-      mention._discoverEndpoint()
-    except BaseException:
-      logging.info('Error discovering webmention endpoint', exc_info=True)
-      mention.error = {'code': 'EXCEPTION'}
-
-    self._fetched_html = getattr(mention, 'html', None)
-    error = getattr(mention, 'error', None)
-    endpoint = getattr(mention, 'receiver_endpoint', None)
+    cached = None if force else WebmentionEndpointCache.get(author_url)
+    if cached:
+      logging.info('Using cached webmention endpoint for %s: %s',
+                   author_url, cached)
+      self._fetched_html = None
+      error = cached if isinstance(cached, dict) else None
+      endpoint = None if error else cached
+    else:
+      logging.info('Attempting to discover webmention endpoint on %s', author_url)
+      mention = util.WebmentionSend('https://brid.gy/', author_url)
+      mention.full_html = full_html
+      mention.requests_kwargs = {'timeout': HTTP_TIMEOUT,
+                                 'headers': util.USER_AGENT_HEADER}
+      try:
+        mention._discoverEndpoint()
+      except BaseException:
+        logging.info('Error discovering webmention endpoint', exc_info=True)
+        mention.error = {'code': 'EXCEPTION'}
+
+      self._fetched_html = getattr(mention, 'html', None)
+      error = getattr(mention, 'error', None)
+      endpoint = getattr(mention, 'receiver_endpoint', None)
+      if endpoint or (error and error.get('code') != 'BAD_TARGET_URL'):
+        WebmentionEndpointCache.set(author_url, endpoint or error)
+
     if error or not endpoint:
       logging.info("No webmention endpoint found: %s %r", error, endpoint)
       self.webmention_endpoint = None
@@ -536,11 +733,9 @@ class Source(StringIdModel):
       logging.warning('Too many profile links! Only resolving the first %s: %s',
                       MAX_AUTHOR_URLS, candidates)
 
-    urls = []
-    for i, url in enumerate(candidates):
-      url, domain, send = util.get_webmention_target(url, resolve=i < MAX_AUTHOR_URLS)
-      if send:
-        urls.append(url)
+    targets = util.get_webmention_targets(
+      candidates, resolve=[i < MAX_AUTHOR_URLS for i in range(len(candidates))])
+    urls = [url for url, _, send in targets if send]
 
     urls = util.dedupe_urls(urls)  # normalizes domains to lower case
     domains = [util.domain_from_link(url) for url in urls]
@@ -633,6 +828,13 @@ class Webmentions(StringIdModel):
   """
   STATUSES = ('new', 'processing', 'complete', 'error')
 
+  # Targets in error are retried after RETRY_BASE_DELAY seconds, doubling after
+  # each attempt up to RETRY_MAX_DELAY. After RETRY_MAX_ATTEMPTS failed
+  # attempts, about a day, they're moved to failed.
+  RETRY_BASE_DELAY = 30
+  RETRY_MAX_DELAY = 6 * 60 * 60
+  RETRY_MAX_ATTEMPTS = 12
+
   # Turn off instance and memcache caching. See Source for details.
   _use_cache = False
   _use_memcache = False
@@ -649,6 +851,12 @@ class Webmentions(StringIdModel):
   error = ndb.StringProperty(repeated=True)
   failed = ndb.StringProperty(repeated=True)
   skipped = ndb.StringProperty(repeated=True)
+  # JSON dict mapping targets in error to their retry state: a dict with keys
+  # attempts (integer), next (POSIX timestamp of the next attempt), and error
+  # (string, the last error). Targets in failed that we gave up on after
+  # RETRY_MAX_ATTEMPTS keep their attempts and error, without next, so that
+  # they aren't sent again. See update_retries().
+  retries_json = ndb.TextProperty()
 
   def label(self):
     """Returns a human-readable string description for use in log messages.
@@ -657,6 +865,73 @@ class Webmentions(StringIdModel):
     """
     raise NotImplementedError()
 
+  def retries(self):
+    """Returns the retry state dict for the targets in error. See retries_json.
+    """
+    retries = json.loads(self.retries_json) if self.retries_json else {}
+    return {url: retry for url, retry in retries.items() if url in self.error}
+
+  def gave_up(self):
+    """Returns the set of targets in failed that we gave up retrying.
+    """
+    retries = json.loads(self.retries_json) if self.retries_json else {}
+    return set(url for url, retry in retries.items()
+               if url in self.failed and
+               retry['attempts'] >= self.RETRY_MAX_ATTEMPTS)
+
+  def due_retries(self):
+    """Returns the targets in error that are due to be retried, in order.
+    """
+    now = self._now()
+    retries = self.retries()
+    return [url for url in self.error
+            if retries.get(url, {}).get('next', 0) <= now]
+
+  def next_retry_delay(self):
+    """Returns the number of seconds until the next retry is due, or None.
+    """
+    times = [retry['next'] for retry in self.retries().values()]
+    if times:
+      return max(min(times) - self._now(), 0)
+
+  def update_retries(self, errors):
+    """Records a failed attempt for each of the given targets.
+
+    Targets that have failed RETRY_MAX_ATTEMPTS times are moved from error to
+    failed, and stay there; see gave_up(). Also drops retry state for other
+    targets that are no longer in error.
+
+    Args:
+      errors: dict mapping target URL to string error message
+    """
+    now = self._now()
+    gave_up = self.gave_up()
+    retries = json.loads(self.retries_json) if self.retries_json else {}
+    for url, error in errors.items():
+      attempts = retries.get(url, {}).get('attempts', 0) + 1
+      if attempts >= self.RETRY_MAX_ATTEMPTS:
+        logging.warning('Giving up on %s after %d attempts: %s',
+                        url, attempts, error)
+        if url in self.error:
+          self.error.remove(url)
+        if url not in self.failed:
+          self.failed.append(url)
+        retries[url] = {'attempts': attempts, 'error': error}
+        gave_up.add(url)
+        continue
+      delay = min(self.RETRY_BASE_DELAY * 2 ** (attempts - 1),
+                  self.RETRY_MAX_DELAY)
+      retries[url] = {'attempts': attempts, 'next': now + delay, 'error': error}
+
+    retries = {url: retry for url, retry in retries.items()
+               if url in self.error or url in gave_up}
+    self.retries_json = json.dumps(retries, sort_keys=True) if retries else None
+
+  @staticmethod
+  def _now():
+    """Returns util.now_fn() as a POSIX timestamp."""
+    return (util.now_fn() - util.EPOCH).total_seconds()
+
   def add_task(self, **kwargs):
     """Adds a propagate task for this entity.
 
@@ -738,6 +1013,7 @@ class Response(Webmentions):
       resp.status = 'new'
       resp.unsent += resp.sent + resp.error + resp.failed + resp.skipped
       resp.sent = resp.error = resp.failed = resp.skipped = []
+      resp.retries_json = None
       resp.old_response_jsons = resp.old_response_jsons[:10] + [resp.response_json]
       resp.response_json = self.response_json
       resp.put()
@@ -745,6 +1021,93 @@ class Response(Webmentions):
 
     return resp
 
+  @classmethod
+  def get_or_save_multi(cls, responses, source):
+    """Batched, non-transactional version of get_or_save().
+
+    Loads every response (and legacy Facebook id) key in one get_multi, then
+    stores new and changed responses with one put_multi and enqueues their
+    propagate tasks in bulk. Changed responses are re-propagated just like in
+    get_or_save().
+
+    Tasks are enqueued *after* the put, so that they always see the new and
+    changed entities. Otherwise, a task for a changed response that was already
+    complete could run first, see 'complete', and drop the re-propagation. If
+    enqueueing fails, the put is undone, so that the poll task's retry stores
+    and enqueues them all again.
+
+    Args:
+      responses: sequence of Response
+      source: Source
+
+    Returns: list of Response, the stored entities, in the same order
+    """
+    if not responses:
+      return []
+
+    stored = ndb.get_multi([r.key for r in responses])
+
+    # TODO(ryan): take this out eventually. background:
+    # https://github.com/snarfed/bridgy/issues/305#issuecomment-94004416
+    fb_keys = {}
+    for i, (resp, existing) in enumerate(zip(responses, stored)):
+      if existing is None:
+        resp_json = json.loads(resp.response_json)
+        fb_id = resp_json.get('fb_id')
+        if fb_id:
+          tag_fb_id = 'tag:facebook.com,2013:' + fb_id
+          if tag_fb_id != resp_json.get('id'):
+            fb_keys[i] = ndb.Key(cls, tag_fb_id)
+    if fb_keys:
+      for i, existing in zip(fb_keys.keys(), ndb.get_multi(fb_keys.values())):
+        stored[i] = existing
+
+    results = []
+    to_put = []
+    to_propagate = []
+    originals = []  # copies of changed responses before we modified them
+    for resp, existing in zip(responses, stored):
+      if existing is None:
+        if resp.unsent or resp.error:
+          logging.debug('New webmentions to propagate! %s', resp.label())
+          to_propagate.append(resp)
+        else:
+          resp.status = 'complete'
+        to_put.append(resp)
+        results.append(resp)
+        continue
+
+      if (resp.type != existing.type or
+          source.gr_source.activity_changed(json.loads(existing.response_json),
+                                           json.loads(resp.response_json),
+                                           log=True)):
+        logging.info('Response changed! Re-propagating. Original: %s' % existing)
+        originals.append(cls(key=existing.key, **existing.to_dict()))
+        existing.status = 'new'
+        existing.unsent += (existing.sent + existing.error + existing.failed +
+                            existing.skipped)
+        existing.sent = existing.error = existing.failed = existing.skipped = []
+        existing.retries_json = None
+        existing.old_response_jsons = (existing.old_response_jsons[:10] +
+                                       [existing.response_json])
+        existing.response_json = resp.response_json
+        to_put.append(existing)
+        to_propagate.append(existing)
+      results.append(existing)
+
+    if to_put:
+      ndb.put_multi(to_put)
+    if to_propagate:
+      try:
+        util.add_propagate_tasks(to_propagate)
+      except:
+        logging.warning('Enqueueing propagate tasks failed. Undoing put.')
+        original_keys = set(o.key for o in originals)
+        ndb.delete_multi([r.key for r in to_put if r.key not in original_keys])
+        ndb.put_multi(originals)
+        raise
+    return results
+
 
 class BlogPost(Webmentions):
   """A blog post to be processed for links to send webmentions to.
@@ -908,3 +1271,370 @@ class SyndicatedPost(ndb.Model):
 
   def _pre_put_hook(self):
     self.key.parent().get().on_new_syndicated_post(self)
+
+
+class CachedActivities(ndb.Model):
+  """Durable tier of ActivitiesCache. Child of a Source, key id 'activities'.
+  """
+  # Turn off instance and memcache caching. ActivitiesCache does its own.
+  _use_cache = False
+  _use_memcache = False
+
+  # maps cache key to [value, expiration POSIX timestamp]
+  values = ndb.JsonProperty(compressed=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+# in-process tier of ActivitiesCache, shared by all requests on this instance.
+# maps (source key, cache key) to (value, expiration POSIX timestamp).
+_activities_lru = collections.OrderedDict()
+_activities_lru_lock = threading.Lock()
+
+
+class ActivitiesCache(object):
+  """Cache for the cache kwarg to granary's get_activities_response().
+
+  Implements the parts of memcache's API that granary uses, scoped to a single
+  source. Reads go through three tiers: an in-process LRU, then memcache, then a
+  CachedActivities child entity of the source. Writes go to all three, except
+  that the CachedActivities entity is only written by flush(). Each key has its
+  own expiration; expired keys are dropped from the durable tier by prune().
+
+  Attributes:
+    source: Source
+    entity: CachedActivities, loaded lazily
+  """
+  # default expiration for keys set without an explicit time, in seconds
+  DEFAULT_TIME = 7 * 24 * 60 * 60
+  # maximum number of keys, across all sources, in the in-process tier
+  LRU_SIZE = 5000
+
+  def __init__(self, source):
+    self.source = source
+    self.entity = None
+    self.dirty = False
+
+  @staticmethod
+  def clear_lru():
+    """Empties the in-process tier. Mainly for unit tests."""
+    with _activities_lru_lock:
+      _activities_lru.clear()
+
+  def _memcache_key(self, key):
+    return 'AC %s %s' % (self.source.key.urlsafe(), key)
+
+  def _load(self):
+    """Loads the durable tier, migrating Source.last_activities_cache_json."""
+    if self.entity is None:
+      key = ndb.Key(CachedActivities, 'activities', parent=self.source.key)
+      self.entity = key.get() or CachedActivities(key=key)
+      if self.entity.values is None:
+        self.entity.values = {}
+      legacy = self.source.last_activities_cache_json
+      if legacy and not self.entity.values:
+        expires = self._now() + self.DEFAULT_TIME
+        self.entity.values = {k: [v, expires]
+                              for k, v in json.loads(legacy).items()}
+        self.dirty = True
+        if self.source.updates is not None:
+          self.source.updates['last_activities_cache_json'] = None
+    return self.entity
+
+  def get(self, key):
+    return self.get_multi([key]).get(key)
+
+  def get_multi(self, keys):
+    keys = list(keys)
+    now = self._now()
+    found = {}
+
+    with _activities_lru_lock:
+      for key in keys:
+        cached = _activities_lru.get((self.source.key, key))
+        if cached and cached[1] > now:
+          found[key] = cached[0]
+          del _activities_lru[(self.source.key, key)]  # move to the end
+          _activities_lru[(self.source.key, key)] = cached
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+      hits = memcache.get_multi([self._memcache_key(k) for k in missing])
+      for key in missing:
+        cached = hits.get(self._memcache_key(key))
+        if cached and cached[1] > now:
+          found[key] = cached[0]
+          self._set_lru(key, cached)
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+      values = self._load().values
+      backfill = {}
+      for key in missing:
+        cached = values.get(key)
+        if cached and cached[1] > now:
+          found[key] = cached[0]
+          backfill[key] = cached
+          self._set_lru(key, cached)
+      if backfill:
+        self._set_memcache(backfill)
+
+    return found
+
+  def set(self, key, value, time=0):
+    self.set_multi({key: value}, time=time)
+
+  def set_multi(self, mapping, time=0):
+    """Sets keys in all tiers. time is the expiration, in seconds."""
+    expires = self._now() + (time or self.DEFAULT_TIME)
+    updates = {k: [v, expires] for k, v in mapping.items()}
+    for key, cached in updates.items():
+      self._set_lru(key, cached)
+    self._set_memcache(updates)
+    self._load().values.update(updates)
+    self.dirty = True
+    return []
+
+  def delete_multi(self, keys):
+    keys = list(keys)
+    with _activities_lru_lock:
+      for key in keys:
+        _activities_lru.pop((self.source.key, key), None)
+    memcache.delete_multi([self._memcache_key(k) for k in keys])
+    values = self._load().values
+    for key in keys:
+      if values.pop(key, None) is not None:
+        self.dirty = True
+    return True
+
+  def prune(self, activity_ids):
+    """Drops expired keys and keys for activities other than activity_ids.
+
+    Finds them in the durable tier, then drops them from all three tiers.
+
+    WARNING: depends on get_activities_response()'s cache key format, e.g.
+    'PREFIX ACTIVITY_ID'!
+
+    Args:
+      activity_ids: set of string silo activity ids
+    """
+    if self.entity is None and not self.source.last_activities_cache_json:
+      return  # the durable tier wasn't touched, so prune it next time
+
+    now = self._now()
+    values = self._load().values
+    pruned = [key for key, (value, expires) in values.items()
+              if expires <= now or key.split()[-1] not in activity_ids]
+    if pruned:
+      self.delete_multi(pruned)
+
+  def flush(self):
+    """Writes the durable tier to the datastore if it has changed."""
+    if self.dirty:
+      self.entity.put()
+      self.dirty = False
+
+  @staticmethod
+  def _now():
+    """Returns util.now_fn() as a POSIX timestamp."""
+    return (util.now_fn() - util.EPOCH).total_seconds()
+
+  def _set_lru(self, key, cached):
+    with _activities_lru_lock:
+      _activities_lru.pop((self.source.key, key), None)
+      _activities_lru[(self.source.key, key)] = cached
+      while len(_activities_lru) > self.LRU_SIZE:
+        _activities_lru.popitem(last=False)
+
+  def _set_memcache(self, updates):
+    ttl = max(int(min(e for _, e in updates.values()) - self._now()), 1)
+    memcache.set_multi({self._memcache_key(k): v for k, v in updates.items()},
+                       time=ttl)
+
+
+class CachedWebmentionEndpoint(ndb.Model):
+  """Durable tier of WebmentionEndpointCache. Key id is the cache key.
+
+  Only holds discovered endpoints, not discovery errors. WebmentionEndpointCache
+  only reads an endpoint from here once it's been discovered
+  DURABLE_DISCOVERIES times in a row.
+  """
+  # Turn off instance and memcache caching. WebmentionEndpointCache does its own.
+  _use_cache = False
+  _use_memcache = False
+
+  endpoint = ndb.StringProperty(indexed=False)
+  # number of consecutive discoveries that found this endpoint
+  discoveries = ndb.IntegerProperty(indexed=False, default=1)
+  # expiration POSIX timestamp
+  expires = ndb.FloatProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+# in-process tier of WebmentionEndpointCache, shared by all requests on this
+# instance. maps cache key to (value, expiration POSIX timestamp).
+_endpoint_lru = collections.OrderedDict()
+_endpoint_lru_lock = threading.Lock()
+
+
+class WebmentionEndpointCache(object):
+  """Caches webmention endpoint discovery results by URL scheme and domain.
+
+  Values are a string endpoint URL if discovery succeeded, or a WebmentionSend
+  error dict if it failed. Reads go through three tiers: an in-process LRU, then
+  memcache, then CachedWebmentionEndpoint entities. How long a value is cached
+  depends on what it is; see set(). Endpoints that keep failing are
+  invalidated; see record_failure().
+  """
+  # discovered endpoints, in the LRU and memcache
+  ENDPOINT_TIME = 24 * 60 * 60
+  # discovered endpoints, in the datastore, once they've been discovered this
+  # many times in a row
+  DURABLE_ENDPOINT_TIME = 30 * 24 * 60 * 60
+  DURABLE_DISCOVERIES = 3
+  # pages without an endpoint
+  NO_ENDPOINT_TIME = 2 * 60 * 60
+  # values read from memcache, in the LRU. memcache doesn't tell us how long
+  # they have left, so this is conservative.
+  MEMCACHE_LRU_TIME = 5 * 60
+  # record_failure() invalidates an endpoint after this many failures within
+  # FAILURE_WINDOW seconds
+  MAX_FAILURES = 3
+  FAILURE_WINDOW = 24 * 60 * 60
+  LRU_SIZE = 5000
+
+  @staticmethod
+  def clear_lru():
+    """Empties the in-process tier. Mainly for unit tests."""
+    with _endpoint_lru_lock:
+      _endpoint_lru.clear()
+
+  @classmethod
+  def get(cls, url):
+    return cls.get_multi([url]).get(url)
+
+  @classmethod
+  def get_multi(cls, urls):
+    """Looks up cached discovery results for many target URLs at once.
+
+    Args:
+      urls: sequence of string target URLs
+
+    Returns: dict mapping URL to cached value. URLs without a cached value
+      aren't included.
+    """
+    now = cls._now()
+    keys = {}
+    for url in urls:
+      keys.setdefault(util.webmention_endpoint_cache_key(url), []).append(url)
+    found = {}
+
+    with _endpoint_lru_lock:
+      for key in keys:
+        cached = _endpoint_lru.pop(key, None)
+        if cached and cached[1] > now:
+          found[key] = cached[0]
+          _endpoint_lru[key] = cached  # move to the end
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+      hits = memcache.get_multi(missing)
+      for key, val in hits.items():
+        if val:
+          found[key] = val
+          cls._set_lru(key, val, now + cls.MEMCACHE_LRU_TIME)
+
+    missing = [k for k in keys if k not in found]
+    if missing:
+      backfill = {}
+      for entity in ndb.get_multi([ndb.Key(CachedWebmentionEndpoint, k)
+                                   for k in missing]):
+        if (entity and entity.endpoint and entity.expires > now and
+            entity.discoveries >= cls.DURABLE_DISCOVERIES):
+          key = entity.key.id()
+          found[key] = backfill[key] = entity.endpoint
+          cls._set_lru(key, entity.endpoint, now + cls.ENDPOINT_TIME)
+      if backfill:
+        memcache.set_multi(backfill, time=cls.ENDPOINT_TIME)
+
+    return {url: found[key] for key, key_urls in keys.items() if key in found
+            for url in key_urls}
+
+  @classmethod
+  def set(cls, url, value):
+    """Caches a discovery result.
+
+    Discovered endpoints are cached for a day in the LRU and memcache. They're
+    also stored in the datastore, which serves them for a month once they've
+    been discovered DURABLE_DISCOVERIES times in a row. NO_ENDPOINT errors are
+    cached for a couple hours. Other errors, e.g. connection failures, are
+    usually transient, so they're not cached, so that they don't short circuit
+    other targets on the same domain.
+
+    Args:
+      url: string target URL
+      value: string endpoint URL or WebmentionSend error dict
+
+    Returns: boolean, whether the value was cached
+    """
+    key = util.webmention_endpoint_cache_key(url)
+    if isinstance(value, dict):
+      if value.get('code') != 'NO_ENDPOINT':
+        return False
+      time = cls.NO_ENDPOINT_TIME
+    else:
+      time = cls.ENDPOINT_TIME
+      existing = CachedWebmentionEndpoint.get_by_id(key)
+      discoveries = (existing.discoveries + 1
+                     if existing and existing.endpoint == value else 1)
+      CachedWebmentionEndpoint(id=key, endpoint=value, discoveries=discoveries,
+                               expires=cls._now() + cls.DURABLE_ENDPOINT_TIME
+                               ).put()
+
+    cls._set_lru(key, value, cls._now() + time)
+    memcache.set(key, value, time=time)
+    return True
+
+  @classmethod
+  def record_failure(cls, url):
+    """Records a 5xx or connection failure from a cached endpoint.
+
+    After MAX_FAILURES of these within FAILURE_WINDOW, deletes the cached
+    endpoint so that it's rediscovered.
+
+    Args:
+      url: string target URL
+
+    Returns: boolean, whether the cached endpoint was deleted
+    """
+    key = 'WF ' + util.webmention_endpoint_cache_key(url)
+    memcache.add(key, 0, time=cls.FAILURE_WINDOW)
+    if (memcache.incr(key) or 0) < cls.MAX_FAILURES:
+      return False
+
+    logging.info('Endpoint for %s failed %d times. Invalidating.', url,
+                 cls.MAX_FAILURES)
+    cls.delete_multi([url])
+    memcache.delete(key)
+    return True
+
+  @classmethod
+  def delete_multi(cls, urls):
+    keys = set(util.webmention_endpoint_cache_key(url) for url in urls)
+    with _endpoint_lru_lock:
+      for key in keys:
+        _endpoint_lru.pop(key, None)
+    memcache.delete_multi(list(keys))
+    ndb.delete_multi([ndb.Key(CachedWebmentionEndpoint, k) for k in keys])
+
+  @staticmethod
+  def _now():
+    """Returns util.now_fn() as a POSIX timestamp."""
+    return (util.now_fn() - util.EPOCH).total_seconds()
+
+  @classmethod
+  def _set_lru(cls, key, value, expires):
+    with _endpoint_lru_lock:
+      _endpoint_lru.pop(key, None)
+      _endpoint_lru[key] = (value, expires)
+      while len(_endpoint_lru) > cls.LRU_SIZE:
+        _endpoint_lru.popitem(last=False)
@@ -23,15 +23,27 @@ lookups in the following primary cases:
     request for *each* post permalink that has not been seen before.
   - 1 DB query for the initial check plus 1 additional DB query for
     *each* post permalink.
+  - If the h-feed hasn't changed since we last processed it, 0 additional
+    requests or DB queries after fetching it. Otherwise, only entries that
+    are new or changed are processed.
+
+The h-feed is fetched truncated, and only its newest MAX_PERMALINK_FETCHES
+entries are considered, so the watermark that decides whether it has changed
+only covers those. Changes further down aren't seen. Separately, every
+HFEED_WATERMARK_TIME (or sooner, if memcache evicts the watermark) we do a full
+pass over those top entries, so an entry skipped as unchanged, e.g. because
+its syndication links were added on its permalink page, isn't skipped forever.
 """
 
 import collections
 import datetime
+import hashlib
 import itertools
+import json
 import logging
 import mf2util
 import requests
-import urlparse
+import threading
 import util
 
 from granary import microformats2
@@ -44,6 +56,29 @@ from google.appengine.api import memcache
 
 MAX_PERMALINK_FETCHES = 10
 
+# _process_author() stores a watermark of each h-feed it processes in memcache,
+# and does a full pass over the h-feed at least this often, in seconds. See
+# _watermark_key().
+HFEED_WATERMARK_TIME = 24 * 60 * 60
+
+
+class FetchedHfeeds(set):
+  """Author URLs whose h-feeds have already been fetched in this round.
+
+  Pass one of these as already_fetched_hfeeds when calling discover() from
+  multiple threads at once. Its per-URL locks make sure each h-feed is still
+  only fetched once, while different h-feeds can be fetched concurrently.
+  """
+  def __init__(self, *args, **kwargs):
+    super(FetchedHfeeds, self).__init__(*args, **kwargs)
+    self._locks = {}
+    self._locks_lock = threading.Lock()
+
+  def lock(self, url):
+    """Returns the lock to hold while fetching url's h-feed."""
+    with self._locks_lock:
+      return self._locks.setdefault(url, threading.Lock())
+
 
 def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
              already_fetched_hfeeds=None):
@@ -63,12 +98,13 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
     include_redirect_sources: boolean, whether to include URLs that redirect as
       well as their final destination URLs
     already_fetched_hfeeds: set, URLs that we have already fetched and run
-      posse-post-discovery on, so we can avoid running it multiple times
+      posse-post-discovery on, so we can avoid running it multiple times. Use a
+      FetchedHfeeds if you're calling discover() concurrently.
 
   Returns: (set(string original post URLs), set(string mention URLs)) tuple
 
   """
-  if not source.updates:
+  if source.updates is None:
     source.updates = {}
 
   if already_fetched_hfeeds is None:
@@ -101,18 +137,22 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
                     att_origs)
       mentions.update(att_origs)
 
-  def resolve(urls):
+  def resolve(urls, targets):
     resolved = set()
-    for url in urls:
-      final, _, send = util.get_webmention_target(url)
+    for url, (final, _, send) in zip(urls, targets):
       if send:
         resolved.add(final)
         if include_redirect_sources:
           resolved.add(url)
     return resolved
 
-  originals = resolve(originals)
-  mentions = resolve(mentions)
+  # resolve originals and mentions together, in one batch
+  originals = list(originals)
+  mentions = list(mentions)
+  targets = util.get_webmention_targets(originals + mentions)
+  num_originals = len(originals)
+  originals = resolve(originals, targets[:num_originals])
+  mentions = resolve(mentions, targets[num_originals:])
 
   if not source.get_author_urls():
     logging.debug('no author url(s), cannot find h-feed')
@@ -139,7 +179,7 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
   return originals, mentions
 
 
-def refetch(source):
+def refetch(source, force=False):
   """Refetch the author's URLs and look for new or updated syndication
   links that might not have been there the first time we looked.
 
@@ -147,6 +187,8 @@ def refetch(source):
     source: models.Source subclass. Changes to property values (e.g. domains,
       domain_urls, last_syndication_url) are stored in source.updates; they
       should be updated transactionally later.
+    force: boolean, whether to process every h-feed entry, even ones that
+      haven't changed since the last refetch
 
   Return:
     a dict of syndicated_url to a list of new models.SyndicatedPosts
@@ -157,7 +199,7 @@ def refetch(source):
   logging.debug('attempting to refetch h-feed for %s', source.label())
   results = {}
   for url in _get_author_urls(source):
-    results.update(_process_author(source, url, refetch=True))
+    results.update(_process_author(source, url, refetch=True, force=force))
 
   return results
 
@@ -196,7 +238,8 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
       author's feed if we don't have a previously stored
       relationship
     already_fetched_hfeeds: set, URLs we've already fetched in a
-      previous iteration
+      previous iteration. If it's a FetchedHfeeds, each URL's lock is held
+      while fetching it.
 
   Return:
     sequence of string original post urls, possibly empty
@@ -204,9 +247,15 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
   logging.info('starting posse post discovery with syndicated %s',
                syndication_url)
 
-  relationships = SyndicatedPost.query(
-    SyndicatedPost.syndication == syndication_url,
-    ancestor=source.key).fetch()
+  def query():
+    return SyndicatedPost.query(SyndicatedPost.syndication == syndication_url,
+                                ancestor=source.key).fetch()
+
+  # the set only grows, so if it grows by more than the h-feeds we fetch
+  # below, another thread fetched one (and stored its relationships) after
+  # our query.
+  num_fetched = len(already_fetched_hfeeds)
+  relationships = query()
 
   if not relationships and fetch_hfeed:
     # a syndicated post we haven't seen before! fetch the author's URLs to see
@@ -216,13 +265,20 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
     # fallback in the future to support content from non-Bridgy users.
     results = {}
     for url in _get_author_urls(source):
-      if url not in already_fetched_hfeeds:
-        results.update(_process_author(source, url))
-        already_fetched_hfeeds.add(url)
-      else:
-        logging.debug('skipping %s, already fetched this round', url)
+      lock = (already_fetched_hfeeds.lock(url)
+              if isinstance(already_fetched_hfeeds, FetchedHfeeds)
+              else threading.Lock())
+      with lock:
+        if url not in already_fetched_hfeeds:
+          results.update(_process_author(source, url))
+          already_fetched_hfeeds.add(url)
+          num_fetched += 1
+        else:
+          logging.debug('skipping %s, already fetched this round', url)
 
     relationships = results.get(syndication_url, [])
+    if not relationships and len(already_fetched_hfeeds) > num_fetched:
+      relationships = query()
 
   if not relationships:
     # No relationships were found. Remember that we've seen this
@@ -239,7 +295,8 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
   return originals
 
 
-def _process_author(source, author_url, refetch=False, store_blanks=True):
+def _process_author(source, author_url, refetch=False, store_blanks=True,
+                    force=False):
   """Fetch the author's domain URL, and look for syndicated posts.
 
   Args:
@@ -248,6 +305,8 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     refetch: boolean, whether to refetch and process entries we've seen before
     store_blanks: boolean, whether we should store blank SyndicatedPosts when
       we don't find a relationship
+    force: boolean, whether to process every entry, even if the h-feed
+      hasn't changed since the last time we processed it
 
   Return:
     a dict of syndicated_url to a list of new models.SyndicatedPost
@@ -260,11 +319,13 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
 
   try:
     logging.debug('fetching author url %s', author_url)
-    author_resp = util.requests_get(author_url)
+    # we only need the top of the h-feed, since that's where the newest posts are
+    author_resp = util.requests_get(author_url, truncate=True)
     # TODO for error codes that indicate a temporary error, should we make
     # a certain number of retries before giving up forever?
     author_resp.raise_for_status()
-    author_dom = util.beautifulsoup_parse(author_resp.text)
+    # looks up the mf2 in the cache first, and only parses on a miss
+    author_mf2 = util.mf2py_parse(author_resp.text, author_url)
   except AssertionError:
     raise  # for unit tests
   except BaseException:
@@ -273,18 +334,14 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     logging.warning('Could not fetch author url %s', author_url, exc_info=True)
     return {}
 
-  feeditems = _find_feed_items(author_url, author_dom)
+  feeditems = _find_feed_items(author_mf2)
 
-  # look for all other feed urls using rel='feed', type='text/html'
+  # look for all other feed urls using rel='feed', type='text/html'. mf2py has
+  # already resolved them against author_url.
   feed_urls = set()
-  for rel_feed_node in (author_dom.find_all('link', rel='feed')
-                        + author_dom.find_all('a', rel='feed')):
-    feed_url = rel_feed_node.get('href')
-    if not feed_url:
-      continue
-
-    feed_url = urlparse.urljoin(author_url, feed_url)
-    feed_type = rel_feed_node.get('type')
+  rel_urls = author_mf2.get('rel-urls', {})
+  for feed_url in author_mf2.get('rels', {}).get('feed', []):
+    feed_type = rel_urls.get(feed_url, {}).get('type')
     if not feed_type:
       # type is not specified, use this to confirm that it's text/html
       feed_url, _, feed_type_ok = util.get_webmention_target(feed_url)
@@ -301,11 +358,11 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   for feed_url in feed_urls:
     try:
       logging.debug("fetching author's rel-feed %s", feed_url)
-      feed_resp = util.requests_get(feed_url)
+      feed_resp = util.requests_get(feed_url, truncate=True)
       feed_resp.raise_for_status()
       logging.debug("author's rel-feed fetched successfully %s", feed_url)
-      feeditems = _merge_hfeeds(feeditems,
-                                _find_feed_items(feed_url, feed_resp.text))
+      feeditems = _merge_hfeeds(feeditems, _find_feed_items(
+        util.mf2py_parse(feed_resp.text, feed_url)))
 
       domain = util.domain_from_link(feed_url)
       if source.updates is not None and domain not in source.domains:
@@ -340,6 +397,46 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
       logging.info('Hit cap of %d permalinks. Stopping.', MAX_PERMALINK_FETCHES)
       break
 
+  # incremental mode: skip entries that haven't changed since the last time we
+  # processed this h-feed, unless they're newer than the newest one we saw.
+  # refetch mostly looks for syndication links on permalink pages, which an
+  # unchanged h-feed doesn't rule out, so it only does this when the h-feed
+  # itself has syndication links.
+  hashes = dict((permalink, _hash(entry))
+                for permalink, entry in permalink_to_entry.items())
+  dates = filter(None, (updated_or_published(entry)
+                        for entry in permalink_to_entry.values()))
+  now = util.now_fn()
+  watermark = {
+    'hash': _hash(permalink_to_entry.items()),
+    'newest': max(dates) if dates else '',
+    'entries': hashes,
+    'since': now,
+  }
+  watermark_key = _watermark_key(source, author_url, refetch)
+
+  if not force and (not refetch or source.last_feed_syndication_url):
+    last = memcache.get(watermark_key)
+    if last and now - last.get('since', util.EPOCH) > datetime.timedelta(
+        seconds=HFEED_WATERMARK_TIME):
+      logging.info('h-feed %s watermark is from %s. Doing a full pass.',
+                   author_url, last.get('since'))
+      last = None
+    if last:
+      # keep the time of the last full pass, so that we do another one after
+      # HFEED_WATERMARK_TIME even if the h-feed keeps changing.
+      watermark['since'] = last['since']
+      if last['hash'] == watermark['hash']:
+        logging.info("h-feed %s hasn't changed since we last processed it. "
+                     'Skipping.', author_url)
+        return {}
+      permalink_to_entry = collections.OrderedDict(
+        (permalink, entry) for permalink, entry in permalink_to_entry.items()
+        if (hashes[permalink] != last['entries'].get(permalink)
+            or (updated_or_published(entry) or '') > last['newest']))
+      logging.info('h-feed %s has %d new or changed entries',
+                   author_url, len(permalink_to_entry))
+
   # query all preexisting permalinks at once, instead of once per link
   permalinks_list = list(permalink_to_entry.keys())
   # fetch the maximum allowed entries (currently 30) at a time
@@ -368,9 +465,28 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     # Source will be saved at the end of each round of polling
     source.updates['last_syndication_url'] = util.now_fn()
 
+  memcache.set(watermark_key, watermark, time=HFEED_WATERMARK_TIME)
   return results
 
 
+def _watermark_key(source, author_url, refetch):
+  """Returns the memcache key for an h-feed's watermark.
+
+  The watermark is a dict with the h-feed's newest dt-updated or dt-published
+  value, a hash of its entries, and a hash of each entry by permalink.
+  Discovery and refetch keep separate watermarks since they process
+  different entries.
+  """
+  key = u'%s %s %s' % (source.key.urlsafe(), 'refetch' if refetch else 'new',
+                       author_url)
+  return 'HW ' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _hash(obj):
+  """Returns a string hash of a JSON-serializable object, e.g. an mf2 item."""
+  return hashlib.sha1(json.dumps(obj, sort_keys=True)).hexdigest()
+
+
 def _merge_hfeeds(feed1, feed2):
   """Merge items from two h-feeds into a composite feed. Skips items in
   feed2 that are already represented in feed1, based on the "url" property.
@@ -392,21 +508,17 @@ def _merge_hfeeds(feed1, feed2):
     url not in seen for url in item.get('properties', {}).get('url', []))]
 
 
-def _find_feed_items(feed_url, feed_doc):
-  """Extract feed items from a given URL and document. If the top-level
+def _find_feed_items(parsed):
+  """Extract feed items from a parsed document. If the top-level
   h-* item is an h-feed, return its children. Otherwise, returns the
   top-level items.
 
   Args:
-    feed_url: a string. the URL passed to mf2py parser
-    feed_doc: a string or BeautifulSoup object. document is passed to
-      mf2py parser
+    parsed: dict, mf2py result for the feed
 
   Returns:
     a list of dicts, each one representing an mf2 h-* item
   """
-  parsed = util.mf2py_parse(feed_doc, feed_url)
-
   feeditems = parsed['items']
   hfeeds = mf2util.find_all_entries(parsed, ('h-feed',))
   if hfeeds:
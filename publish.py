@@ -30,6 +30,7 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 import collections
 import logging
 import json
+import math
 import pprint
 import urllib
 import urlparse
@@ -203,6 +204,14 @@ class Handler(webmention.WebmentionHandler):
         return self.error(
           "Looks like that's your home page. Try one of your posts instead!")
 
+    # check this before creating the Publish entity, so that we don't leave one
+    # behind for every request we turn away
+    wait = self.source.api_token_wait()
+    if wait:
+      return self.error(
+        "We're making too many %s API calls right now. Please try again in %d seconds." %
+        (source_cls.GR_CLASS.NAME, math.ceil(wait)), status=429)
+
     # done with the sanity checks, ready to fetch the source url. create the
     # Publish entity so we can store the result.
     entity = self.get_or_add_publish_entity(url)
@@ -220,49 +229,53 @@ class Handler(webmention.WebmentionHandler):
     # find rel-shortlink, if any
     # http://microformats.org/wiki/rel-shortlink
     # https://github.com/snarfed/bridgy/issues/173
-    soup = util.beautifulsoup_parse(self.fetched.text)
+    soup = self.parsed.doc
     shortlinks = (soup.find_all('link', rel='shortlink') +
                   soup.find_all('a', rel='shortlink') +
                   soup.find_all('a', class_='shortlink'))
     if shortlinks:
       self.shortlink = shortlinks[0]['href']
 
-    # loop through each item and its children and try to preview/create it. if
-    # it fails, try the next one. break after the first one that works.
-    resp = None
-    types = set()
-    queue = collections.deque(data.get('items', []))
-    while queue:
-      item = queue.popleft()
-      item_types = set(item.get('type'))
-      if 'h-feed' in item_types and 'h-entry' not in item_types:
-        queue.extend(item.get('children', []))
-        continue
-      elif not item_types & PUBLISHABLE_TYPES:
-        continue
+    try:
+      # loop through each item and its children and try to preview/create it. if
+      # it fails, try the next one. break after the first one that works.
+      resp = None
+      types = set()
+      queue = collections.deque(data.get('items', []))
+      while queue:
+        item = queue.popleft()
+        item_types = set(item.get('type'))
+        if 'h-feed' in item_types and 'h-entry' not in item_types:
+          queue.extend(item.get('children', []))
+          continue
+        elif not item_types & PUBLISHABLE_TYPES:
+          continue
 
-      try:
-        result = self.attempt_single_item(item)
-        if self.entity.published:
-          break
-        if result.abort:
-          if result.error_plain:
-            self.error(result.error_plain, html=result.error_html, data=item)
-          return
-        # try the next item
-        for embedded in ('rsvp', 'invitee', 'repost', 'repost-of', 'like',
-                         'like-of', 'in-reply-to'):
-          if embedded in item.get('properties', []):
-            item_types.add(embedded)
-        logging.info(
-          'Object type(s) %s not supported; error=%s; trying next.',
-          item_types, result.error_plain)
-        types = types.union(item_types)
-        queue.extend(item.get('children', []))
-      except BaseException, e:
-        code, body = util.interpret_http_exception(e)
-        return self.error('Error: %s %s' % (body or '', e), status=code or 500,
-                          mail=True)
+        try:
+          result = self.attempt_single_item(item)
+          if self.entity.published:
+            break
+          if result.abort:
+            if result.error_plain:
+              self.error(result.error_plain, html=result.error_html, data=item)
+            return
+          # try the next item
+          for embedded in ('rsvp', 'invitee', 'repost', 'repost-of', 'like',
+                           'like-of', 'in-reply-to'):
+            if embedded in item.get('properties', []):
+              item_types.add(embedded)
+          logging.info(
+            'Object type(s) %s not supported; error=%s; trying next.',
+            item_types, result.error_plain)
+          types = types.union(item_types)
+          queue.extend(item.get('children', []))
+        except BaseException, e:
+          code, body = util.interpret_http_exception(e)
+          return self.error('Error: %s %s' % (body or '', e),
+                            status=code or 500, mail=True)
+    finally:
+      # api_token_wait() only took one token. charge for the rest.
+      self.source.charge_api_calls()
 
     if not self.entity.published:  # tried all the items
       types.discard('h-entry')
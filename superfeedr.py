@@ -51,8 +51,7 @@ def subscribe(source, handler):
   resp = util.requests_post(
     PUSH_API_URL, data=data,
     auth=HTTPBasicAuth(appengine_config.SUPERFEEDR_USERNAME,
-                       appengine_config.SUPERFEEDR_TOKEN),
-    headers=util.USER_AGENT_HEADER)
+                       appengine_config.SUPERFEEDR_TOKEN))
   resp.raise_for_status()
   handle_feed(resp.text, source)
 
@@ -5,6 +5,7 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import bz2
 import calendar
+import collections
 import copy
 import datetime
 import gc
@@ -14,13 +15,11 @@ import logging
 import random
 import urlparse
 
-from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 from granary import source as gr_source
 import webapp2
-from webmentiontools import send
 
 import appengine_config
 
@@ -40,8 +39,6 @@ import twitter
 import util
 import wordpress_rest
 
-WEBMENTION_DISCOVERY_CACHE_TIME = 60 * 60 * 2  # 2h
-
 ERROR_HTTP_RETURN_CODE = 304  # "Not Modified"
 
 
@@ -53,7 +50,11 @@ class Poll(webapp2.RequestHandler):
     last_polled: timestamp, YYYY-MM-DD-HH-MM-SS
 
   Inserts a propagate task for each response that hasn't been seen before.
+
+  Attributes:
+    breaker: util.CircuitBreaker for the source's silo
   """
+  breaker = None
 
   def post(self, *path_args):
     logging.debug('Params: %s', self.request.params)
@@ -71,6 +72,18 @@ class Poll(webapp2.RequestHandler):
       logging.warning('duplicate poll task! deferring to the other task.')
       return
 
+    self.breaker = util.CircuitBreaker(source.SHORT_NAME)
+    if not self.breaker.allow():
+      logging.info('Silo API circuit breaker is open. Rescheduling poll.')
+      self.reschedule(source, self.breaker.retry_after() * random.uniform(1, 1.5))
+      return
+
+    wait = source.api_token_wait()
+    if wait:
+      logging.info('Out of API tokens. Rescheduling poll.')
+      self.reschedule(source, wait * random.uniform(1, 1.2))
+      return
+
     logging.info('Last poll: %s/log?start_time=%s&key=%s',
                  self.request.host_url,
                  calendar.timegm(source.last_poll_attempt.utctimetuple()),
@@ -95,6 +108,7 @@ class Poll(webapp2.RequestHandler):
       source.updates['poll_status'] = 'error'
       raise
     finally:
+      source.charge_api_calls()
       source = models.Source.put_updates(source)
 
     # add new poll task. randomize task ETA to within +/- 20% to try to spread
@@ -106,6 +120,20 @@ class Poll(webapp2.RequestHandler):
     source = None
     gc.collect()
 
+  @staticmethod
+  def reschedule(source, countdown):
+    """Adds a new poll task for a poll we didn't run, and pushes back its
+    next_poll_due so that cron.ReplacePollTasks doesn't add a duplicate task.
+
+    Args:
+      source: Source
+      countdown: float, seconds until the new task should run
+    """
+    source.updates = {'next_poll_due': util.now_fn() +
+                                       datetime.timedelta(seconds=countdown * 2)}
+    source = models.Source.put_updates(source)
+    util.add_poll_task(source, countdown=countdown)
+
   def poll(self, source):
     """Actually runs the poll.
 
@@ -120,24 +148,27 @@ class Poll(webapp2.RequestHandler):
     # * posts by the user
     # * search all posts for the user's domain URLs to find links
     #
-    cache = util.CacheDict()
-    if source.last_activities_cache_json:
-      cache.update(json.loads(source.last_activities_cache_json))
+    cache = models.ActivitiesCache(source)
+    breaker = self.breaker or util.CircuitBreaker(source.SHORT_NAME)
 
     try:
-      # search for links first so that the user's activities and responses
-      # override them if they overlap
-      links = source.search_for_links()
-
-      # this user's own activities (and user mentions)
-      resp = source.get_activities_response(
-        fetch_replies=True, fetch_likes=True, fetch_shares=True,
-        fetch_mentions=True, count=50, etag=source.last_activities_etag,
-        min_id=source.last_activity_id, cache=cache)
+      # load gr_source up front so that the threads below don't race to do it
+      source.gr_source
+
+      # search for links and fetch this user's own activities (and user
+      # mentions). these are separate silo API calls, so make them concurrently.
+      links, resp = util.run_in_threads((
+        source.search_for_links,
+        lambda: source.get_activities_response(
+          fetch_replies=True, fetch_likes=True, fetch_shares=True,
+          fetch_mentions=True, count=50, etag=source.last_activities_etag,
+          min_id=source.last_activity_id, cache=cache),
+      ))
       etag = resp.get('etag')  # used later
       user_activities = resp.get('items', [])
 
-      # these map ids to AS objects
+      # these map ids to AS objects. links go first so that the user's
+      # activities and responses override them if they overlap.
       responses = {a['id']: a for a in links}
       activities = {a['id']: a for a in links + user_activities}
 
@@ -153,12 +184,17 @@ class Poll(webapp2.RequestHandler):
         source.updates.update({'poll_status': 'error', 'rate_limited': True})
         return
       elif (code and int(code) / 100 == 5) or util.is_connection_failure(e):
-        logging.error('API call failed. Marking as error and finishing. %s: %s\n%s',
+        logging.error('API call failed. Marking as error and backing off. %s: %s\n%s',
                       code, body, e)
-        self.abort(ERROR_HTTP_RETURN_CODE)
+        source.updates.update({'poll_status': 'error',
+                               'poll_failures': source.poll_failures + 1})
+        breaker.failure()
+        return
       else:
         raise
 
+    breaker.success()
+
     # extract silo activity ids, update last_activity_id
     silo_activity_ids = set()
     last_activity_id = source.last_activity_id
@@ -180,14 +216,13 @@ class Poll(webapp2.RequestHandler):
       source.updates['last_activity_id'] = last_activity_id
 
     # trim cache to just the returned activity ids, so that it doesn't grow
-    # without bound. (WARNING: depends on get_activities_response()'s cache key
-    # format, e.g. 'PREFIX ACTIVITY_ID'!)
-    source.updates['last_activities_cache_json'] = json.dumps(
-      {k: v for k, v in cache.items() if k.split()[-1] in silo_activity_ids})
+    # without bound.
+    cache.prune(silo_activity_ids)
+    cache.flush()
 
     # Cache to make sure we only fetch the author's h-feed(s) the
     # first time we see it
-    fetched_hfeeds = set()
+    fetched_hfeeds = original_post_discovery.FetchedHfeeds()
 
     # narrow down to just public activities
     public = {}
@@ -218,6 +253,9 @@ class Poll(webapp2.RequestHandler):
     # prune_activity() and prune_response() in step 4 to remove these before
     # serializing to JSON.
     #
+    # (activity, [string URL]) tuples for user mentions. the URLs are added to
+    # the activity's mentions after original post discovery in step 4.
+    user_mentions = []
     for id, activity in public.items():
       obj = activity.get('object') or activity
 
@@ -227,12 +265,7 @@ class Poll(webapp2.RequestHandler):
         for tag in obj.get('tags', []):
           urls = tag.get('urls')
           if tag.get('objectType') == 'person' and tag.get('id') == user_id and urls:
-            activity['originals'], activity['mentions'] = \
-              original_post_discovery.discover(
-                source, activity, fetch_hfeed=True,
-                include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
-            activity['mentions'].update(u.get('value') for u in urls)
+            user_mentions.append((activity, [u.get('value') for u in urls]))
             responses[id] = activity
             break
 
@@ -241,13 +274,7 @@ class Poll(webapp2.RequestHandler):
         if (att.get('objectType') in ('note', 'article')
                 and att.get('author', {}).get('id') == source.user_tag_id()):
           # now that we've confirmed that one exists, OPD will dig
-          # into the actual attachments
-          if 'originals' not in activity or 'mentions' not in activity:
-            activity['originals'], activity['mentions'] = \
-              original_post_discovery.discover(
-                source, activity, fetch_hfeed=True,
-                include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
+          # into the actual attachments in step 4
           responses[id] = activity
           break
 
@@ -283,20 +310,54 @@ class Poll(webapp2.RequestHandler):
     #
     # Step 3: filter out responses we've already seen
     #
-    # seen responses (JSON objects) for each source are stored in its entity.
-    unchanged_responses = []
-    if source.seen_responses_cache_json:
-      for seen in json.loads(source.seen_responses_cache_json):
-        id = seen['id']
-        resp = responses.get(id)
-        if resp and not source.gr_source.activity_changed(seen, resp, log=True):
-          unchanged_responses.append(seen)
-          del responses[id]
+    # seen responses for each source are stored in its entity as a JSON dict
+    # that maps response id to fingerprint. see util.response_fingerprint().
+    if source.seen_responses_fingerprints_json:
+      seen = json.loads(source.seen_responses_fingerprints_json)
+    elif source.seen_responses_cache_json:  # migrate from full JSON objects
+      seen = {r['id']: util.response_fingerprint(r)
+              for r in json.loads(source.seen_responses_cache_json)}
+    else:
+      seen = {}
+
+    fingerprints = {}
+    for id, resp in responses.items():
+      fingerprints[id] = util.response_fingerprint(resp)
+      if seen.get(id) == fingerprints[id]:
+        del responses[id]
 
     #
-    # Step 4: store new responses and enqueue propagate tasks
+    # Step 4: run original post discovery, store new responses, and enqueue
+    # propagate tasks
     #
-    pruned_responses = []
+    # we'll usually have multiple responses for the same activity, and the
+    # objects in resp['activities'] are shared, so collect each activity that
+    # needs discovery once, run OPD on all of them concurrently, and cache each
+    # activity's discovered webmention targets inside its object.
+    to_discover = []
+    for resp in responses.values():
+      activities = resp.get('activities') or (
+        [resp] if Response.get_type(resp) == 'post' else [])
+      for activity in activities:
+        if (('originals' not in activity or 'mentions' not in activity) and
+            not any(a is activity for a in to_discover)):
+          to_discover.append(activity)
+
+    def discover(activity):
+      activity['originals'], activity['mentions'] = \
+        original_post_discovery.discover(
+          source, activity, fetch_hfeed=True, include_redirect_sources=False,
+          already_fetched_hfeeds=fetched_hfeeds)
+
+    logging.info('Running original post discovery on %d activities',
+                 len(to_discover))
+    util.run_in_threads([lambda a=a: discover(a) for a in to_discover])
+
+    for activity, urls in user_mentions:
+      if 'mentions' in activity:
+        activity['mentions'].update(urls)
+
+    resp_entities = []
     for id, resp in responses.items():
       resp_type = Response.get_type(resp)
       activities = resp.pop('activities', [])
@@ -305,16 +366,6 @@ class Poll(webapp2.RequestHandler):
       too_long = set()
       urls_to_activity = {}
       for i, activity in enumerate(activities):
-        # we'll usually have multiple responses for the same activity, and the
-        # objects in resp['activities'] are shared, so cache each activity's
-        # discovered webmention targets inside its object.
-        if 'originals' not in activity or 'mentions' not in activity:
-          activity['originals'], activity['mentions'] = \
-            original_post_discovery.discover(
-              source, activity, fetch_hfeed=True,
-              include_redirect_sources=False,
-              already_fetched_hfeeds=fetched_hfeeds)
-
         targets = original_post_discovery.targets_for_response(
           resp, originals=activity['originals'], mentions=activity['mentions'])
         if targets:
@@ -332,7 +383,6 @@ class Poll(webapp2.RequestHandler):
       # remove circular references in link responses, which are their own
       # activities. details in the step 2 comment above.
       pruned_response = util.prune_response(resp)
-      pruned_responses.append(pruned_response)
       resp_entity = Response(
         id=id,
         source=source.key,
@@ -345,15 +395,22 @@ class Poll(webapp2.RequestHandler):
         original_posts=resp.get('originals', []))
       if urls_to_activity and len(activities) > 1:
         resp_entity.urls_to_activity=json.dumps(urls_to_activity)
-      resp_entity.get_or_save(source)
+      resp_entities.append(resp_entity)
+
+    # store new and changed responses and enqueue their propagate tasks in bulk
+    Response.get_or_save_multi(resp_entities, source)
 
     # update cache
-    if pruned_responses:
-      source.updates['seen_responses_cache_json'] = json.dumps(
-        pruned_responses + unchanged_responses)
+    if resp_entities:
+      source.updates.update({
+        'seen_responses_fingerprints_json': json.dumps(fingerprints),
+        'seen_responses_cache_json': None,
+      })
 
+    source.update_response_rate(len(resp_entities))
     source.updates.update({'last_polled': source.last_poll_attempt,
-                           'poll_status': 'ok'})
+                           'poll_status': 'ok',
+                           'poll_failures': 0})
     if etag and etag != source.last_activities_etag:
       source.updates['last_activities_etag'] = etag
 
@@ -366,7 +423,8 @@ class Poll(webapp2.RequestHandler):
     # *ever* published a rel=syndication url
     if source.should_refetch():
       logging.info('refetching h-feed for source %s', source.label())
-      relationships = original_post_discovery.refetch(source)
+      relationships = original_post_discovery.refetch(
+        source, force=source.last_hfeed_refetch == models.REFETCH_HFEED_TRIGGER)
 
       now = util.now_fn()
       source.updates['last_hfeed_refetch'] = now
@@ -446,46 +504,131 @@ class SendWebmentions(webapp2.RequestHandler):
 
   # request deadline (10m) plus some padding
   LEASE_LENGTH = datetime.timedelta(minutes=12)
+  # only update Source.last_webmention_sent this often
+  LAST_WEBMENTION_SENT_GRANULARITY = datetime.timedelta(minutes=10)
 
   def source_url(self, target_url):
     """Return the source URL to use for a given target URL.
 
-    Subclasses must implement.
+    Subclasses must implement. May be called concurrently for other targets,
+    so it shouldn't abort() or modify self.entity.
 
     Args:
       target_url: string
 
-    Returns: string
+    Returns: string, or None if we can't determine it right now
     """
     raise NotImplementedError()
 
-  def send_webmentions(self):
+  def send_webmentions(self, batch=None):
     """Tries to send each unsent webmention in self.entity.
 
     Uses source_url() to determine the source parameter for each webmention.
 
     self.lease() *must* be called before this!
+
+    Args:
+      batch: sequence of SendWebmentions, each with its own leased entity, to
+        send together, coalesced by target host. Defaults to [self].
     """
-    logging.info('Starting %s', self.entity.label())
+    batch = batch or [self]
+    for handler, source in zip(
+        batch, ndb.get_multi([h.entity.source for h in batch])):
+      logging.info('Starting %s', handler.entity.label())
+      handler.source = source
 
-    self.source = self.entity.source.get()
     try:
-      self.do_send_webmentions()
+      self.do_send_webmentions(batch)
     except:
       logging.warning('Propagate task failed', exc_info=True)
-      self.release('error')
+      for handler in batch:
+        handler.release('error')
       raise
 
-  def do_send_webmentions(self):
-    urls = self.entity.unsent + self.entity.error + self.entity.failed
+  def do_send_webmentions(self, batch):
+    for handler in batch:
+      handler.check_targets()
+
+    # send to different hosts concurrently, but to each host serially, so that
+    # we don't hammer any single site. all of the batch's webmentions to a host
+    # go out together, in one group.
+    by_host = collections.OrderedDict()
+    for handler in batch:
+      for target in handler.entity.unsent:
+        by_host.setdefault(util.domain_from_link(target), []).append(
+          (handler, target))
+
+    # look up cached endpoints for all targets at once. maps cache key to value.
+    # each host's worker adds the results of its own discoveries.
+    endpoints = {
+      util.webmention_endpoint_cache_key(url): val for url, val in
+      models.WebmentionEndpointCache.get_multi(
+        set(t for pairs in by_host.values() for _, t in pairs)).items()}
+
+    def send_to_host(host, pairs):
+      # only one task at a time sends to each host. if another task has it,
+      # leave its targets unsent and try again later.
+      shard = util.HostShard(host)
+      if not shard.lease():
+        logging.info('Host %s is busy. Deferring %d targets.', host, len(pairs))
+        shard.defer(len(pairs))
+        return [(handler, (t, 'unsent', None, None)) for handler, t in pairs]
+      try:
+        return [(handler, handler.send_webmention(t, endpoints))
+                for handler, t in pairs]
+      finally:
+        shard.release()
+
+    results = util.run_in_threads(
+      [lambda host=host, pairs=pairs: send_to_host(host, pairs)
+       for host, pairs in by_host.items()])
+
+    # merge the results back into each entity in one place, in this thread
+    for handler in batch:
+      handler.entity.unsent = []
+    sent = collections.OrderedDict()  # maps source key to (Source, mentions)
+    errors = collections.defaultdict(dict)  # maps handler to {target: message}
+    for handler, (target, status, mention, message) in itertools.chain(*results):
+      if message:
+        handler.fail(message)
+      if status == 'error':
+        errors[handler][target] = message
+      if status == 'sent':
+        sent.setdefault(handler.source.key, (handler.source, []))[1].append(
+          mention)
+      getattr(handler.entity, status).append(target)
+
+    # update each source once per task, not once per webmention
+    for source, mentions in sent.values():
+      self.record_source_webmentions(source, mentions)
+
+    for handler in batch:
+      handler.finish(errors[handler])
+
+  def check_targets(self):
+    """Rechecks self.entity's targets and moves them into unsent.
+
+    Targets in error stay there until they're due to be retried. See
+    Webmentions.due_retries(). Failed targets that we gave up retrying stay in
+    failed. See Webmentions.gave_up().
+    """
+    due = self.entity.due_retries()
+    waiting = [url for url in self.entity.error if url not in due]
+    if waiting:
+      logging.info('Not retrying %d targets yet: %s', len(waiting),
+                   ' '.join(waiting))
+
+    gave_up = self.entity.gave_up()
+    urls = (self.entity.unsent + due +
+            [url for url in self.entity.failed if url not in gave_up])
     unsent = set()
     self.entity.error = []
-    self.entity.failed = []
+    self.entity.failed = [url for url in self.entity.failed if url in gave_up]
 
-    for orig_url in urls:
-      # recheck the url here since the checks may have failed during the poll
-      # or streaming add.
-      url, domain, ok = util.get_webmention_target(orig_url)
+    # recheck the urls here since the checks may have failed during the poll
+    # or streaming add.
+    for orig_url, (url, domain, ok) in zip(
+        urls, util.get_webmention_targets(urls)):
       if ok:
         if len(url) <= _MAX_STRING_LENGTH:
           unsent.add(url)
@@ -494,70 +637,130 @@ class SendWebmentions(webapp2.RequestHandler):
                           _MAX_STRING_LENGTH, url)
           self.entity.failed.append(orig_url)
     self.entity.unsent = sorted(unsent)
+    self.entity.error = [target for target in waiting if target not in unsent]
 
-    while self.entity.unsent:
-      target = self.entity.unsent.pop(0)
-      source_url = self.source_url(target)
-      logging.info('Webmention from %s to %s', source_url, target)
-
-      # see if we've cached webmention discovery for this domain. the cache
-      # value is a string URL endpoint if discovery succeeded, a
-      # WebmentionSend error dict if it failed (semi-)permanently, or None.
-      cache_key = util.webmention_endpoint_cache_key(target)
-      cached = memcache.get(cache_key)
-      if cached:
-        logging.info('Using cached webmention endpoint %r: %s', cache_key, cached)
-
-      # send! and handle response or error
-      error = None
-      if isinstance(cached, dict):
-        error = cached
-      else:
-        mention = send.WebmentionSend(source_url, target, endpoint=cached)
-        logging.info('Sending...')
-        try:
-          if not mention.send(timeout=999, headers=util.USER_AGENT_HEADER):
-            error = mention.error
-        except BaseException, e:
-          logging.warning('', exc_info=True)
-          error = getattr(mention, 'error')
-          if not error:
-            error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
-                     if 'DNS lookup failed for URL:' in str(e)
-                     else {'code': 'EXCEPTION'})
-
-      error_code = error['code'] if error else None
-      if error_code != 'BAD_TARGET_URL' and not cached:
-        val = error if error_code == 'NO_ENDPOINT' else mention.receiver_endpoint
-        memcache.set(cache_key, val, time=WEBMENTION_DISCOVERY_CACHE_TIME)
-
-      if error is None:
-        logging.info('Sent! %s', mention.response)
-        self.record_source_webmention(mention)
-        self.entity.sent.append(target)
-      else:
-        status = error.get('http_status', 0)
-        if (error_code == 'NO_ENDPOINT' or
-            (error_code == 'BAD_TARGET_URL' and status == 204)):  # No Content
-          logging.info('Giving up this target. %s', error)
-          self.entity.skipped.append(target)
-        elif status // 100 == 4:
-          # Give up on 4XX errors; we don't expect later retries to succeed.
-          logging.info('Giving up this target. %s', error)
-          self.entity.failed.append(target)
-        else:
-          self.fail('Error sending to endpoint: %s' % error)
-          self.entity.error.append(target)
-
-      if target in self.entity.unsent:
-        self.entity.unsent.remove(target)
+  def finish(self, errors):
+    """Releases or completes self.entity after its webmentions are sent.
 
+    Args:
+      errors: dict mapping target URL to error message for the targets that
+        failed in this attempt
+    """
+    self.entity.update_retries(errors)
     if self.entity.error:
-      logging.warning('Propagate task failed')
+      logging.warning('Propagate task failed for %s', self.entity.label())
       self.release('error')
+      if not errors:
+        # nothing failed this time, so the queue won't retry this task. add a
+        # new one for when the first remaining target is due.
+        delay = self.entity.next_retry_delay() or 0
+        logging.info('Retrying %d targets in %ds', len(self.entity.error), delay)
+        self.add_task(countdown=delay)
+    elif self.entity.unsent:
+      self.release('new')
+      self.add_task(
+        countdown=util.HOST_SHARD_RETRY_DELAY * random.uniform(1, 2))
     else:
       self.complete()
 
+  def add_task(self, **kwargs):
+    """Adds a new task to retry self.entity.
+
+    Subclasses must implement.
+
+    Args:
+      kwargs: passed through to taskqueue.add()
+    """
+    raise NotImplementedError()
+
+  def send_webmention(self, target, endpoints):
+    """Sends a single webmention. May be called concurrently for other targets.
+
+    Doesn't modify self.entity or self.source; do_send_webmentions() merges the
+    results.
+
+    Args:
+      target: string URL
+      endpoints: dict mapping webmention endpoint cache key to cached endpoint
+        or error. Updated with the result of discovery, if any.
+
+    Returns: (string target, string status, WebmentionSend or None, string
+      error message for fail() or None) tuple. status is the name of the
+      Webmentions property to add target to: sent, skipped, failed, or error.
+    """
+    source_url = self.source_url(target)
+    if not source_url:
+      return (target, 'error', None,
+              "Couldn't determine source URL for %s. Will retry." % target)
+    logging.info('Webmention from %s to %s', source_url, target)
+
+    # see if we've cached webmention discovery for this domain. the cache
+    # value is a string URL endpoint if discovery succeeded, a
+    # WebmentionSend error dict if it failed, or None.
+    cache_key = util.webmention_endpoint_cache_key(target)
+    cached = endpoints.get(cache_key)
+    if cached:
+      logging.info('Using cached webmention endpoint %r: %s', cache_key, cached)
+
+    # send! and handle response or error. skip hosts that are failing
+    # repeatedly; the task will retry them later.
+    breaker = util.CircuitBreaker('webmention ' + util.domain_from_link(target))
+    mention = None
+    error = None
+    if isinstance(cached, dict):
+      error = cached
+    elif not breaker.allow():
+      return (target, 'error', None,
+              'Circuit breaker %s is open. Will retry.' % breaker.name)
+    else:
+      mention = util.WebmentionSend(source_url, target, endpoint=cached)
+      logging.info('Sending...')
+      try:
+        if not mention.send(timeout=999, headers=util.USER_AGENT_HEADER):
+          error = mention.error
+      except BaseException, e:
+        logging.warning('', exc_info=True)
+        error = getattr(mention, 'error')
+        if not error:
+          error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
+                   if 'DNS lookup failed for URL:' in str(e)
+                   else {'code': 'EXCEPTION'})
+
+    error_code = error['code'] if error else None
+    if error_code != 'BAD_TARGET_URL' and not cached:
+      val = mention.receiver_endpoint or error
+      if val and models.WebmentionEndpointCache.set(target, val):
+        endpoints[cache_key] = val
+
+    if error is None:
+      logging.info('Sent! %s', mention.response)
+      breaker.success()
+      return target, 'sent', mention, None
+
+    status = error.get('http_status', 0)
+    if (error_code == 'NO_ENDPOINT' or
+        (error_code == 'BAD_TARGET_URL' and status == 204)):  # No Content
+      logging.info('Giving up this target. %s', error)
+      breaker.success()
+      return target, 'skipped', mention, None
+    elif status // 100 == 4:
+      # Give up on 4XX errors; we don't expect later retries to succeed.
+      logging.info('Giving up this target. %s', error)
+      if error_code == 'RECEIVER_ERROR' and isinstance(cached, basestring):
+        # the endpoint may have moved, so rediscover it next time
+        models.WebmentionEndpointCache.delete_multi([target])
+        endpoints.pop(cache_key, None)
+      breaker.success()
+      return target, 'failed', mention, None
+    else:
+      if not isinstance(cached, dict):  # don't count cached errors again
+        breaker.failure()
+      if (isinstance(cached, basestring) and
+          models.WebmentionEndpointCache.record_failure(target)):
+        endpoints.pop(cache_key, None)
+      return (target, 'error', mention,
+              'Error sending to endpoint: %s' % error)
+
   @ndb.transactional
   def lease(self, key):
     """Attempts to acquire and lease the Webmentions entity.
@@ -633,25 +836,46 @@ class SendWebmentions(webapp2.RequestHandler):
     logging.log(level, message)
     self.response.out.write(message)
 
-  @ndb.transactional
-  def record_source_webmention(self, mention):
-    """Sets this source's last_webmention_sent and maybe webmention_endpoint.
+  def record_source_webmentions(self, source, mentions):
+    """Sets a source's last_webmention_sent and maybe webmention_endpoint.
+
+    Skips the write if last_webmention_sent is already within
+    LAST_WEBMENTION_SENT_GRANULARITY and webmention_endpoint wouldn't change,
+    since busy sources would otherwise see lots of contention.
 
     Args:
-      mention: webmentiontools.send.WebmentionSend
+      source: Source
+      mentions: sequence of util.WebmentionSend that succeeded
     """
-    self.source = self.source.key.get()
-    logging.info('Setting last_webmention_sent')
-    self.source.last_webmention_sent = util.now_fn()
+    def new_endpoint(source):
+      for mention in mentions:
+        if (mention.receiver_endpoint != source.webmention_endpoint and
+            util.domain_from_link(mention.target_url) in source.domains):
+          return mention
+
+    now = util.now_fn()
+    if (source.last_webmention_sent and
+        now - source.last_webmention_sent < self.LAST_WEBMENTION_SENT_GRANULARITY
+        and not new_endpoint(source)):
+      logging.info('last_webmention_sent was recently set; not updating')
+      return
+
+    @ndb.transactional
+    def update(key):
+      source = key.get()
+      logging.info('Setting last_webmention_sent')
+      source.last_webmention_sent = now
 
-    if (mention.receiver_endpoint != self.source.webmention_endpoint and
-        util.domain_from_link(mention.target_url) in self.source.domains):
-      logging.info('Also setting webmention_endpoint to %s (discovered in %s; was %s)',
-                   mention.receiver_endpoint, mention.target_url,
-                   self.source.webmention_endpoint)
-      self.source.webmention_endpoint = mention.receiver_endpoint
+      mention = new_endpoint(source)
+      if mention:
+        logging.info('Also setting webmention_endpoint to %s (discovered in %s; was %s)',
+                     mention.receiver_endpoint, mention.target_url,
+                     source.webmention_endpoint)
+        source.webmention_endpoint = mention.receiver_endpoint
 
-    self.source.put()
+      source.put()
+
+    update(source.key)
 
 
 class PropagateResponse(SendWebmentions):
@@ -661,18 +885,31 @@ class PropagateResponse(SendWebmentions):
     activities: parsed Response.activities_json list
 
   Request parameters:
-    response_key: string key of Response entity
+    response_key: string key of Response entity. May be repeated.
   """
 
   def post(self):
     logging.debug('Params: %s', self.request.params)
-    if not self.lease(ndb.Key(urlsafe=self.request.params['response_key'])):
-      return
 
+    # polls batch responses that send to the same hosts into the same task.
+    # see util.add_propagate_tasks(). each gets its own copy of this handler,
+    # with its own entity and lease.
+    batch = []
+    for key in self.request.params.getall('response_key'):
+      handler = copy.copy(self)
+      if handler.lease(ndb.Key(urlsafe=key)) and handler.check_response():
+        batch.append(handler)
+
+    if batch:
+      self.send_webmentions(batch)
+
+  def check_response(self):
+    """Returns True if self.entity should be propagated, False otherwise.
+    """
     source = self.entity.source.get()
     if not source:
       logging.warning('Source not found! Dropping response.')
-      return
+      return False
     logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
                  source.bridgy_url(self))
     logging.info('Created by this poll: %s/log?start_time=%s&key=%s',
@@ -686,9 +923,12 @@ class PropagateResponse(SendWebmentions):
         not all(source.is_activity_public(a) for a in self.activities)):
       logging.info('Response or activity is non-public. Dropping.')
       self.complete()
-      return
+      return False
+
+    return True
 
-    self.send_webmentions()
+  def add_task(self, **kwargs):
+    util.add_propagate_task(self.entity, **kwargs)
 
   def source_url(self, target_url):
     # parse the response id. (we know Response key ids are always tag URIs)
@@ -708,7 +948,7 @@ class PropagateResponse(SendWebmentions):
 Hit https://github.com/snarfed/bridgy/issues/237 KeyError!
 target url %s not in urls_to_activity: %s
 activities: %s""", target_url, urls_to_activity, self.activities)
-          self.abort(ERROR_HTTP_RETURN_CODE)
+          return None
 
     # generate source URL
     id = activity['id']
@@ -743,8 +983,7 @@ class PropagateBlogPost(SendWebmentions):
     if self.lease(ndb.Key(urlsafe=self.request.params['key'])):
       source_domains = self.entity.source.get().domains
       to_send = set()
-      for url in self.entity.unsent:
-        url, domain, ok = util.get_webmention_target(url)
+      for url, domain, ok in util.get_webmention_targets(self.entity.unsent):
         # skip "self" links to this blog's domain
         if ok and domain not in source_domains:
           to_send.add(url)
@@ -752,6 +991,9 @@ class PropagateBlogPost(SendWebmentions):
       self.entity.unsent = list(to_send)
       self.send_webmentions()
 
+  def add_task(self, **kwargs):
+    util.add_propagate_blogpost_task(self.entity, **kwargs)
+
   def source_url(self, target_url):
     return self.entity.key.id()
 
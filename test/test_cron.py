@@ -6,18 +6,23 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 import copy
 import datetime
 import json
+import urllib
 
+from granary import twitter as gr_twitter
 from granary.test import test_flickr
 from granary.test import test_instagram
 import oauth_dropins
 from oauth_dropins import indieauth
 from oauth_dropins import flickr as oauth_flickr
+from oauth_dropins import twitter as oauth_twitter
 
 import cron
 from flickr import Flickr
 from instagram import Instagram
+from twitter import Twitter
 import testutil
 from testutil import FakeSource, HandlerTest
+import util
 
 
 class CronTest(HandlerTest):
@@ -47,30 +52,111 @@ class CronTest(HandlerTest):
       'features': ['listen'],
       'last_webmention_sent': day_and_half_ago,
       }
+
+    def new(**kwargs):
+      source = FakeSource.new(None, **kwargs)
+      source.next_poll_due = source.calculate_next_poll_due()
+      return source.put()
+
     sources = [
       # doesn't need a new poll task
-      FakeSource.new(None, last_poll_attempt=now, **defaults).put(),
-      FakeSource.new(None, last_poll_attempt=five_min_ago, **defaults).put(),
-      FakeSource.new(None, status='disabled', **defaults).put(),
-      FakeSource.new(None, status='disabled', **defaults).put(),
+      new(last_poll_attempt=now, **defaults),
+      new(last_poll_attempt=five_min_ago, **defaults),
+      new(status='disabled', **defaults),
+      new(status='disabled', **defaults),
       # need a new poll task
-      FakeSource.new(None, status='enabled', **defaults).put(),
+      new(status='enabled', **defaults),
       # not signed up for listen
-      FakeSource.new(None, last_webmention_sent=day_and_half_ago).put(),
+      new(last_webmention_sent=day_and_half_ago),
       # never sent a webmention, past grace period. last polled is older than 2x
       # fast poll, but within 2x slow poll.
-      FakeSource.new(None, features=['listen'], created=month_ago,
-                     last_poll_attempt=day_and_half_ago).put(),
+      new(features=['listen'], created=month_ago,
+          last_poll_attempt=day_and_half_ago),
+      # failing and backing off. last polled is older than 2x fast poll, but
+      # within 2x its backoff.
+      new(last_poll_attempt=day_and_half_ago, poll_failures=10, **defaults),
       ]
+
+    # the cron job fans out to one task per silo
     resp = cron.application.get_response('/cron/replace_poll_tasks')
     self.assertEqual(200, resp.status_int)
+    tasks = self.taskqueue_stub.GetTasks('default')
+    self.assertIn({'source_type': 'fake'},
+                  [testutil.get_task_params(t) for t in tasks])
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll'))
+
+    resp = cron.application.get_response('/cron/replace_poll_tasks',
+                                         method='POST', body='source_type=fake')
+    self.assertEqual(200, resp.status_int)
 
     tasks = self.taskqueue_stub.GetTasks('poll')
     self.assertEqual(1, len(tasks))
     self.assert_equals(sources[4].urlsafe(),
                        testutil.get_task_params(tasks[0])['source_key'])
 
+  def test_replace_poll_tasks_pages(self):
+    self.mox.stubs.Set(cron.ReplacePollTasks, 'PAGE_SIZE', 1)
+    sources = [FakeSource.new(None, features=['listen']).put() for i in 1, 2]
+
+    resp = cron.application.get_response('/cron/replace_poll_tasks',
+                                         method='POST', body='source_type=fake')
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('poll')))
+
+    tasks = self.taskqueue_stub.GetTasks('default')
+    self.assertEqual(1, len(tasks))
+    params = testutil.get_task_params(tasks[0])
+    self.assertEqual('fake', params['source_type'])
+    self.assertTrue(params['cursor'])
+
+    resp = cron.application.get_response(
+      '/cron/replace_poll_tasks', method='POST',
+      body=urllib.urlencode(params))
+    self.assertEqual(200, resp.status_int)
+    self.assertItemsEqual(
+      [s.urlsafe() for s in sources],
+      [testutil.get_task_params(t)['source_key']
+       for t in self.taskqueue_stub.GetTasks('poll')])
+
+  def test_backfill_next_poll_due(self):
+    self.mox.stubs.Set(cron.BackfillNextPollDue, 'PAGE_SIZE', 1)
+    old = datetime.datetime.now() - datetime.timedelta(days=3)
+    keys = [FakeSource.new(None, features=['listen'],
+                           last_poll_attempt=old).put() for i in 1, 2]
+    already = FakeSource.new(None, features=['listen'])
+    already.next_poll_due = datetime.datetime(2099, 1, 1)
+    already.put()
+
+    # the cron job fans out to one task per silo
+    resp = cron.application.get_response('/cron/backfill_next_poll_due')
+    self.assertEqual(200, resp.status_int)
+    self.assertIn('fake', [testutil.get_task_params(t)['source_type']
+                           for t in self.taskqueue_stub.GetTasks('default')])
+
+    # one source per page
+    params = {'source_type': 'fake'}
+    for _ in range(5):
+      self.taskqueue_stub.FlushQueue('default')
+      resp = cron.application.get_response(
+        '/cron/backfill_next_poll_due', method='POST',
+        body=urllib.urlencode(params))
+      self.assertEqual(200, resp.status_int)
+      tasks = self.taskqueue_stub.GetTasks('default')
+      if not tasks:
+        break
+      params = testutil.get_task_params(tasks[0])
+
+    for key in keys:
+      source = key.get()
+      self.assertEqual(source.calculate_next_poll_due(), source.next_poll_due)
+    self.assertEqual(datetime.datetime(2099, 1, 1),
+                     already.key.get().next_poll_due)
+
   def test_update_instagram_pictures(self):
+    # one source per page
+    self.mox.stubs.Set(cron.UpdatePictures, 'PAGE_SIZE', 1)
+    util.CachedPage.store('/users', 'foo')
+
     for username in 'a', 'b':
       profile = copy.deepcopy(test_instagram.HTML_PROFILE)
       profile['entry_data']['ProfilePage'][0]['user'].update({
@@ -103,6 +189,7 @@ class CronTest(HandlerTest):
     self.assertEquals('http://new/pic', sources[1].get().picture)
     self.assertEquals('http://old/pic', sources[2].get().picture)
     self.assertEquals('http://old/pic', sources[3].get().picture)
+    self.assertIsNone(util.CachedPage.load('/users'))
 
   def test_update_instagram_picture_profile_404s(self):
     auth_entity = indieauth.IndieAuth(id='http://foo.com/', user_json='{}')
@@ -139,3 +226,36 @@ class CronTest(HandlerTest):
     self.assertEquals(
       'https://farm9.staticflickr.com/9876/buddyicons/123@N00.jpg',
       self.flickr.key.get().picture)
+
+  def test_update_twitter_pictures(self):
+    oauth_dropins.appengine_config.TWITTER_APP_KEY = 'my_app_key'
+    oauth_dropins.appengine_config.TWITTER_APP_SECRET = 'my_app_secret'
+    util.CachedPage.store('/users', 'foo')
+
+    sources = []
+    for username in 'a', 'b', 'c':
+      auth_entity = oauth_twitter.TwitterAuth(
+        id=username, token_key='my_key', token_secret='my_secret',
+        user_json=json.dumps({'screen_name': username}))
+      auth_entity.put()
+      source = Twitter.new(None, auth_entity=auth_entity, features=['listen'])
+      source.picture = 'http://old/pic'
+      sources.append(source.put())
+
+    # one lookup for the whole page. c isn't in the response, so it's unchanged.
+    users = [{'screen_name': 'A', 'profile_image_url_https': 'http://new/a'},
+             {'screen_name': 'b', 'profile_image_url_https': 'http://new/b'}]
+    self.expect_urlopen(
+      'https://api.twitter.com/1.1/users/lookup.json?screen_name=a,b,c',
+      json.dumps(users))
+    self.mox.ReplayAll()
+
+    resp = cron.application.get_response('/cron/update_twitter_pictures')
+    self.assertEqual(200, resp.status_int)
+
+    gr = gr_twitter.Twitter('my_key', 'my_secret')
+    for source, user in zip(sources, users):
+      self.assertEquals(gr.user_to_actor(user)['image']['url'],
+                        source.get().picture)
+    self.assertEquals('http://old/pic', sources[2].get().picture)
+    self.assertIsNone(util.CachedPage.load('/users'))
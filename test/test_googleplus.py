@@ -8,6 +8,7 @@ import json
 import appengine_config
 from apiclient import discovery
 from apiclient import http
+from granary import googleplus as gr_googleplus
 from granary.test import test_googleplus as gr_test_googleplus
 from oauth_dropins import googleplus as oauth_googleplus
 
@@ -49,6 +50,18 @@ class GooglePlusTest(testutil.ModelsTest):
     self.gp.rate_limited = True
     self.assertEqual(GooglePlusPage.RATE_LIMITED_POLL, self.gp.poll_period())
 
+  def test_count_api_calls(self):
+    class FakeHttp(object):
+      def request(self, *args, **kwargs):
+        return 'resp'
+    self.auth_entity.http = FakeHttp
+
+    gr = gr_googleplus.GooglePlus(auth_entity=self.auth_entity)
+    self.gp.count_api_calls(gr)
+    for _ in range(2):
+      self.assertEqual('resp', gr.auth_entity.http().request('http://x'))
+    self.assertEqual(2, self.gp.api_calls)
+
   def test_search_for_links(self):
     # should only search for urls without paths
     for urls in [], [], ['http://a/b'], ['https://c/d/e', 'https://f.com/g']:
@@ -181,6 +181,17 @@ asdf http://other/link qwert
     self.assertEqual(503, resp.status_int)
     self.assertEqual('FakeSource error:\nTry again pls', resp.body)
 
+  def test_out_of_api_tokens_429(self):
+    self.mox.stubs.Set(testutil.FakeSource, 'API_TOKEN_BUCKET', (1, .01))
+    self.assertEqual(0, self.source.api_token_wait())
+    self.mox.StubOutWithMock(testutil.FakeSource, 'get_activities')
+    self.mox.ReplayAll()
+
+    resp = handlers.application.get_response(
+      '/post/fake/%s/000' % self.source.key.string_id())
+    self.assertEqual(429, resp.status_int)
+    self.assertEqual('100', resp.headers['Retry-After'])
+
   def test_comment(self):
     FakeGrSource.comment = {
       'id': 'tag:fa.ke,2013:a1-b2.c3',  # test alphanumeric id (like G+)
@@ -7,7 +7,10 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 import datetime
 import json
 import re
+import time
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from granary import source as gr_source
 import mox
 
@@ -17,7 +20,8 @@ import flickr
 import googleplus
 import instagram
 import models
-from models import BlogPost, Response, Source, SyndicatedPost
+from models import (ActivitiesCache, BlogPost, Response, Source, SyndicatedPost,
+                    WebmentionEndpointCache)
 import superfeedr
 import testutil
 from testutil import FakeGrSource, FakeSource
@@ -130,6 +134,136 @@ class ResponseTest(testutil.ModelsTest):
     self.assertEqual('complete', saved.status)
     self.assert_no_propagate_task()
 
+  def test_get_or_save_multi(self):
+    # responses[0] is new, [1] is stored and unchanged, [2] is stored, complete,
+    # and has changed since.
+    self.responses[1].put()
+    stored = self.responses[2]
+    stored.unsent = []
+    stored.sent = ['http://sent']
+    stored.status = 'complete'
+    stored.put()
+    old_resp_json = stored.response_json
+
+    changed = Response(id=stored.key.id(), **stored.to_dict())
+    new_resp_json = json.loads(old_resp_json)
+    new_resp_json['content'] = 'new content'
+    changed.response_json = json.dumps(new_resp_json)
+
+    saved = Response.get_or_save_multi(
+      [self.responses[0], self.responses[1], changed], self.sources[0])
+    self.assertEqual([r.key for r in self.responses], [r.key for r in saved])
+
+    self.assertEqual('new', saved[0].status)
+    self.assert_entities_equal(self.responses[1], saved[1])
+    self.assertEqual('new', saved[2].status)
+    self.assertEqual(['http://sent'], saved[2].unsent)
+    self.assertEqual([], saved[2].sent)
+    self.assertEqual([old_resp_json], saved[2].old_response_jsons)
+    self.assertEqual(json.dumps(new_resp_json), saved[2].response_json)
+    self.assert_entities_equal(saved, [r.key.get() for r in self.responses],
+                               ignore=('created', 'updated'))
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertItemsEqual(
+      [self.responses[0].key.urlsafe(), self.responses[2].key.urlsafe()],
+      [testutil.get_task_params(t)['response_key'] for t in tasks])
+
+  def _store_complete_and_change(self):
+    """Stores responses[0] as complete, returns a changed copy of it."""
+    stored = self.responses[0]
+    stored.unsent = []
+    stored.sent = ['http://sent']
+    stored.status = 'complete'
+    stored.put()
+
+    changed = Response(id=stored.key.id(), **stored.to_dict())
+    resp_json = json.loads(stored.response_json)
+    resp_json['content'] = 'new content'
+    changed.response_json = json.dumps(resp_json)
+    return changed
+
+  def test_get_or_save_multi_puts_before_enqueueing(self):
+    changed = self._store_complete_and_change()
+
+    # when the task is enqueued, it should already see the re-propagation
+    def check_stored(entities):
+      stored = changed.key.get()
+      self.assertEqual('new', stored.status)
+      self.assertEqual(['http://sent'], stored.unsent)
+    self.mox.StubOutWithMock(util, 'add_propagate_tasks')
+    util.add_propagate_tasks(mox.IgnoreArg()).WithSideEffects(check_stored)
+    self.mox.ReplayAll()
+
+    Response.get_or_save_multi([changed], self.sources[0])
+
+  def test_get_or_save_multi_enqueue_fails(self):
+    changed = self._store_complete_and_change()
+    self.mox.StubOutWithMock(util, 'add_propagate_tasks')
+    util.add_propagate_tasks(mox.IgnoreArg()).AndRaise(
+      taskqueue.TransientError())
+    self.mox.ReplayAll()
+
+    with self.assertRaises(taskqueue.TransientError):
+      Response.get_or_save_multi([changed, self.responses[1]], self.sources[0])
+
+    # the put should be undone, so that the poll's retry re-propagates both
+    stored = changed.key.get()
+    self.assertEqual('complete', stored.status)
+    self.assertEqual(['http://sent'], stored.sent)
+    self.assertIsNone(self.responses[1].key.get())
+
+  def test_get_or_save_multi_empty_unsent_no_task(self):
+    self.responses[0].unsent = []
+    saved = Response.get_or_save_multi([self.responses[0]], self.sources[0])
+    self.assertEqual('complete', saved[0].status)
+    self.assertEqual('complete', self.responses[0].key.get().status)
+    self.assert_no_propagate_task()
+
+  def test_retries(self):
+    resp = self.responses[0]
+    resp.error = ['http://a', 'http://b']
+    self.assertEqual(['http://a', 'http://b'], resp.due_retries())
+    self.assertIsNone(resp.next_retry_delay())
+
+    now = resp._now()
+    resp.update_retries({'http://a': 'foo'})
+    self.assertEqual(['http://b'], resp.due_retries())
+    self.assertEqual(30, resp.next_retry_delay())
+
+    # backs off exponentially, and drops targets that are no longer in error
+    resp.update_retries({'http://a': 'bar', 'http://b': 'baz'})
+    resp.error = ['http://a']
+    self.assertEqual({'http://a': {'attempts': 2, 'next': now + 60,
+                                   'error': 'bar'}},
+                     resp.retries())
+    resp.update_retries({})
+    self.assertEqual(['http://a'], json.loads(resp.retries_json).keys())
+
+    resp.error = []
+    resp.update_retries({})
+    self.assertIsNone(resp.retries_json)
+
+  def test_retries_max_attempts(self):
+    resp = self.responses[0]
+    resp.error = ['http://a', 'http://b']
+    for i in range(Response.RETRY_MAX_ATTEMPTS - 1):
+      resp.update_retries({'http://a': 'foo'})
+    self.assertEqual(['http://a', 'http://b'], resp.error)
+    self.assertEqual(Response.RETRY_MAX_ATTEMPTS - 1,
+                     resp.retries()['http://a']['attempts'])
+
+    # gives up and moves it to failed
+    resp.update_retries({'http://a': 'foo'})
+    self.assertEqual(['http://b'], resp.error)
+    self.assertEqual(['http://a'], resp.failed)
+    self.assertEqual({}, resp.retries())
+    self.assertEqual(set(['http://a']), resp.gave_up())
+
+    # and remembers that across updates
+    resp.update_retries({})
+    self.assertEqual(set(['http://a']), resp.gave_up())
+
   def test_get_type(self):
     self.assertEqual('repost', Response.get_type(
         {'objectType': 'activity', 'verb': 'share'}))
@@ -406,6 +540,27 @@ class SourceTest(testutil.HandlerTest):
     source.verify()
     self.assertEquals('http://web.ment/ion', source.webmention_endpoint)
 
+  def test_verify_uses_cached_endpoint(self):
+    WebmentionEndpointCache.set('http://primary/post', 'http://web.ment/ion')
+
+    source = FakeSource.new(self.handler, features=['webmention'],
+                            domain_urls=['http://primary/'], domains=['primary'])
+    source.verify()
+    self.assertEquals('http://web.ment/ion', source.webmention_endpoint)
+
+  def test_verify_caches_endpoint(self):
+    self.expect_webmention_requests_get('http://primary/', """
+<html><meta>
+<link rel="webmention" href="http://web.ment/ion">
+</meta></html>""", verify=False)
+    self.mox.ReplayAll()
+
+    source = FakeSource.new(self.handler, features=['webmention'],
+                            domain_urls=['http://primary/'], domains=['primary'])
+    source.verify()
+    self.assertEquals('http://web.ment/ion',
+                      WebmentionEndpointCache.get('http://primary/post'))
+
   def test_verify_without_webmention_endpoint(self):
     self.expect_webmention_requests_get(
       'http://primary/', 'no webmention endpoint here!', verify=False)
@@ -440,6 +595,28 @@ class SourceTest(testutil.HandlerTest):
     finally:
       del FakeSource._pre_put_hook
 
+  def test_put_updates_next_poll_due(self):
+    source = FakeSource.new(None, features=['listen'])
+    source.put()
+    self.assertEquals(util.EPOCH, source.next_poll_due)
+
+    source.updates = {'last_poll_attempt': testutil.NOW}
+    source = Source.put_updates(source)
+    # new sources are in the fast poll grace period
+    self.assertEquals(testutil.NOW + datetime.timedelta(hours=2),
+                      source.key.get().next_poll_due)
+
+    source.updates = {'poll_failures': 10}
+    source = Source.put_updates(source)
+    self.assertEquals(testutil.NOW + source.MAX_POLL_BACKOFF * 2,
+                      source.key.get().next_poll_due)
+
+    # explicit values aren't recalculated
+    due = testutil.NOW + datetime.timedelta(minutes=5)
+    source.updates = {'next_poll_due': due}
+    source = Source.put_updates(source)
+    self.assertEquals(due, source.key.get().next_poll_due)
+
   def test_should_refetch(self):
     source = FakeSource.new(None)  # haven't found a synd url yet
     self.assertFalse(source.should_refetch())
@@ -463,6 +640,108 @@ class SourceTest(testutil.HandlerTest):
     source.last_hfeed_refetch -= (Source.SLOW_REFETCH + hour)
     self.assertTrue(source.should_refetch())
 
+  def test_update_response_rate(self):
+    source = FakeSource.new(None)
+    source.updates = {}
+    source.last_poll_attempt = testutil.NOW
+    source.update_response_rate(5)  # first poll
+    self.assertEqual({}, source.updates)
+
+    source.last_polled = testutil.NOW - datetime.timedelta(hours=2)
+    source.update_response_rate(5)
+    self.assertEqual(2.5, source.updates['response_rate'])
+    self.assertEqual([2.5] * 24, source.updates['hourly_response_rates'])
+    self.assertEqual(1, source.updates['response_rate_samples'])
+
+    source.populate(**source.updates)
+    source.update_response_rate(0)
+    self.assertEqual(2.0, source.updates['response_rate'])
+    expected = [2.5] * 24
+    expected[testutil.NOW.hour] = 2.0
+    self.assertEqual(expected, source.updates['hourly_response_rates'])
+    self.assertEqual(2, source.updates['response_rate_samples'])
+
+  def test_response_rate_same_hour_for_reads_and_writes(self):
+    """update_response_rate() and poll_period() should use the same hour."""
+    now = datetime.datetime(2016, 1, 1, 5)
+    util.now_fn = lambda: now
+
+    source = FakeSource.new(None)
+    source.created = now - datetime.timedelta(days=30)
+    source.updates = {}
+    source.hourly_response_rates = [1.0] * 24
+    source.response_rate = 1.0
+    source.response_rate_samples = Source.MIN_RESPONSE_RATE_SAMPLES
+    # the poll attempt started in the previous hour
+    source.last_poll_attempt = now - datetime.timedelta(minutes=10)
+    source.last_polled = source.last_poll_attempt - datetime.timedelta(hours=1)
+    source.update_response_rate(0)
+
+    hourly = source.updates['hourly_response_rates']
+    self.assertLess(hourly[5], 1.0)
+    self.assertEqual([1.0] * 23, hourly[:5] + hourly[6:])
+
+    source.hourly_response_rates = [1.0] * 24
+    source.hourly_response_rates[5] = 0.0
+    source.response_rate = 0.5
+    # rate = (0.5 + 0.0) / 2 = 0.25
+    self.assertEqual(datetime.timedelta(hours=4), source.poll_period())
+
+  def test_poll_period_adaptive(self):
+    source = FakeSource.new(None)
+    source.created = testutil.NOW - datetime.timedelta(days=30)
+    self.assertEqual(Source.SLOW_POLL, source.poll_period())
+
+    # not enough samples yet
+    source.response_rate = 4.0
+    source.response_rate_samples = Source.MIN_RESPONSE_RATE_SAMPLES - 1
+    self.assertEqual(Source.SLOW_POLL, source.poll_period())
+
+    source.response_rate_samples = Source.MIN_RESPONSE_RATE_SAMPLES
+    self.assertEqual(datetime.timedelta(minutes=15), source.poll_period())
+
+    source.response_rate = 0.5
+    self.assertEqual(datetime.timedelta(hours=2), source.poll_period())
+
+    # time of day profile
+    source.hourly_response_rates = [0.0] * 24
+    self.assertEqual(datetime.timedelta(hours=4), source.poll_period())
+
+    # bounds
+    source.response_rate = 100.0
+    self.assertEqual(Source.MIN_ADAPTIVE_POLL, source.poll_period())
+    source.response_rate = 0.0
+    self.assertEqual(Source.SLOW_POLL, source.poll_period())
+
+    source.created = testutil.NOW  # grace period
+    self.assertEqual(Source.FAST_POLL, source.poll_period())
+
+  def test_charge_api_calls(self):
+    self.mox.stubs.Set(FakeSource, 'API_TOKEN_BUCKET', (5, .001))
+    class UrlopenGrSource(FakeGrSource):
+      def urlopen(self, url):
+        return url
+    self.mox.stubs.Set(FakeSource, 'GR_CLASS', UrlopenGrSource)
+    source = self.sources[0]
+    self.assertEqual(0, source.api_token_wait())
+    for url in 'a', 'b', 'c':
+      self.assertEqual(url, source.gr_source.urlopen(url))
+    self.assertEqual(3, source.api_calls)
+
+    # the first call was already charged by api_token_wait()
+    source.charge_api_calls()
+    tokens, _ = memcache.get('TB fake')
+    self.assertAlmostEqual(2, tokens, delta=.1)
+
+  def test_charge_api_calls_debt(self):
+    self.mox.stubs.Set(FakeSource, 'API_TOKEN_BUCKET', (2, .001))
+    source = self.sources[0]
+    source.api_calls = 10
+    source.charge_api_calls()
+    tokens, _ = memcache.get('TB fake')
+    self.assertEqual(-2, tokens)
+    self.assertAlmostEqual(4000, source.api_token_wait(), delta=10)
+
   def test_is_beta_user(self):
     source = FakeSource.new(self.handler)
     self.assertFalse(source.is_beta_user())
@@ -617,3 +896,150 @@ class SyndicatedPostTest(testutil.ModelsTest):
     ).fetch()
 
     self.assertEqual(1, len(rs))
+
+
+class ActivitiesCacheTest(testutil.ModelsTest):
+
+  def setUp(self):
+    super(ActivitiesCacheTest, self).setUp()
+    self.cache = ActivitiesCache(self.sources[0])
+
+  def test_tiers(self):
+    self.cache.set_multi({'AGC 1': 3, 'AGL 1': 4})
+    self.cache.flush()
+    self.assertEqual({'AGC 1': 3, 'AGL 1': 4},
+                     self.cache.get_multi(['AGC 1', 'AGL 1', 'AGS 1']))
+
+    # memcache
+    ActivitiesCache.clear_lru()
+    self.assertEqual(3, ActivitiesCache(self.sources[0]).get('AGC 1'))
+
+    # datastore
+    ActivitiesCache.clear_lru()
+    memcache.flush_all()
+    self.assertEqual(4, ActivitiesCache(self.sources[0]).get('AGL 1'))
+
+    # keys are per source
+    self.assertIsNone(ActivitiesCache(self.sources[1]).get('AGC 1'))
+
+  def test_expiration_and_prune(self):
+    self.cache.set('AGC 1', 3, time=10)
+    self.cache.set_multi({'AGC 2': 4, 'AGC 3': 5})
+
+    util.now_fn = lambda: testutil.NOW + datetime.timedelta(seconds=11)
+    self.assertIsNone(self.cache.get('AGC 1'))
+    self.assertEqual(4, self.cache.get('AGC 2'))
+
+    self.cache.prune(set(['2']))
+    self.cache.flush()
+    ActivitiesCache.clear_lru()
+    memcache.flush_all()
+    cache = ActivitiesCache(self.sources[0])
+    self.assertEqual({'AGC 2': 4}, cache.get_multi(['AGC 1', 'AGC 2', 'AGC 3']))
+
+  def test_prune_evicts_lru_and_memcache(self):
+    self.cache.set_multi({'AGC 1': 3, 'AGC 2': 4})
+    self.cache.prune(set(['2']))
+
+    # a fresh cache on the same instance shouldn't see the pruned key
+    cache = ActivitiesCache(self.sources[0])
+    self.assertEqual({'AGC 2': 4}, cache.get_multi(['AGC 1', 'AGC 2']))
+    self.assertIsNone(memcache.get(self.cache._memcache_key('AGC 1')))
+    self.assertEqual(4, memcache.get(self.cache._memcache_key('AGC 2'))[0])
+
+  def test_delete_multi(self):
+    self.cache.set_multi({'AGC 1': 3, 'AGL 1': 4})
+    self.cache.delete_multi(['AGC 1'])
+    self.cache.flush()
+    self.assertEqual({'AGL 1': 4}, self.cache.get_multi(['AGC 1', 'AGL 1']))
+    self.assertEqual(['AGL 1'], self.cache.entity.key.get().values.keys())
+
+
+class WebmentionEndpointCacheTest(testutil.ModelsTest):
+
+  def set_durable(self, url, endpoint):
+    for _ in range(WebmentionEndpointCache.DURABLE_DISCOVERIES):
+      WebmentionEndpointCache.set(url, endpoint)
+
+  def test_tiers(self):
+    self.set_durable('http://a/1', 'http://a/wm')
+    WebmentionEndpointCache.set('http://b/1', {'code': 'NO_ENDPOINT'})
+    self.assertEqual({'http://a/2': 'http://a/wm',
+                      'http://b/2': {'code': 'NO_ENDPOINT'}},
+                     WebmentionEndpointCache.get_multi(
+                       ['http://a/2', 'http://b/2', 'http://c/2']))
+    # keys are per scheme
+    self.assertIsNone(WebmentionEndpointCache.get('https://a/1'))
+
+    # memcache
+    WebmentionEndpointCache.clear_lru()
+    self.assertEqual('http://a/wm', WebmentionEndpointCache.get('http://a/3'))
+
+    # datastore only has endpoints, not errors
+    WebmentionEndpointCache.clear_lru()
+    memcache.flush_all()
+    self.assertEqual({'http://a/4': 'http://a/wm'},
+                     WebmentionEndpointCache.get_multi(['http://a/4',
+                                                        'http://b/4']))
+
+  def test_expiration(self):
+    self.set_durable('http://a/1', 'http://a/wm')
+    WebmentionEndpointCache.set('http://b/1', {'code': 'NO_ENDPOINT'})
+
+    now = time.time()
+    for elapsed, expected in (
+        (WebmentionEndpointCache.MEMCACHE_LRU_TIME + 1, ['a', 'b']),
+        (WebmentionEndpointCache.NO_ENDPOINT_TIME + 1, ['a']),
+        (WebmentionEndpointCache.DURABLE_ENDPOINT_TIME + 1, [])):
+      util.now_fn = lambda: testutil.NOW + datetime.timedelta(seconds=elapsed)
+      WebmentionEndpointCache.clear_lru()
+      memcache.flush_all()
+      self.testbed.get_stub('memcache')._gettime = lambda: now + elapsed
+      got = WebmentionEndpointCache.get_multi(
+        ['http://a/2', 'http://b/2', 'http://c/2'])
+      self.assertItemsEqual(expected, [util.domain_from_link(u) for u in got])
+
+  def test_transient_errors_not_cached(self):
+    self.assertFalse(WebmentionEndpointCache.set('http://c/1',
+                                                 {'code': 'EXCEPTION'}))
+    self.assertIsNone(WebmentionEndpointCache.get('http://c/2'))
+
+  def test_durable_after_repeated_discoveries(self):
+    def get_from_datastore():
+      WebmentionEndpointCache.clear_lru()
+      memcache.flush_all()
+      return WebmentionEndpointCache.get('http://a/2')
+
+    for _ in range(WebmentionEndpointCache.DURABLE_DISCOVERIES - 1):
+      WebmentionEndpointCache.set('http://a/1', 'http://a/wm')
+    self.assertIsNone(get_from_datastore())
+
+    WebmentionEndpointCache.set('http://a/1', 'http://a/wm')
+    self.assertEqual('http://a/wm', get_from_datastore())
+
+    # a different endpoint starts over
+    WebmentionEndpointCache.set('http://a/1', 'http://a/moved')
+    self.assertIsNone(get_from_datastore())
+
+  def test_record_failure(self):
+    self.set_durable('http://a/1', 'http://a/wm')
+    for _ in range(WebmentionEndpointCache.MAX_FAILURES - 1):
+      self.assertFalse(WebmentionEndpointCache.record_failure('http://a/2'))
+    self.assertEqual('http://a/wm', WebmentionEndpointCache.get('http://a/1'))
+
+    self.assertTrue(WebmentionEndpointCache.record_failure('http://a/2'))
+    self.assertIsNone(WebmentionEndpointCache.get('http://a/1'))
+    WebmentionEndpointCache.clear_lru()
+    memcache.flush_all()
+    self.assertIsNone(WebmentionEndpointCache.get('http://a/1'))
+
+  def test_delete_multi(self):
+    WebmentionEndpointCache.set('http://a/1', 'http://a/wm')
+    self.set_durable('http://b/1', 'http://b/wm')
+    WebmentionEndpointCache.delete_multi(['http://a/2'])
+    self.assertIsNone(WebmentionEndpointCache.get('http://a/1'))
+
+    WebmentionEndpointCache.clear_lru()
+    memcache.flush_all()
+    self.assertIsNone(WebmentionEndpointCache.get('http://a/1'))
+    self.assertEqual('http://b/wm', WebmentionEndpointCache.get('http://b/1'))
@@ -5,6 +5,7 @@ import datetime
 import json
 import string
 
+from google.appengine.ext import ndb
 from oauth_dropins import facebook as oauth_facebook
 from requests.exceptions import HTTPError
 
@@ -13,6 +14,7 @@ from models import SyndicatedPost
 import original_post_discovery
 from original_post_discovery import discover, refetch
 import testutil
+import util
 
 
 class OriginalPostDiscoveryTest(testutil.ModelsTest):
@@ -253,6 +255,37 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     # confirm that we do not fetch the h-feed again for the same syndicated post
     self.assertEquals((set(), set()), discover(self.source, self.activities[2]))
 
+  def test_concurrent_discover_fetches_hfeed_once(self):
+    """Concurrent discover() calls that share a FetchedHfeeds should only fetch
+    the author's h-feed once, and should all see its relationships.
+    """
+    for i, activity in enumerate(self.activities):
+      activity['object']['url'] = 'https://fa.ke/post/url%d' % i
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">""" + ''.join("""
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/%d"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url%d"></a>
+      </div>""" % (i, i) for i in range(3)) + """
+    </html>""")
+    self.mox.ReplayAll()
+
+    util.MAX_THREADS = 3
+    fetched = original_post_discovery.FetchedHfeeds()
+    results = util.run_in_threads(
+      [lambda a=a: discover(self.source, a, already_fetched_hfeeds=fetched)
+       for a in self.activities])
+
+    self.assertEquals([(set(['http://author/post/%d' % i]), set())
+                       for i in range(3)], results)
+    self.assertEquals(set(['http://author']), fetched)
+
+  def test_fetched_hfeeds_locks_per_url(self):
+    fetched = original_post_discovery.FetchedHfeeds()
+    self.assertIs(fetched.lock('http://a'), fetched.lock('http://a'))
+    self.assertIsNot(fetched.lock('http://a'), fetched.lock('http://b'))
+
   def test_no_duplicate_links(self):
     """Make sure that a link found by both original-post-discovery and
     posse-post-discovery will not result in two webmentions being sent.
@@ -1236,6 +1269,78 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     self.assert_equals({}, refetch(self.source))
     self.assert_syndicated_posts(('http://author/permalink', None))
 
+  def test_refetch_incremental(self):
+    """Refetch should only process h-feed entries that are new or changed."""
+    self.source.last_feed_syndication_url = datetime.datetime(1970, 1, 1)
+    self.source.put()
+
+    hfeed = """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="/1"></a>
+        <a class="u-syndication" href="https://fa.ke/1"></a>
+      </div>
+      <div class="h-entry">
+        <a class="u-url" href="/2"></a>
+        %s
+      </div>
+    </html>"""
+    updated = hfeed % '<a class="u-syndication" href="https://fa.ke/2"></a>'
+    for html in hfeed % '', hfeed % '', updated, updated:
+      self.expect_requests_get('http://author', html)
+    self.mox.ReplayAll()
+
+    self.assertEquals(['https://fa.ke/1'], refetch(self.source).keys())
+    self.assert_syndicated_posts(('http://author/1', 'https://fa.ke/1'),
+                                 ('http://author/2', None))
+
+    # unchanged h-feed. shouldn't process any entries, so deleted
+    # relationships don't come back.
+    ndb.delete_multi(SyndicatedPost.query().fetch(keys_only=True))
+    self.assert_equals({}, refetch(self.source))
+    self.assert_syndicated_posts()
+
+    # only the changed entry
+    self.assertEquals(['https://fa.ke/2'], refetch(self.source).keys())
+    self.assert_syndicated_posts(('http://author/2', 'https://fa.ke/2'))
+
+    # forced full pass
+    self.assertEquals(['https://fa.ke/1'],
+                      refetch(self.source, force=True).keys())
+    self.assert_syndicated_posts(('http://author/1', 'https://fa.ke/1'),
+                                 ('http://author/2', 'https://fa.ke/2'))
+
+  def test_refetch_incremental_full_pass_after_watermark_time(self):
+    """Even if the h-feed keeps changing, refetch should process every entry
+    again once its watermark is older than HFEED_WATERMARK_TIME."""
+    self.source.last_feed_syndication_url = datetime.datetime(1970, 1, 1)
+    self.source.put()
+
+    hfeed = """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="/1"></a>
+        <a class="u-syndication" href="https://fa.ke/1"></a>
+      </div>
+      <div class="h-entry">
+        <a class="u-url" href="/%d"></a>
+      </div>
+    </html>"""
+    for i in 2, 3, 4:
+      self.expect_requests_get('http://author', hfeed % i)
+    self.mox.ReplayAll()
+
+    self.assertEquals(['https://fa.ke/1'], refetch(self.source).keys())
+    ndb.delete_multi(SyndicatedPost.query().fetch(keys_only=True))
+
+    # changed h-feed, but /1 is unchanged, so it's skipped
+    self.assert_equals({}, refetch(self.source))
+
+    # watermark is too old, so /1 is processed again
+    util.now_fn = lambda: testutil.NOW + datetime.timedelta(
+      seconds=original_post_discovery.HFEED_WATERMARK_TIME + 1)
+    self.assertEquals(['https://fa.ke/1'], refetch(self.source).keys())
+
   def test_refetch_dont_follow_other_silo_syndication(self):
     """We should only resolve redirects if the initial domain is our silo."""
     self.unstub_requests_head()
@@ -11,6 +11,7 @@ import appengine_config
 
 from granary import source as gr_source
 from google.appengine.api import mail
+from google.appengine.api import memcache
 import mox
 from oauth_dropins import facebook as oauth_facebook
 import requests
@@ -121,6 +122,35 @@ class PublishTest(testutil.HandlerTest):
     self.assertEquals('http://fake/url', resp.headers['Location'])
     self._check_entity()
 
+  def test_out_of_api_tokens_429(self):
+    self.mox.stubs.Set(testutil.FakeSource, 'API_TOKEN_BUCKET', (1, .001))
+    self.assertEquals(0, self.source.api_token_wait())
+    self.mox.ReplayAll()
+
+    self.assert_error('too many FakeSource API calls', status=429)
+    # we shouldn't leave anything behind
+    self.assertEquals(0, Publish.query().count())
+    self.assertEquals(0, PublishedPage.query().count())
+
+  def test_charges_api_calls(self):
+    class UrlopenGrSource(testutil.FakeGrSource):
+      def urlopen(self, url):
+        return url
+      def create(self, *args, **kwargs):
+        for url in 'a', 'b', 'c':
+          self.urlopen(url)
+        return super(UrlopenGrSource, self).create(*args, **kwargs)
+
+    self.mox.stubs.Set(testutil.FakeSource, 'GR_CLASS', UrlopenGrSource)
+    self.mox.stubs.Set(testutil.FakeSource, 'API_TOKEN_BUCKET', (5, .001))
+    self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
+    self.mox.ReplayAll()
+
+    self.assert_created('foo - http://foo.com/bar')
+    # one token up front, then two more for the extra calls
+    tokens, _ = memcache.get('TB fake')
+    self.assertAlmostEqual(2, tokens, delta=.1)
+
   def test_interactive_success(self):
     self.expect_requests_get('http://foo.com/bar', self.post_html % 'foo')
     self.mox.ReplayAll()
@@ -14,6 +14,7 @@ import mox
 import socket
 import string
 import StringIO
+import threading
 import time
 import urllib
 import urllib2
@@ -26,7 +27,6 @@ from google.appengine.ext import ndb
 import httplib2
 from oauth2client.client import AccessTokenRefreshError
 import requests
-from webmentiontools import send
 
 import appengine_config
 
@@ -148,8 +148,8 @@ class PollTest(TaskQueueTest):
     tasks = self.taskqueue_stub.GetTasks('propagate')
     for task in tasks:
       self.assertEqual('/_ah/queue/propagate', task['url'])
-    keys = set(ndb.Key(urlsafe=testutil.get_task_params(t)['response_key'])
-               for t in tasks)
+    keys = set(ndb.Key(urlsafe=key)
+               for key in testutil.get_task_response_keys(tasks))
     self.assert_equals(keys, set(r.key for r in self.responses))
 
     tasks = self.taskqueue_stub.GetTasks('poll')
@@ -159,6 +159,30 @@ class PollTest(TaskQueueTest):
     params = testutil.get_task_params(tasks[0])
     self.assert_equals(source.key.urlsafe(), params['source_key'])
 
+  def test_poll_concurrent(self):
+    """With more than one thread, the silo calls should overlap."""
+    util.MAX_THREADS = 3
+    started = {'links': threading.Event(), 'activities': threading.Event()}
+    overlapped = []
+
+    def wrap(name, other, orig):
+      def wrapper(source, *args, **kwargs):
+        started[name].set()
+        overlapped.append(started[other].wait(10))
+        return orig(source, *args, **kwargs)
+      return wrapper
+
+    self.mox.stubs.Set(FakeSource, 'search_for_links', wrap(
+      'links', 'activities', FakeSource.search_for_links.im_func))
+    self.mox.stubs.Set(FakeSource, 'get_activities_response', wrap(
+      'activities', 'links', FakeSource.get_activities_response.im_func))
+
+    self.post_task()
+    self.assertEqual([True, True], overlapped)
+    self.assertEqual(9, Response.query().count())
+    self.assert_responses()
+    self.assertEqual('ok', self.sources[0].key.get().poll_status)
+
   def test_poll_status_polling(self):
     def check_poll_status(*args, **kwargs):
       self.assertEqual('polling', self.sources[0].key.get().poll_status)
@@ -169,6 +193,41 @@ class PollTest(TaskQueueTest):
     self.post_task()
     self.assertEqual('ok', self.sources[0].key.get().poll_status)
 
+  def test_poll_out_of_api_tokens(self):
+    """If the silo's API token bucket is empty, we should reschedule the poll."""
+    self.mox.stubs.Set(FakeSource, 'API_TOKEN_BUCKET', (1, .001))
+    self.assertEqual(0, self.sources[0].api_token_wait())
+    self.mox.StubOutWithMock(FakeSource, 'get_activities_response')
+    self.mox.ReplayAll()
+
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual(util.EPOCH, source.last_poll_attempt)
+    self.assert_task_eta(datetime.timedelta(seconds=1000))
+
+  def test_poll_circuit_breaker(self):
+    """Silo failures should open the circuit breaker, which reschedules polls."""
+    self.mox.stubs.Set(util, 'CIRCUIT_BREAKER_FAILURES', 1)
+    self.expect_get_activities().AndRaise(
+      urllib2.HTTPError('url', 500, 'msg', {}, None))
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assertEquals('open', util.CircuitBreaker('fake').state())
+
+    # the next poll shouldn't call the silo at all
+    self.taskqueue_stub.FlushQueue('poll')
+    self.post_task(reset=True)
+    self.assertEquals(1, self.sources[0].key.get().poll_failures)
+    self.assert_task_eta(datetime.timedelta(
+      seconds=util.CIRCUIT_BREAKER_OPEN_TIME * 1.25))
+
+    # next_poll_due is after the new task, so ReplacePollTasks won't duplicate it
+    task_eta = testutil.get_task_eta(self.taskqueue_stub.GetTasks('poll')[0])
+    next_poll_due = self.sources[0].key.get().next_poll_due
+    self.assertGreater(next_poll_due - NOW,
+                       task_eta - datetime.datetime.utcnow())
+
   def test_poll_error(self):
     """If anything goes wrong, the source status should be set to 'error'."""
     self.expect_get_activities().AndRaise(Exception('foo'))
@@ -179,22 +238,48 @@ class PollTest(TaskQueueTest):
     self.assertEqual(0, len(self.taskqueue_stub.GetTasks('poll')))
 
   def test_poll_silo_500(self):
-    """If a silo HTTP request 500s, we should quietly retry the task."""
+    """If a silo HTTP request 500s, we should back off and poll again later."""
     self.expect_get_activities().AndRaise(
       urllib2.HTTPError('url', 505, 'msg', {}, None))
     self.mox.ReplayAll()
 
-    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
-    self.assertEqual('error', self.sources[0].key.get().poll_status)
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual('error', source.poll_status)
+    self.assertEqual(1, source.poll_failures)
+    self.assert_task_eta(FakeSource.FAST_POLL)
 
   def test_poll_silo_deadlines(self):
-    """If a silo HTTP request deadlines, we should quietly retry the task."""
+    """If a silo HTTP request deadlines, we should back off and poll again later."""
     self.expect_get_activities().AndRaise(
       urllib2.URLError(socket.gaierror('deadlined')))
     self.mox.ReplayAll()
 
-    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
-    self.assertEqual('error', self.sources[0].key.get().poll_status)
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual('error', source.poll_status)
+    self.assertEqual(1, source.poll_failures)
+
+  def test_poll_failures_backoff(self):
+    """Consecutive failures should back off exponentially, and reset on success."""
+    self.sources[0].poll_failures = 5
+    self.sources[0].put()
+    self.expect_get_activities().AndRaise(
+      urllib2.HTTPError('url', 503, 'msg', {}, None))
+    self.mox.ReplayAll()
+
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual(6, source.poll_failures)
+    self.assert_task_eta(FakeSource.POLL_BACKOFF * 32)
+
+    self.mox.UnsetStubs()
+    self.taskqueue_stub.FlushQueue('poll')
+    self.post_task(reset=True)
+    source = self.sources[0].key.get()
+    self.assertEqual(0, source.poll_failures)
+    self.assertEqual('ok', source.poll_status)
+    self.assert_task_eta(FakeSource.FAST_POLL)
 
   def test_reset_status_to_enabled(self):
     """After a successful poll, status should be set to 'enabled' and 'ok'."""
@@ -390,8 +475,9 @@ class PollTest(TaskQueueTest):
 
     self.post_task()
     ids = set()
-    for task in self.taskqueue_stub.GetTasks('propagate'):
-      resp_key = ndb.Key(urlsafe=testutil.get_task_params(task)['response_key'])
+    for key in testutil.get_task_response_keys(
+        self.taskqueue_stub.GetTasks('propagate')):
+      resp_key = ndb.Key(urlsafe=key)
       ids.update(json.loads(a)['id'] for a in resp_key.get().activities_json)
     self.assert_equals(ids, set([self.activities[0]['id'], self.activities[2]['id']]))
 
@@ -420,6 +506,29 @@ class PollTest(TaskQueueTest):
     self.assert_responses()
     self.assertEqual('complete', self.responses[0].key.get().status)
 
+  def test_migrate_seen_responses_cache_json(self):
+    """Seen responses in the deprecated full JSON cache should still be skipped.
+    """
+    source = self.sources[0]
+    source.seen_responses_cache_json = json.dumps(
+      [json.loads(r.response_json) for r in self.responses])
+    source.put()
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate'))
+
+    # a changed response should store it and replace the old cache
+    self.activities[0]['object']['replies']['items'][0]['content'] = 'changed'
+    self.post_task(reset=True)
+    self.assert_equals([self.responses[0].key],
+                       list(Response.query().iter(keys_only=True)))
+
+    source = source.key.get()
+    self.assertIsNone(source.seen_responses_cache_json)
+    self.assertEqual(set(r.key.id() for r in self.responses),
+                     set(json.loads(source.seen_responses_fingerprints_json)))
+
   def test_existing_response_with_fb_id(self):
     """We should de-dupe responses using fb_id as well as id.
 
@@ -885,7 +994,10 @@ class PollTest(TaskQueueTest):
     self.assertEqual('c', self.sources[0].key.get().last_activity_id)
 
   def test_cache_trims_to_returned_activity_ids(self):
-    """We should trim last_activities_cache_json to just the returned activity ids."""
+    """We should trim the activities cache to just the returned activity ids.
+
+    Also migrates the deprecated Source.last_activities_cache_json.
+    """
     source = self.sources[0]
     source.last_activities_cache_json = json.dumps(
       {1: 2, 'x': 'y', 'prefix x': 1, 'prefix b': 0})
@@ -893,8 +1005,11 @@ class PollTest(TaskQueueTest):
 
     self.post_task()
 
-    self.assert_equals({'prefix b': 0},
-                       json.loads(source.key.get().last_activities_cache_json))
+    source = source.key.get()
+    self.assertIsNone(source.last_activities_cache_json)
+    cached = ndb.Key('CachedActivities', 'activities', parent=source.key).get()
+    self.assertEqual(['prefix b'], cached.values.keys())
+    self.assertEqual(0, models.ActivitiesCache(source).get('prefix b'))
 
   def test_slow_poll_never_sent_webmention(self):
     self.sources[0].created = NOW - (FakeSource.FAST_POLL_GRACE_PERIOD +
@@ -1147,7 +1262,6 @@ class PollTest(TaskQueueTest):
   def test_response_changed(self):
     """If a response changes, we should repropagate it from scratch.
     """
-    source = self.sources[0]
     activity = self.activities[0]
 
     # just one response: self.responses[0]
@@ -1162,12 +1276,12 @@ class PollTest(TaskQueueTest):
     self._change_response_and_poll()
 
     # return new response *and* existing response. both should be stored in
-    # Source.seen_responses_cache_json
+    # Source.seen_responses_fingerprints_json
     replies = activity['object']['replies']['items']
     replies.append(self.activities[1]['object']['replies']['items'][0])
 
     self.post_task(reset=True)
-    self.assert_equals(replies, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_seen_responses(replies)
     self.responses[3].key.delete()
 
     # new responses that don't include existing response. cache will have
@@ -1178,7 +1292,7 @@ class PollTest(TaskQueueTest):
     self.post_task(reset=True)
     self.assert_equals([r.key for r in self.responses[:3]],
                        list(Response.query().iter(keys_only=True)))
-    self.assert_equals(tags, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_seen_responses(tags)
 
   def _change_response_and_poll(self):
     resp = self.responses[0].key.get() or self.responses[0]
@@ -1206,8 +1320,13 @@ class PollTest(TaskQueueTest):
                       testutil.get_task_params(tasks[0])['response_key'])
     self.taskqueue_stub.FlushQueue('propagate')
 
+    self.assert_seen_responses([reply])
+
+  def assert_seen_responses(self, responses):
     source = self.sources[0].key.get()
-    self.assert_equals([reply], json.loads(source.seen_responses_cache_json))
+    self.assert_equals(
+      {r['id']: util.response_fingerprint(r) for r in responses},
+      json.loads(source.seen_responses_fingerprints_json))
 
 
 class PropagateTest(TaskQueueTest):
@@ -1218,7 +1337,7 @@ class PropagateTest(TaskQueueTest):
     super(PropagateTest, self).setUp()
     for r in self.responses[:3]:
       r.put()
-    self.mox.StubOutClassWithMocks(send, 'WebmentionSend')
+    self.mox.StubOutClassWithMocks(util, 'WebmentionSend')
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -1253,7 +1372,7 @@ class PropagateTest(TaskQueueTest):
     if source_url is None:
       source_url = 'http://localhost/comment/fake/%s/a/1_2_a' % \
           self.sources[0].key.string_id()
-    mock_send = send.WebmentionSend(source_url, target, endpoint=input_endpoint)
+    mock_send = util.WebmentionSend(source_url, target, endpoint=input_endpoint)
     mock_send.source_url = source_url
     mock_send.target_url = target
     mock_send.receiver_endpoint = (discovered_endpoint if discovered_endpoint
@@ -1285,6 +1404,29 @@ class PropagateTest(TaskQueueTest):
       self.assert_equals(now, self.sources[0].key.get().last_webmention_sent)
       memcache.flush_all()
 
+  def test_propagate_changed_complete_response(self):
+    """A changed response that was already complete should be re-sent, even if
+    its propagate task runs as soon as it's enqueued."""
+    stored = self.responses[0]
+    stored.sent = stored.unsent
+    stored.unsent = []
+    stored.status = 'complete'
+    stored.put()
+
+    changed = Response(id=stored.key.id(), **stored.to_dict())
+    resp_json = json.loads(changed.response_json)
+    resp_json['content'] = 'edited'
+    changed.response_json = json.dumps(resp_json)
+
+    self.mox.StubOutWithMock(util, 'add_propagate_tasks')
+    util.add_propagate_tasks(mox.IgnoreArg()).WithSideEffects(
+      lambda entities: self.post_task())
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+
+    Response.get_or_save_multi([changed], self.sources[0])
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+
   def test_propagate_from_error(self):
     """A normal propagate task, with a response starting as 'error'."""
     self.responses[0].status = 'error'
@@ -1331,6 +1473,147 @@ class PropagateTest(TaskQueueTest):
                             skipped=['http://2', 'http://8'])
     self.assertEquals(NOW, self.sources[0].key.get().last_webmention_sent)
 
+  def test_groups_targets_by_host(self):
+    """Targets on the same host should be sent to serially, in one group."""
+    self.responses[0].unsent = ['http://a/1', 'https://a/2', 'http://b/1']
+    self.responses[0].put()
+
+    self.expect_webmention(target='http://a/1').AndReturn(True)
+    self.expect_webmention(target='https://a/2',
+                           error={'code': 'RECEIVER_ERROR'}).AndReturn(False)
+    self.expect_webmention(target='http://b/1').AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', sent=['http://a/1', 'http://b/1'],
+                            error=['https://a/2'])
+
+  def test_host_busy(self):
+    """Targets on hosts that another task is sending to should be deferred."""
+    self.responses[0].unsent = ['http://a/1', 'http://b/1']
+    self.responses[0].put()
+    self.assertTrue(util.HostShard('b').lease())
+
+    self.expect_webmention(target='http://a/1').AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('new', None, sent=['http://a/1'],
+                            unsent=['http://b/1'])
+    self.assertEquals(1, util.HostShard('b').backlog())
+    self.assertIsNone(util.HostShard('a').leased())
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEquals(1, len(tasks))
+    self.assertEquals(self.responses[0].key.urlsafe(),
+                      testutil.get_task_params(tasks[0])['response_key'])
+    self.assertGreater(testutil.get_task_eta(tasks[0]),
+                       datetime.datetime.utcnow())
+
+  def test_batch(self):
+    """A task with several responses should send all of their webmentions."""
+    self.responses[1].unsent = ['http://target1/post/url', 'http://b/1']
+    self.responses[1].put()
+
+    id = self.sources[0].key.string_id()
+    self.expect_webmention().AndReturn(True)
+    # the second response should use the endpoint that the first one discovered
+    self.expect_webmention(source_url='http://localhost/like/fake/%s/a/alice' % id,
+                           input_endpoint='http://webmention/endpoint',
+                           error={'code': 'RECEIVER_ERROR', 'http_status': 500})\
+                           .AndReturn(False)
+    self.expect_webmention(source_url='http://localhost/like/fake/%s/a/alice' % id,
+                           target='http://b/1').AndReturn(True)
+    self.mox.ReplayAll()
+
+    super(PropagateTest, self).post_task(
+      expected_status=tasks.ERROR_HTTP_RETURN_CODE,
+      params=[('response_key', r.key.urlsafe()) for r in self.responses[:2]])
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assert_response_is('error', sent=['http://b/1'],
+                            error=['http://target1/post/url'],
+                            response=self.responses[1])
+    self.assert_response_is('new', unsent=['http://target1/post/url'],
+                            response=self.responses[2])
+
+  def test_retry_only_due_targets(self):
+    """Targets in error should only be retried when they're due."""
+    self.responses[0].unsent = ['http://a/1', 'http://b/1']
+    self.responses[0].put()
+
+    self.expect_webmention(target='http://a/1', error={'code': 'RECEIVER_ERROR'})\
+        .AndReturn(False)
+    self.expect_webmention(target='http://b/1').AndReturn(True)
+    self.expect_webmention(target='http://a/1',
+                           input_endpoint='http://webmention/endpoint'
+                           ).AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', sent=['http://b/1'], error=['http://a/1'])
+    retries = self.responses[0].key.get().retries()
+    self.assertEquals(['http://a/1'], retries.keys())
+    self.assertEquals(1, retries['http://a/1']['attempts'])
+
+    # not due yet. should schedule a new task for when it is.
+    self.post_task()
+    self.assert_response_is('error', sent=['http://b/1'], error=['http://a/1'])
+    queued = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEquals(1, len(queued))
+    self.assertEquals(self.responses[0].key.urlsafe(),
+                      testutil.get_task_params(queued[0])['response_key'])
+
+    util.now_fn = lambda: NOW + datetime.timedelta(
+      seconds=Response.RETRY_BASE_DELAY)
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://b/1', 'http://a/1'])
+    self.assertIsNone(self.responses[0].key.get().retries_json)
+
+  def test_retry_gives_up_after_max_attempts(self):
+    """Targets that keep failing should eventually move to failed."""
+    self.responses[0].unsent = []
+    self.responses[0].error = ['http://a/1']
+    self.responses[0].retries_json = json.dumps({'http://a/1': {
+      'attempts': Response.RETRY_MAX_ATTEMPTS - 1, 'next': 0, 'error': 'foo'}})
+    self.responses[0].put()
+
+    self.expect_webmention(target='http://a/1', error={'code': 'RECEIVER_ERROR'})\
+        .AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('complete', failed=['http://a/1'])
+    self.assertEquals(set(['http://a/1']), self.responses[0].key.get().gave_up())
+    self.assertEquals(0, len(self.taskqueue_stub.GetTasks('propagate')))
+
+  def test_retry_gave_up_targets_not_resent(self):
+    """Targets we gave up on shouldn't be re-sent when other targets retry."""
+    self.responses[0].unsent = ['http://b/1']
+    self.responses[0].error = ['http://a/1']
+    self.responses[0].retries_json = json.dumps({'http://a/1': {
+      'attempts': Response.RETRY_MAX_ATTEMPTS - 1, 'next': 0, 'error': 'foo'}})
+    self.responses[0].put()
+
+    self.expect_webmention(target='http://a/1', error={'code': 'RECEIVER_ERROR'})\
+        .AndReturn(False)
+    self.expect_webmention(target='http://b/1', error={'code': 'RECEIVER_ERROR'})\
+        .AndReturn(False)
+    # only b is retried
+    self.expect_webmention(target='http://b/1', error={'code': 'RECEIVER_ERROR'},
+                           input_endpoint='http://webmention/endpoint')\
+        .AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', failed=['http://a/1'], error=['http://b/1'])
+
+    util.now_fn = lambda: NOW + datetime.timedelta(
+      seconds=Response.RETRY_BASE_DELAY)
+    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', failed=['http://a/1'], error=['http://b/1'])
+    retries = self.responses[0].key.get().retries()
+    self.assertEquals(2, retries['http://b/1']['attempts'])
+
   def test_cached_webmention_discovery(self):
     """Webmention endpoints should be cached."""
     self.expect_webmention().AndReturn(True)
@@ -1345,6 +1628,56 @@ class PropagateTest(TaskQueueTest):
     self.responses[0].put()
     self.post_task()
 
+  def test_cached_webmention_discovery_datastore(self):
+    """Endpoints discovered repeatedly should outlive memcache in the datastore.
+    """
+    for _ in range(models.WebmentionEndpointCache.DURABLE_DISCOVERIES - 1):
+      models.WebmentionEndpointCache.set('http://target1/',
+                                         'http://webmention/endpoint')
+    memcache.flush_all()
+    models.WebmentionEndpointCache.clear_lru()
+
+    self.expect_webmention().AndReturn(True)
+    self.expect_webmention(input_endpoint='http://webmention/endpoint'
+                           ).AndReturn(True)
+
+    self.mox.ReplayAll()
+    self.post_task()
+
+    memcache.flush_all()
+    models.WebmentionEndpointCache.clear_lru()
+    self.responses[0].status = 'new'
+    self.responses[0].put()
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+
+  def test_cached_webmention_endpoint_receiver_4xx(self):
+    """A 4xx from a cached endpoint should make us rediscover it next time."""
+    models.WebmentionEndpointCache.set('http://target1/', 'http://old/endpoint')
+    self.expect_webmention(input_endpoint='http://old/endpoint',
+                           error={'code': 'RECEIVER_ERROR', 'http_status': 404}
+                           ).AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('complete', failed=['http://target1/post/url'])
+    self.assertIsNone(
+      models.WebmentionEndpointCache.get('http://target1/post/url'))
+
+  def test_cached_webmention_endpoint_receiver_5xx(self):
+    """Repeated 5xxes from a cached endpoint should make us rediscover it."""
+    self.mox.stubs.Set(models.WebmentionEndpointCache, 'MAX_FAILURES', 1)
+    models.WebmentionEndpointCache.set('http://target1/', 'http://old/endpoint')
+    self.expect_webmention(input_endpoint='http://old/endpoint',
+                           error={'code': 'RECEIVER_ERROR', 'http_status': 500}
+                           ).AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', error=['http://target1/post/url'])
+    self.assertIsNone(
+      models.WebmentionEndpointCache.get('http://target1/post/url'))
+
   def test_cached_webmention_discovery_error(self):
     """Failed webmention discovery should be cached too."""
     self.expect_webmention(error={'code': 'NO_ENDPOINT'}).AndReturn(False)
@@ -1403,11 +1736,13 @@ class PropagateTest(TaskQueueTest):
     # https://code.google.com/p/googleappengine/issues/list?can=1&q=patch&sort=-id
     now = time.time()
     self.testbed.get_stub('memcache')._gettime = lambda: now
+    self.mox.stubs.Set(models.WebmentionEndpointCache, '_now',
+                       staticmethod(lambda: now))
 
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += tasks.WEBMENTION_DISCOVERY_CACHE_TIME - 1
+    now += models.WebmentionEndpointCache.NO_ENDPOINT_TIME - 1
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
@@ -1566,6 +1901,18 @@ class PropagateTest(TaskQueueTest):
     self.post_task()
     self.assert_equals('yes', self.sources[0].key.get().webmention_endpoint)
 
+  def test_last_webmention_sent_recent(self):
+    """Should only update Source.last_webmention_sent every so often."""
+    recent = NOW - datetime.timedelta(minutes=1)
+    self.sources[0].last_webmention_sent = recent
+    self.sources[0].put()
+
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assert_equals(recent, self.sources[0].key.get().last_webmention_sent)
+
   def test_leased(self):
     """If the response is processing and the lease hasn't expired, do nothing."""
     self.responses[0].status = 'processing'
@@ -1782,6 +2129,24 @@ class PropagateTest(TaskQueueTest):
 
     self.mox.ReplayAll()
     self.post_task(expected_status=tasks.ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', error=['http://target1/post/url'])
+
+  def test_source_url_key_error_batch(self):
+    """The KeyError bug should only fail its own target, not the batch."""
+    self.responses[0].urls_to_activity = json.dumps({'bad': 9})
+    self.responses[0].put()
+
+    id = self.sources[0].key.string_id()
+    self.expect_webmention(source_url='http://localhost/like/fake/%s/a/alice' % id
+                           ).AndReturn(True)
+    self.mox.ReplayAll()
+
+    super(PropagateTest, self).post_task(
+      expected_status=tasks.ERROR_HTTP_RETURN_CODE,
+      params=[('response_key', r.key.urlsafe()) for r in self.responses[:2]])
+    self.assert_response_is('error', error=['http://target1/post/url'])
+    self.assert_response_is('complete', sent=['http://target1/post/url'],
+                            response=self.responses[1])
 
   def test_propagate_blogpost(self):
     """Blog post propagate task."""
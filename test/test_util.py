@@ -1,7 +1,10 @@
 # coding=utf-8
 """Unit tests for util.py."""
+import copy
 import datetime
 import json
+import mox
+import threading
 import time
 import urllib
 import urlparse
@@ -10,6 +13,8 @@ from appengine_config import HTTP_TIMEOUT
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
+import mf2py
+import requests
 import webapp2
 from webmentiontools import send
 
@@ -91,6 +96,32 @@ class UtilTest(testutil.ModelsTest):
       ):
       self.assert_equals(expected, util.prune_activity(orig, self.sources[0]))
 
+  def test_response_fingerprint(self):
+    resp = {
+      'id': 'tag:fa.ke,2013:1',
+      'objectType': 'comment',
+      'content': 'foo',
+      'published': '2012-12-05T00:58:26+00:00',
+      'replies': {'items': [{'content': 'bar'}]},
+      'object': {'content': 'baz', 'url': 'http://fa.ke/1'},
+    }
+    fingerprint = util.response_fingerprint(resp)
+
+    # fields activity_changed() ignores don't change the fingerprint
+    for same in (
+      dict(resp, published='2016-01-01T00:00:00+00:00', to=[]),
+      dict(resp, object={'content': 'baz', 'image': None}),
+      util.prune_response(copy.deepcopy(resp)),
+      ):
+      self.assertEqual(fingerprint, util.response_fingerprint(same))
+
+    for changed in (
+      dict(resp, content='qux'),
+      dict(resp, objectType='note'),
+      dict(resp, object={'content': 'baz', 'location': {'id': 'x'}}),
+      ):
+      self.assertNotEqual(fingerprint, util.response_fingerprint(changed))
+
   def test_webmention_tools_relative_webmention_endpoint_in_body(self):
     super(testutil.HandlerTest, self).expect_requests_get('http://target/', """
 <html><meta>
@@ -114,6 +145,92 @@ class UtilTest(testutil.ModelsTest):
     mention._discoverEndpoint()
     self.assertEquals('http://target/endpoint', mention.receiver_endpoint)
 
+  def test_webmention_send_endpoint_in_head(self):
+    self.expect_webmention_requests_get('http://target/', """
+<html><head><link rel="webmention" href="/endpoint"></head>
+<body>%s</body></html>""" % ('x' * util.HTTP_CHUNK_SIZE * 2), verify=False)
+    self.mox.ReplayAll()
+
+    mention = util.WebmentionSend('http://source/', 'http://target/')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    mention._discoverEndpoint()
+    self.assertEquals('http://target/endpoint', mention.receiver_endpoint)
+    self.assertLessEqual(len(mention.html), util.HTTP_CHUNK_SIZE)
+
+  def test_webmention_send_endpoint_in_body(self):
+    self.expect_webmention_requests_get('http://target/', """
+<html><head></head>
+<body><a rel="webmention" href="http://end/point">wm</a></body></html>""",
+      verify=False)
+    self.mox.ReplayAll()
+
+    mention = util.WebmentionSend('http://source/', 'http://target/')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    mention._discoverEndpoint()
+    self.assertEquals('http://end/point', mention.receiver_endpoint)
+
+  def test_webmention_send_parses_each_byte_once(self):
+    html = """\
+<html><head><title>x</title></head>
+<body><a rel="webmention" href="http://end/point">wm</a></body></html>"""
+    raw = self.mox.CreateMockAnything()
+    raw.close()
+    raw.release_conn()
+    self.expect_webmention_requests_get('http://target/', html, verify=False
+                                        )._return_value.raw = raw
+    self.mox.ReplayAll()
+
+    parsed = []
+    orig = util.bs4.BeautifulSoup
+    def beautifulsoup(input):
+      parsed.append(input)
+      return orig(input)
+    self.mox.stubs.Set(util.bs4, 'BeautifulSoup', beautifulsoup)
+
+    mention = util.WebmentionSend('http://source/', 'http://target/')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    mention._discoverEndpoint()
+    self.assertEquals('http://end/point', mention.receiver_endpoint)
+    self.assertEquals(html, ''.join(parsed))
+
+  def test_webmention_send_stops_after_max_size(self):
+    self.mox.stubs.Set(util, 'MAX_HTTP_RESPONSE_SIZE', util.HTTP_CHUNK_SIZE)
+    self.expect_webmention_requests_get('http://target/', """
+<html><body>%s<a rel="webmention" href="http://end/point">wm</a></body></html>
+""" % ('x' * util.HTTP_CHUNK_SIZE), verify=False)
+    self.mox.ReplayAll()
+
+    mention = util.WebmentionSend('http://source/', 'http://target/')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    mention._discoverEndpoint()
+    self.assertIsNone(mention.receiver_endpoint)
+    self.assertEquals('NO_ENDPOINT', mention.error['code'])
+
+  def test_webmention_send_not_html(self):
+    self.expect_webmention_requests_get(
+      'http://target/', '<link rel="webmention" href="http://end/point">',
+      content_type='image/jpeg', verify=False)
+    self.mox.ReplayAll()
+
+    mention = util.WebmentionSend('http://source/', 'http://target/')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    mention._discoverEndpoint()
+    self.assertIsNone(mention.receiver_endpoint)
+    self.assertIsNone(mention.html)
+    self.assertEquals('BAD_TARGET_URL', mention.error['code'])
+
+  def test_webmention_send_notify_receiver(self):
+    super(testutil.HandlerTest, self).expect_requests_post(
+      'http://end/point', 'ok', verify=False,
+      data={'source': 'http://source/', 'target': 'http://target/'})
+    self.mox.ReplayAll()
+
+    mention = util.WebmentionSend('http://source/', 'http://target/',
+                                  endpoint='http://end/point')
+    mention.requests_kwargs = {'timeout': HTTP_TIMEOUT}
+    self.assertTrue(mention._notifyReceiver())
+    self.assertEquals(200, mention.response['http_status'])
+
   def test_get_webmention_target_blacklisted_urls(self):
     for resolve in True, False:
       self.assertTrue(util.get_webmention_target(
@@ -152,6 +269,94 @@ class UtilTest(testutil.ModelsTest):
     self.assert_equals(('https://end', 'end', True),
                        util.get_webmention_target('http://orig', resolve=True))
 
+  def test_get_webmention_targets(self):
+    self.expect_requests_head('http://a', redirected_url='http://a/final')
+    self.expect_requests_head('http://b', content_type='application/pdf')
+    self.expect_requests_head('http://c', redirected_url='http://c/final')
+    self.mox.ReplayAll()
+
+    util.follow_redirects('http://a')
+    util.RedirectCache.clear_lru()  # should come from memcache
+    self.assert_equals([
+      ('http://a/final', 'a', True),
+      ('http://b', 'b', False),
+      ('http://c/final', 'c', True),
+      ('http://b', 'b', False),
+      ('http://d', 'd', True),
+    ], util.get_webmention_targets(
+      ['http://a', 'http://b', 'http://c', 'http://b', 'http://d'],
+      resolve=[True, True, True, True, False]))
+
+  def test_follow_redirects_cache(self):
+    self.expect_requests_head('http://foo/bar', redirected_url='http://final')
+    self.expect_requests_head('http://foo/bar', redirected_url='http://final')
+    self.mox.ReplayAll()
+
+    # should use the in-process cache even after memcache is flushed
+    for _ in range(2):
+      resolved = util.follow_redirects('http://foo/bar')
+      self.assertEquals('http://final', resolved.url)
+      self.assertEquals('text/html', resolved.headers['content-type'])
+      memcache.flush_all()
+
+    util.RedirectCache.clear_lru()
+    self.assertEquals('http://final', util.follow_redirects('http://foo/bar').url)
+
+  def test_follow_redirects_cache_hit_skips_host_limit(self):
+    limited = []
+    real_host_limit = util.host_limit
+
+    def host_limit(url):
+      limited.append(url)
+      return real_host_limit(url)
+    self.mox.stubs.Set(util, 'host_limit', host_limit)
+
+    self.expect_requests_head('http://foo/bar', redirected_url='http://final')
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.assertEquals('http://final', util.follow_redirects('http://foo/bar').url)
+    self.assertEquals(['http://foo/bar'], limited)
+
+  def test_follow_redirects_cache_failure(self):
+    now = time.time()
+    self.mox.stubs.Set(util.RedirectCache, '_now', staticmethod(lambda: now))
+    self.expect_requests_head('http://foo/bar', status_code=404)
+    self.expect_requests_head('http://foo/bar')
+    self.mox.ReplayAll()
+
+    self.assertEquals(499, util.follow_redirects('http://foo/bar').status_code)
+    memcache.flush_all()
+    self.assertEquals(499, util.follow_redirects('http://foo/bar').status_code)
+
+    # failures expire sooner
+    now += util.REDIRECT_FAIL_TIME + 1
+    memcache.flush_all()
+    self.assertEquals(200, util.follow_redirects('http://foo/bar').status_code)
+
+  def test_follow_redirects_cache_failure_memcache(self):
+    times = []
+    real_set_multi = memcache.set_multi
+
+    def set_multi(mapping, time=0):
+      times.append(time)
+      return real_set_multi(mapping, time=time)
+    self.mox.stubs.Set(memcache, 'set_multi', set_multi)
+
+    self.expect_requests_head('http://foo/bar', status_code=404)
+    self.expect_requests_head('http://foo/bar')
+    self.mox.ReplayAll()
+
+    self.assertEquals(499, util.follow_redirects('http://foo/bar').status_code)
+    self.assertEquals([util.REDIRECT_FAIL_TIME], times)
+
+    # failures from memcache don't go into the in-process cache, so they don't
+    # outlive REDIRECT_FAIL_TIME
+    util.RedirectCache.clear_lru()
+    self.assertEquals(499, util.follow_redirects('http://foo/bar').status_code)
+    memcache.flush_all()
+    self.assertEquals(200, util.follow_redirects('http://foo/bar').status_code)
+
   def test_registration_callback(self):
     """Run through an authorization back and forth and make sure that
     the external callback makes it all the way through.
@@ -299,16 +504,75 @@ class UtilTest(testutil.ModelsTest):
     self.assert_equals('http://withknown.com/bridgy_callback?result=declined',
                        resp.headers['location'])
 
+  def expect_closed(self, call):
+    """Expects the response from a mox requests call to be closed."""
+    raw = self.mox.CreateMockAnything()
+    raw.close()
+    raw.release_conn()
+    call._return_value.raw = raw
+
   def test_requests_get_too_big(self):
-    self.expect_requests_get(
+    self.expect_closed(self.expect_requests_get(
       'http://foo/bar', '',
-      response_headers={'Content-Length': str(util.MAX_HTTP_RESPONSE_SIZE + 1)})
+      response_headers={'Content-Length': str(util.MAX_HTTP_RESPONSE_SIZE + 1)}))
+    self.mox.ReplayAll()
+
+    resp = util.requests_get('http://foo/bar')
+    self.assertEquals(util.HTTP_REQUEST_REFUSED_STATUS_CODE, resp.status_code)
+    self.assertIn(' larger than our limit ', resp.content)
+
+  def test_requests_get_too_big_streaming(self):
+    self.mox.stubs.Set(util, 'MAX_HTTP_RESPONSE_SIZE', 10)
+    self.expect_closed(self.expect_requests_get('http://foo/bar', 'x' * 11))
+    self.expect_closed(self.expect_requests_get('http://foo/bar', 'x' * 11))
     self.mox.ReplayAll()
 
     resp = util.requests_get('http://foo/bar')
     self.assertEquals(util.HTTP_REQUEST_REFUSED_STATUS_CODE, resp.status_code)
     self.assertIn(' larger than our limit ', resp.content)
 
+    resp = util.requests_get('http://foo/bar', truncate=True)
+    self.assertEquals(200, resp.status_code)
+    self.assertEquals('x' * 10, resp.text)
+
+  def test_requests_get_stream(self):
+    self.mox.stubs.Set(util, 'MAX_HTTP_RESPONSE_SIZE', 10)
+    self.expect_closed(self.expect_requests_get('http://foo/bar', 'x' * 11))
+    self.expect_closed(self.expect_requests_get(
+      'http://foo/bar', '', response_headers={'Content-Length': '11'}))
+    self.mox.ReplayAll()
+    semaphore = util.host_semaphore('http://foo/bar')
+
+    # no Content-Length, so the caller gets the unread response, which holds
+    # its host slot until it's closed
+    resp = util.requests_get('http://foo/bar', stream=True)
+    self.assertEquals(200, resp.status_code)
+    self.assertEquals('x' * 11, resp.content)
+    self.assertTrue(semaphore.acquire(False))
+    self.assertFalse(semaphore.acquire(False))
+    semaphore.release()
+
+    util.close_response(resp)
+    self.assertTrue(semaphore.acquire(False))
+    self.assertTrue(semaphore.acquire(False))
+    semaphore.release()
+    semaphore.release()
+
+    # Content-Length is still checked, and the slot is released
+    resp = util.requests_get('http://foo/bar', stream=True)
+    self.assertEquals(util.HTTP_REQUEST_REFUSED_STATUS_CODE, resp.status_code)
+    self.assertTrue(semaphore.acquire(False))
+    self.assertTrue(semaphore.acquire(False))
+    semaphore.release()
+    semaphore.release()
+
+  def test_host_semaphores_bounded(self):
+    semaphores = set(util.host_semaphore('http://host%d/' % i)
+                     for i in range(util.HOST_SEMAPHORE_SHARDS * 2))
+    self.assertLessEqual(len(semaphores), util.HOST_SEMAPHORE_SHARDS)
+    self.assertIs(util.host_semaphore('http://FOO/x'),
+                  util.host_semaphore('http://foo/y'))
+
   def test_requests_get_content_length_not_int(self):
     self.expect_requests_get('http://foo/bar', 'xyz',
                              response_headers={'Content-Length': 'foo'})
@@ -323,6 +587,87 @@ class UtilTest(testutil.ModelsTest):
     self.assertEquals(util.HTTP_REQUEST_REFUSED_STATUS_CODE, resp.status_code)
     self.assertEquals('Sorry, Bridgy has blacklisted this URL.', resp.content)
 
+  def test_requests_post(self):
+    self.expect_requests_post('http://foo/bar', 'xyz', data={'a': 'b'})
+    self.mox.ReplayAll()
+
+    resp = util.requests_post('http://foo/bar', data={'a': 'b'})
+    self.assertEquals('xyz', resp.content)
+
+  def test_parse_html(self):
+    resp = requests.Response()
+    resp.url = 'http://foo/bar'
+    resp._content = """\
+<html><head><link rel="shortlink" href="/s"></head>
+<body><div class="h-entry"><p class="e-content">hi</p></div></body></html>"""
+    resp._content_consumed = True
+
+    parsed = util.parse_html(resp)
+    self.assertEquals('hi', parsed.doc.find(class_='e-content').text)
+    self.assertEquals(['h-entry'], parsed.mf2['items'][0]['type'])
+    self.assertEquals(['http://foo/s'], parsed.mf2['rels']['shortlink'])
+
+  def test_parse_html_cache_hit_parses_lazily(self):
+    html = '<div class="hentry"><p class="entry-content">hi</p></div>'
+    miss = util.parse_html(html, 'http://foo')
+    self.assertIn('h-entry', miss.doc.div['class'])
+
+    parsed = []
+    orig = util.bs4.BeautifulSoup
+    def beautifulsoup(input):
+      parsed.append(input)
+      return orig(input)
+    self.mox.stubs.Set(util.bs4, 'BeautifulSoup', beautifulsoup)
+
+    hit = util.parse_html(html, 'http://foo')
+    self.assertEquals(miss.mf2, hit.mf2)
+    self.assertEquals([], parsed)
+
+    # doc is parsed on demand, with the same changes mf2py makes on a miss
+    self.assertEquals(unicode(miss.doc), unicode(hit.doc))
+    self.assertEquals([html], parsed)
+
+  def test_mf2py_parse_cache(self):
+    html = '<div class="h-entry"><p class="e-content">hi</p></div>'
+    self.mox.StubOutWithMock(mf2py, 'parse')
+    mf2py.parse(url='http://foo', doc=mox.IgnoreArg()).AndReturn(
+      {'items': [{'type': ['h-entry']}]})
+    self.mox.ReplayAll()
+
+    expected = {'items': [{'type': ['h-entry']}]}
+    first = util.mf2py_parse(html, 'http://foo')
+    self.assertEquals(expected, first)
+    first['items'] = []
+
+    # in-process LRU, then memcache. each hit returns a new copy.
+    self.assertEquals(expected, util.mf2py_parse(html, 'http://foo'))
+    util.Mf2Cache.clear_lru()
+    self.assertEquals(expected, util.parse_html(html, 'http://foo').mf2)
+
+  def test_mf2py_parse_cache_unicode(self):
+    url = u'http://foo/✁'
+    html = u'<div class="h-entry"><p class="e-content">✁</p></div>'
+    for input in html, html.encode('utf-8'):
+      util.Mf2Cache.clear_lru()
+      parsed = util.mf2py_parse(input, url)
+      self.assertEquals(parsed, util.mf2py_parse(input, url))
+      self.assertEquals(parsed, util.parse_html(input, url).mf2)
+
+  def test_mf2py_parse_cache_lru_bytes(self):
+    self.mox.stubs.Set(util, 'MF2_LRU_BYTES', 100)
+    util.Mf2Cache.set('a', {'x': 'y' * 40})
+    util.Mf2Cache.set('b', {'x': 'y' * 40})
+    self.assertEquals(['a', 'b'], util._mf2_lru.keys())
+
+    # evicts the least recently used
+    util.Mf2Cache.set('c', {'x': 'y' * 40})
+    self.assertEquals(['b', 'c'], util._mf2_lru.keys())
+
+    # too big for the LRU by itself, so it only goes in memcache
+    util.Mf2Cache.set('d', {'x': 'y' * 200})
+    self.assertEquals(['b', 'c'], util._mf2_lru.keys())
+    self.assertEquals({'x': 'y' * 200}, util.Mf2Cache.get('d'))
+
   def test_in_webmention_blacklist(self):
     for bad in 't.co', 'x.t.co', 'x.y.t.co', 'abc.onion':
       self.assertTrue(util.in_webmention_blacklist(bad), bad)
@@ -352,3 +697,121 @@ class UtilTest(testutil.ModelsTest):
 
     self.assertEquals(102, memcache.get('timed foo'))
     self.assertEquals(3, memcache.get('timed foo size'))
+
+  def test_add_propagate_tasks(self):
+    self.mox.stubs.Set(util, 'PROPAGATE_BATCH_SIZE', 4)
+    self.responses[4].unsent = ['http://other/post']
+    util.add_propagate_tasks(self.responses)
+
+    keys = [r.key.urlsafe() for r in self.responses]
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertItemsEqual(
+      [keys[:4], keys[5:9], [keys[4]]],
+      [testutil.get_task_response_keys([task]) for task in tasks])
+
+  def test_run_in_threads(self):
+    util.MAX_THREADS = 3
+    self.assertEquals([], util.run_in_threads([]))
+    self.assertEquals([0, 2, 4, 6, 8], util.run_in_threads(
+      [lambda i=i: i * 2 for i in range(5)], max_threads=2))
+
+  def test_run_in_threads_nested_runs_serially(self):
+    util.MAX_THREADS = 3
+    outer = threading.current_thread()
+
+    def inner():
+      self.assertNotEqual(outer, threading.current_thread())
+      worker = threading.current_thread()
+      return util.run_in_threads(
+        [lambda: threading.current_thread() == worker] * 3)
+
+    self.assertEquals([[True] * 3] * 2, util.run_in_threads([inner, inner]))
+
+  def test_run_in_threads_raises(self):
+    util.MAX_THREADS = 3
+
+    def fail():
+      raise ValueError('foo')
+
+    with self.assertRaises(ValueError):
+      util.run_in_threads((lambda: 1, fail, lambda: 3))
+
+  def test_take_token(self):
+    self.assertEquals(0, util.take_token('foo', 2, .1))
+    self.assertEquals(0, util.take_token('foo', 2, .1))
+    self.assertAlmostEqual(10, util.take_token('foo', 2, .1), delta=.1)
+    # other buckets are independent
+    self.assertEquals(0, util.take_token('bar', 2, .1))
+
+    # refills over time
+    tokens, updated = memcache.get('TB foo')
+    memcache.set('TB foo', (tokens, updated - 5))
+    self.assertAlmostEqual(5, util.take_token('foo', 2, .1), delta=.1)
+    memcache.set('TB foo', (tokens, updated - 10))
+    self.assertEquals(0, util.take_token('foo', 2, .1))
+
+  def test_take_token_multiple(self):
+    self.assertEquals(0, util.take_token('foo', 5, .1, tokens=3))
+    self.assertAlmostEqual(10, util.take_token('foo', 5, .1, tokens=3),
+                           delta=.1)
+    # not forced, so nothing was taken
+    self.assertEquals(0, util.take_token('foo', 5, .1, tokens=2))
+
+  def test_take_token_force(self):
+    self.assertEquals(0, util.take_token('foo', 2, .1, tokens=3, force=True))
+    self.assertAlmostEqual(-1, memcache.get('TB foo')[0], delta=.1)
+    self.assertEquals(0, util.take_token('foo', 2, .1, tokens=5, force=True))
+    # debt is capped at -capacity
+    self.assertAlmostEqual(-2, memcache.get('TB foo')[0], delta=.1)
+    self.assertAlmostEqual(30, util.take_token('foo', 2, .1), delta=.1)
+
+  def test_host_shard(self):
+    shard = util.HostShard('foo.com')
+    self.assertIsNone(shard.leased())
+    self.assertTrue(shard.lease())
+    self.assertIsNotNone(shard.leased())
+    self.assertFalse(util.HostShard('foo.com').lease())
+    self.assertTrue(util.HostShard('bar.com').lease())
+
+    shard.release()
+    self.assertTrue(util.HostShard('foo.com').lease())
+
+    self.assertEquals(0, shard.backlog())
+    shard.defer(3)
+    shard.defer(2)
+    util.HostShard('bar.com').defer(1)
+    self.assertEquals(5, shard.backlog())
+    self.assertEquals(['bar.com', 'foo.com'], util.HostShard.recent_hosts())
+
+  def test_circuit_breaker(self):
+    breaker = util.CircuitBreaker('foo')
+    self.assertEquals('closed', breaker.state())
+    for _ in range(util.CIRCUIT_BREAKER_FAILURES - 1):
+      self.assertTrue(breaker.allow())
+      breaker.failure()
+    self.assertEquals('closed', breaker.state())
+
+    breaker.failure()
+    self.assertEquals('open', breaker.state())
+    self.assertFalse(breaker.allow())
+    self.assertFalse(util.CircuitBreaker('bar').state() == 'open')
+    self.assertEquals(['foo'], util.CircuitBreaker.recent_names())
+
+    def half_open():
+      memcache.set('CBO foo', time.time() - util.CIRCUIT_BREAKER_OPEN_TIME - 1)
+
+    # failed probe reopens
+    half_open()
+    probe = util.CircuitBreaker('foo')
+    self.assertTrue(probe.allow())
+    self.assertFalse(util.CircuitBreaker('foo').allow())  # probe in flight
+    probe.failure()
+    self.assertEquals('open', breaker.state())
+
+    # successful probe closes
+    half_open()
+    probe = util.CircuitBreaker('foo')
+    self.assertTrue(probe.allow())
+    probe.success()
+    self.assertEquals('closed', breaker.state())
+    self.assertTrue(breaker.allow())
@@ -3,18 +3,21 @@
 
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
+import base64
 import copy
 import datetime
 import json
 import logging
 import urllib
+import urlparse
 
 import appengine_config
 
 from granary import source as gr_source
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
-from models import BlogPost, Publish, PublishedPage, Response, Source
+from models import (ActivitiesCache, BlogPost, Publish, PublishedPage, Response,
+                    Source, WebmentionEndpointCache)
 from oauth_dropins.models import BaseAuth
 from oauth_dropins.webutil import testutil
 # mirror some methods from webutil.testutil
@@ -27,6 +30,15 @@ import util
 NOW = datetime.datetime.utcnow()
 
 
+def get_task_response_keys(tasks):
+  """Returns all of the response_key params in propagate tasks, in order.
+
+  Unlike get_task_params(), includes every value of repeated params.
+  """
+  return [key for task in tasks for key in
+          urlparse.parse_qs(base64.b64decode(task['body']))['response_key']]
+
+
 class FakeAuthEntity(BaseAuth):
   user_json = ndb.TextProperty()
 
@@ -191,6 +203,12 @@ class HandlerTest(testutil.HandlerTest):
     self.handler = util.Handler(self.request, self.response)
     FakeGrSource.clear()
     util.now_fn = lambda: NOW
+    # run "concurrent" work serially so that mock expectations stay in order
+    util.MAX_THREADS = 1
+    ActivitiesCache.clear_lru()
+    WebmentionEndpointCache.clear_lru()
+    util.RedirectCache.clear_lru()
+    util.Mf2Cache.clear_lru()
 
     # we use global queries in tests to verify entities in the datastore, so
     # make the datastore stub always return consistent data. not ideal, since it
@@ -214,6 +232,7 @@ class HandlerTest(testutil.HandlerTest):
 
   def expect_webmention_requests_get(self, *args, **kwargs):
     kwargs.setdefault('headers', {}).update(util.USER_AGENT_HEADER)
+    kwargs['stream'] = True  # util.WebmentionSend streams discovery fetches
     return super(HandlerTest, self).expect_requests_get(*args, **kwargs)
 
   def expect_requests_post(self, *args, **kwargs):
@@ -224,6 +243,12 @@ class HandlerTest(testutil.HandlerTest):
     kwargs.setdefault('headers', {}).update(util.USER_AGENT_HEADER)
     return super(HandlerTest, self).expect_requests_head(*args, **kwargs)
 
+  def _expect_requests_call(self, *args, **kwargs):
+    call = super(HandlerTest, self)._expect_requests_call(*args, **kwargs)
+    # the fake response has no raw stream, so make iter_content() read content
+    call._return_value._content_consumed = True
+    return call
+
 
 class ModelsTest(HandlerTest):
   """Sets up some test sources and responses.
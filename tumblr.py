@@ -135,7 +135,7 @@ class Tumblr(models.Source):
     if self.verified():
       return
 
-    super(Tumblr, self).verify(force=True)
+    super(Tumblr, self).verify(force=True, full_html=not self.disqus_shortname)
 
     html = getattr(self, '_fetched_html', None)  # set by Source.verify()
     if not self.disqus_shortname and html:
@@ -206,7 +206,7 @@ class Tumblr(models.Source):
     """Makes a Disqus API call.
 
     Args:
-      method: requests function to use, e.g. requests.get
+      method: util function to use, e.g. util.requests_get
       url: string
       params: query parameters
       kwargs: passed through to method
@@ -219,7 +219,6 @@ class Tumblr(models.Source):
         'api_secret': appengine_config.DISQUS_API_SECRET,
         'access_token': appengine_config.DISQUS_ACCESS_TOKEN,
         })
-    kwargs.setdefault('headers', {}).update(util.USER_AGENT_HEADER)
     resp = method(url, params=params, **kwargs)
     resp.raise_for_status()
     resp = resp.json().get('response', {})
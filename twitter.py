@@ -42,6 +42,15 @@ class Twitter(models.Source):
   # new hits /statuses/user_timeline and /search/tweets once each. Both
   # allow 180 calls per window before they're rate limited.
   # https://dev.twitter.com/docs/rate-limiting/1.1/limits
+  #
+  # The limits are per user access token, so each source gets its own token
+  # bucket. Polls are charged for every call they make, including granary's
+  # extra calls for retweets and mentions. Allow half of a window's worth of
+  # calls, since they're spread across endpoints.
+  API_TOKEN_BUCKET = (90, 90. / (15 * 60))
+
+  def api_token_bucket_name(self):
+    return 'twitter ' + self.key.id()
 
   @staticmethod
   def new(handler, auth_entity=None, **kwargs):
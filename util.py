@@ -6,8 +6,13 @@ import collections
 import Cookie
 import contextlib
 import datetime
+import hashlib
+import itertools
 import json
+import random
 import re
+import sys
+import threading
 import time
 import urllib
 import urlparse
@@ -18,10 +23,14 @@ from appengine_config import DEBUG
 import bs4
 from granary import source as gr_source
 import mf2py
+from mf2py import backcompat as mf2py_backcompat
+from mf2py import temp_fixes as mf2py_temp_fixes
 from oauth_dropins.webutil import handlers as webutil_handlers
 from oauth_dropins.webutil.models import StringIdModel
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import *
+import requests
+from webmentiontools import send
 
 from google.appengine.api import mail
 from google.appengine.api import memcache
@@ -74,9 +83,87 @@ with open('beta_users.txt') as f:
 # http://httparchive.org/interesting.php#bytesperpage
 MAX_HTTP_RESPONSE_SIZE = 500000
 
+# requests_get() and WebmentionSend read response bodies this many bytes at a
+# time.
+HTTP_CHUNK_SIZE = 8192
+HEAD_END_RE = re.compile(r'</head\s*>', re.I)
+
 # Returned as the HTTP status code when we refuse to make or finish a request.
 HTTP_REQUEST_REFUSED_STATUS_CODE = 599
 
+# The fields that granary's Source.activity_changed() compares, on both an
+# activity and its object. Used by response_fingerprint().
+ACTIVITY_CHANGED_FIELDS = ('objectType', 'verb', 'to', 'content', 'location',
+                           'image')
+
+# Upper bound on the number of worker threads that run_in_threads() starts.
+# Unit tests set this to 1 so that calls, and mocks, happen in a deterministic
+# order. Calls from inside a worker thread run serially, so nested calls don't
+# multiply the number of threads in a request past App Engine's limit of 50.
+MAX_THREADS = 10
+_run_in_threads_local = threading.local()
+
+# Maximum number of outbound HTTP requests that this instance will have in
+# flight to any single host at once. Enforced by host_limit().
+# Hosts hash into a fixed number of shards, so memory stays bounded no matter
+# how many hosts we see. Hosts that collide share a limit, which only makes it
+# stricter.
+MAX_REQUESTS_PER_HOST = 2
+HOST_SEMAPHORE_SHARDS = 512
+_host_semaphores = [threading.BoundedSemaphore(MAX_REQUESTS_PER_HOST)
+                    for _ in range(HOST_SEMAPHORE_SHARDS)]
+
+# Number of memcache compare-and-set attempts take_token() and CircuitBreaker
+# make before they give up.
+MEMCACHE_CAS_RETRIES = 5
+
+# Circuit breakers open after this many failures within the same window of
+# CIRCUIT_BREAKER_WINDOW seconds, stay open for CIRCUIT_BREAKER_OPEN_TIME
+# seconds, and then let a single probe call through at a time, every
+# CIRCUIT_BREAKER_PROBE_TIME seconds at most, until one succeeds.
+CIRCUIT_BREAKER_FAILURES = 5
+CIRCUIT_BREAKER_WINDOW = 60
+CIRCUIT_BREAKER_OPEN_TIME = 5 * 60
+CIRCUIT_BREAKER_PROBE_TIME = 60
+# memcache key for the names of recently opened circuit breakers
+CIRCUIT_BREAKER_NAMES_KEY = 'CB names'
+MAX_CIRCUIT_BREAKER_NAMES = 100
+
+# Across all instances, propagate tasks send at most one webmention at a time
+# to any single host. See HostShard. Leases expire after HOST_SHARD_LEASE_TIME
+# seconds in case a task dies while holding one. Tasks retry targets on busy
+# hosts after about HOST_SHARD_RETRY_DELAY seconds. Deferred targets are
+# counted per host in windows of HOST_SHARD_WINDOW seconds.
+HOST_SHARD_LEASE_TIME = 10 * 60
+HOST_SHARD_RETRY_DELAY = 60
+HOST_SHARD_WINDOW = 60 * 60
+# memcache key for the hosts that recently had targets deferred
+HOST_SHARD_NAMES_KEY = 'HS hosts'
+MAX_HOST_SHARD_NAMES = 100
+
+# follow_redirects() caches resolved URLs in this process, in front of
+# memcache, for REDIRECT_LRU_TIME seconds. If resolving failed, e.g. if the DNS
+# lookup failed, it caches the failure for REDIRECT_FAIL_TIME seconds, both in
+# memcache and in this process, and then tries again. See RedirectCache.
+REDIRECT_LRU_SIZE = 5000
+REDIRECT_LRU_TIME = 60 * 60
+REDIRECT_FAIL_TIME = 5 * 60
+_redirect_lru = collections.OrderedDict()
+_redirect_lru_lock = threading.Lock()
+
+# mf2py_parse() caches results by URL and a hash of the HTML, in memcache for
+# MF2_CACHE_TIME seconds and in this process for up to MF2_LRU_BYTES of JSON.
+# See Mf2Cache.
+MF2_CACHE_TIME = 6 * 60 * 60
+MF2_LRU_BYTES = 4 * 1000 * 1000
+_mf2_lru = collections.OrderedDict()
+_mf2_lru_bytes = 0
+_mf2_lru_lock = threading.Lock()
+
+# add_propagate_tasks() puts up to this many responses from the same source
+# that send to the same hosts into a single propagate task.
+PROPAGATE_BATCH_SIZE = 10
+
 # Unpacked representation of logged in account in the logins cookie.
 Login = collections.namedtuple('Login', ('site', 'name', 'path'))
 
@@ -97,7 +184,18 @@ def add_poll_task(source, now=False, **kwargs):
   Note the constant. The string 'default' works in dev_appserver, but routes to
   default.brid-gy.appspot.com in prod instead of brid.gy, which breaks SSL
   because appspot.com doesn't have a third-level wildcard cert.
+
+  If the source's recent polls have failed, regular poll tasks are delayed by
+  at least its Source.poll_backoff(), +/- 20% jitter. Poll-now tasks aren't.
   """
+  if not now:
+    backoff = source.poll_backoff().total_seconds()
+    if backoff:
+      backoff *= random.uniform(.8, 1.2)
+      if backoff > kwargs.get('countdown', 0):
+        logging.info('Backing off after %d poll failures', source.poll_failures)
+        kwargs['countdown'] = backoff
+
   last_polled_str = source.last_polled.strftime(POLL_TASK_DATETIME_FORMAT)
   queue = 'poll-now' if now else 'poll'
   task = taskqueue.add(queue_name=queue,
@@ -117,6 +215,36 @@ def add_propagate_task(entity, **kwargs):
   logging.info('Added propagate task: %s', task.name)
 
 
+def add_propagate_tasks(entities):
+  """Adds propagate tasks for many response entities in batched queue calls.
+
+  Responses from the same source with targets on the same hosts, e.g. many
+  likes of the same post, share tasks, up to PROPAGATE_BATCH_SIZE responses per
+  task. Each task then sends all of its responses' webmentions to each host in
+  one run. See tasks.PropagateResponse.
+
+  Args:
+    entities: sequence of Response
+  """
+  groups = collections.OrderedDict()
+  for e in entities:
+    hosts = frozenset(domain_from_link(url) for url in e.unsent + e.error)
+    groups.setdefault((e.source, hosts), []).append(e)
+
+  tasks = []
+  for group in groups.values():
+    for i in range(0, len(group), PROPAGATE_BATCH_SIZE):
+      keys = [e.key.urlsafe() for e in group[i:i + PROPAGATE_BATCH_SIZE]]
+      tasks.append(taskqueue.Task(params={'response_key': keys},
+                                  target=taskqueue.DEFAULT_APP_VERSION))
+
+  queue = taskqueue.Queue('propagate')
+  for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+  logging.info('Added %d propagate tasks for %d responses', len(tasks),
+               len(entities))
+
+
 def add_propagate_blogpost_task(entity, **kwargs):
   """Adds a propagate-blogpost task for the given response entity.
   """
@@ -137,6 +265,282 @@ def webmention_endpoint_cache_key(url):
   return ' '.join(('W', scheme, domain))
 
 
+def run_in_threads(fns, max_threads=None):
+  """Calls functions concurrently in a bounded number of threads.
+
+  App Engine's python27 runtime allows threads inside a request as long as they
+  finish before the request does, which they do here since we join them all.
+
+  Args:
+    fns: sequence of callables that take no arguments
+    max_threads: integer, maximum number of threads to start. Capped at
+      MAX_THREADS.
+
+  Returns: list of the functions' return values, in the same order as fns
+
+  Raises: the first exception raised by any of the functions, with its original
+    traceback. Functions that haven't started yet when that happens are skipped.
+  """
+  fns = list(fns)
+  num_threads = min(len(fns), max_threads or MAX_THREADS, MAX_THREADS)
+  if num_threads <= 1 or getattr(_run_in_threads_local, 'in_worker', False):
+    return [fn() for fn in fns]
+
+  results = [None] * len(fns)
+  errors = []
+  todo = collections.deque(enumerate(fns))  # popleft() is thread safe
+
+  def worker():
+    _run_in_threads_local.in_worker = True
+    while todo and not errors:
+      try:
+        i, fn = todo.popleft()
+      except IndexError:
+        return
+      try:
+        results[i] = fn()
+      except BaseException:
+        errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=worker) for _ in xrange(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    type, value, tb = errors[0]
+    raise type, value, tb
+
+  return results
+
+
+@contextlib.contextmanager
+def host_limit(url):
+  """Blocks until fewer than MAX_REQUESTS_PER_HOST requests to url's host are
+  in flight from this instance, then holds a slot while the block runs.
+
+  Keeps concurrent fetches, e.g. parallel original post discovery, from piling
+  onto a single small personal web site.
+  """
+  with host_semaphore(url):
+    yield
+
+
+def host_semaphore(url):
+  """Returns the semaphore shard that host_limit() uses for url's host."""
+  host = urlparse.urlparse(url).netloc.lower()
+  return _host_semaphores[hash(host) % HOST_SEMAPHORE_SHARDS]
+
+
+def take_token(name, capacity, rate, tokens=1, force=False):
+  """Takes tokens from a token bucket in memcache, shared by all instances.
+
+  The bucket starts full, holds at most capacity tokens, and refills at rate
+  tokens per second. Updates are atomic via memcache compare-and-set. If
+  memcache is unavailable or too contended, fails open and allows the call.
+
+  Args:
+    name: string, bucket name, e.g. silo and app key
+    capacity: integer
+    rate: float, tokens per second
+    tokens: integer, number of tokens to take
+    force: boolean, whether to take the tokens even if the bucket doesn't have
+      enough, e.g. to charge for calls that were already made. The bucket goes
+      into debt, down to -capacity, which later calls then wait for.
+
+  Returns: 0 if the tokens were taken, otherwise float seconds until they will
+    be available
+  """
+  client = memcache.Client()
+  key = 'TB ' + name
+  # expire idle buckets once they'd be full again anyway, even from max debt
+  expiration = int(2 * capacity / rate) + 1
+
+  for _ in range(MEMCACHE_CAS_RETRIES):
+    now = time.time()
+    bucket = client.gets(key)
+    if bucket is None:
+      if client.add(key, (max(capacity - tokens, -capacity), now),
+                    time=expiration):
+        return 0
+      continue
+
+    available, updated = bucket
+    available = min(capacity, available + (now - updated) * rate)
+    if available < tokens and not force:
+      return (tokens - available) / rate
+    if client.cas(key, (max(available - tokens, -capacity), now),
+                  time=expiration):
+      return 0
+
+  logging.warning("Couldn't update token bucket %s, allowing call", name)
+  return 0
+
+
+class CircuitBreaker(object):
+  """A circuit breaker around a silo API or remote host, shared via memcache.
+
+  Closed normally. Opens after CIRCUIT_BREAKER_FAILURES failures in a
+  CIRCUIT_BREAKER_WINDOW, and disallows calls until CIRCUIT_BREAKER_OPEN_TIME
+  has passed. Then it's half open and allows one probe call at a time. A
+  successful probe closes it; a failed one opens it again.
+
+  Usage: check allow() before making calls, then report the outcome with
+  success() or failure().
+
+  Attributes:
+    name: string, e.g. silo short name or 'webmention HOST'
+    probing: boolean, whether allow() let a half open probe through
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.probing = False
+
+  def _key(self, prefix):
+    return 'CB%s %s' % (prefix, self.name)
+
+  def _failures_key(self, now):
+    return '%s %d' % (self._key('F'), int(now / CIRCUIT_BREAKER_WINDOW))
+
+  def opened(self):
+    """Returns the POSIX timestamp when this breaker last opened, or None."""
+    return memcache.get(self._key('O'))
+
+  def state(self):
+    """Returns 'closed', 'open', or 'half-open'."""
+    opened = self.opened()
+    if opened is None:
+      return 'closed'
+    return ('open' if time.time() < opened + CIRCUIT_BREAKER_OPEN_TIME
+            else 'half-open')
+
+  def allow(self):
+    """Returns True if a call is allowed now, False otherwise."""
+    state = self.state()
+    if state == 'closed':
+      return True
+    elif state == 'half-open' and memcache.add(self._key('P'), 1,
+                                                time=CIRCUIT_BREAKER_PROBE_TIME):
+      logging.info('Circuit breaker %s is half open, probing', self.name)
+      self.probing = True
+      return True
+
+    logging.info('Circuit breaker %s is %s', self.name, state)
+    return False
+
+  def retry_after(self):
+    """Returns seconds until a call might be allowed again."""
+    opened = self.opened()
+    if opened is None:
+      return 0
+    return max(opened + CIRCUIT_BREAKER_OPEN_TIME - time.time(),
+               CIRCUIT_BREAKER_PROBE_TIME)
+
+  def success(self):
+    if self.probing:
+      logging.info('Probe succeeded, closing circuit breaker %s', self.name)
+      memcache.delete_multi([self._key('O'), self._key('P')])
+      self.probing = False
+
+  def failure(self):
+    now = time.time()
+    if self.probing:
+      self._open(now)
+      self.probing = False
+      return
+
+    key = self._failures_key(now)
+    memcache.add(key, 0, time=CIRCUIT_BREAKER_WINDOW * 2)
+    failures = memcache.incr(key)
+    if failures >= CIRCUIT_BREAKER_FAILURES and self.opened() is None:
+      self._open(now)
+
+  def _open(self, now):
+    logging.warning('Opening circuit breaker %s', self.name)
+    memcache.set(self._key('O'), now)
+    memcache.delete(self._key('P'))
+
+    _add_recent_name(CIRCUIT_BREAKER_NAMES_KEY, self.name,
+                     MAX_CIRCUIT_BREAKER_NAMES)
+
+  @staticmethod
+  def recent_names():
+    """Returns the names of recently opened circuit breakers, newest first."""
+    return memcache.get(CIRCUIT_BREAKER_NAMES_KEY) or []
+
+
+class HostShard(object):
+  """Serializes webmention sends to a single host across all instances.
+
+  Propagate tasks for different hosts run in parallel, but only the task that
+  holds a host's lease may send to it. Others defer their targets for that host
+  and retry later. Deferred targets are counted so that we can see which
+  receivers are backed up.
+
+  Attributes:
+    host: string domain
+  """
+
+  def __init__(self, host):
+    self.host = host
+
+  def _key(self, prefix):
+    return 'HS%s %s' % (prefix, self.host)
+
+  def _backlog_key(self, now):
+    return '%s %d' % (self._key('B'), int(now / HOST_SHARD_WINDOW))
+
+  def lease(self):
+    """Returns True if we got the lease on this host, False otherwise.
+
+    Fails open if memcache is unavailable.
+    """
+    key = self._key('L')
+    return (memcache.add(key, time.time(), time=HOST_SHARD_LEASE_TIME) or
+            memcache.get(key) is None)
+
+  def release(self):
+    memcache.delete(self._key('L'))
+
+  def leased(self):
+    """Returns the POSIX timestamp when this host was leased, or None."""
+    return memcache.get(self._key('L'))
+
+  def defer(self, num_targets):
+    """Records that num_targets targets are waiting on this host."""
+    key = self._backlog_key(time.time())
+    memcache.add(key, 0, time=HOST_SHARD_WINDOW * 2)
+    memcache.incr(key, delta=num_targets)
+    _add_recent_name(HOST_SHARD_NAMES_KEY, self.host, MAX_HOST_SHARD_NAMES)
+
+  def backlog(self):
+    """Returns the number of targets deferred in the current window."""
+    return memcache.get(self._backlog_key(time.time())) or 0
+
+  @staticmethod
+  def recent_hosts():
+    """Returns the hosts that recently had targets deferred, newest first."""
+    return memcache.get(HOST_SHARD_NAMES_KEY) or []
+
+
+def _add_recent_name(key, name, max_names):
+  """Adds a name to the front of a list in memcache, atomically."""
+  client = memcache.Client()
+  for _ in range(MEMCACHE_CAS_RETRIES):
+    names = client.gets(key)
+    if names is None:
+      if client.add(key, [name]):
+        return
+      continue
+    if name in names:
+      return
+    names = ([name] + names)[:max_names]
+    if client.cas(key, names):
+      return
+
+
 def email_me(**kwargs):
   """Thin wrapper around mail.send_mail() that handles errors."""
   try:
@@ -146,15 +550,30 @@ def email_me(**kwargs):
     logging.warning('Error sending notification email', exc_info=True)
 
 
-def requests_get(url, **kwargs):
+def requests_get(url, truncate=False, **kwargs):
   """Wraps requests.get with extra semantics and our user agent.
 
-  If a server tells us a response will be too big (based on Content-Length), we
-  hijack the response and return 599 and an error response body instead. We pass
-  stream=True to requests.get so that it doesn't fetch the response body until
-  we access response.content (or .text).
+  If a response is too big, we hijack it and return 599 and an error response
+  body instead. We check Content-Length first, if it's there, and then read the
+  body in chunks and stop as soon as it's over MAX_HTTP_RESPONSE_SIZE, so that
+  chunked responses can't blow up our memory either.
+
+  Note that this reads every body into memory, up to MAX_HTTP_RESPONSE_SIZE,
+  regardless of content type, e.g. images and other non-HTML files. Callers
+  that don't want that can pass stream=True, which only checks Content-Length
+  and returns the response unread. They then have to read it and
+  close_response() it themselves. The response holds its host_limit() slot
+  until close_response(), so callers must always call it, even after reading
+  the whole body.
 
   http://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
+
+  Args:
+    url: string
+    truncate: boolean. If True, instead of refusing responses that are too big,
+      returns just their first MAX_HTTP_RESPONSE_SIZE bytes, e.g. for callers
+      that only need the top of an HTML page.
+    kwargs: passed through to requests.get. stream=True is described above.
   """
   if url in URL_BLACKLIST:
     resp = requests.Response()
@@ -162,28 +581,311 @@ def requests_get(url, **kwargs):
     resp._text = resp._content = 'Sorry, Bridgy has blacklisted this URL.'
     return resp
 
+  stream = kwargs.pop('stream', False)
   kwargs.setdefault('headers', {}).update(USER_AGENT_HEADER)
-  resp = util.requests_get(url, stream=True, **kwargs)
+  semaphore = host_semaphore(url)
+  semaphore.acquire()
+  try:
+    resp = util.requests_get(url, stream=True, **kwargs)
+
+    length = resp.headers.get('Content-Length', 0)
+    if (not truncate and util.is_int(length) and
+        int(length) > MAX_HTTP_RESPONSE_SIZE):
+      close_response(resp)
+      resp.status_code = HTTP_REQUEST_REFUSED_STATUS_CODE
+      resp._text = resp._content = ('Content-Length %s is larger than our limit %s.' %
+                                    (length, MAX_HTTP_RESPONSE_SIZE))
+      resp._content_consumed = True
+      return resp
+
+    if stream:
+      # close_response() releases the slot once the caller is done reading.
+      resp._host_semaphore = semaphore
+      semaphore = None
+      return resp
+
+    chunks = []
+    size = 0
+    for chunk in resp.iter_content(HTTP_CHUNK_SIZE):
+      chunks.append(chunk)
+      size += len(chunk)
+      if size > MAX_HTTP_RESPONSE_SIZE:
+        close_response(resp)
+        break
+  finally:
+    if semaphore:
+      semaphore.release()
+
+  content = ''.join(chunks)
+  if size > MAX_HTTP_RESPONSE_SIZE:
+    if truncate:
+      logging.info('Truncating %s after %s bytes', url, MAX_HTTP_RESPONSE_SIZE)
+      content = content[:MAX_HTTP_RESPONSE_SIZE]
+    else:
+      resp.status_code = HTTP_REQUEST_REFUSED_STATUS_CODE
+      content = ('Response is larger than our limit %s.' %
+                 MAX_HTTP_RESPONSE_SIZE)
+
+  resp._content = content
+  resp._content_consumed = True
+  return resp
 
-  length = resp.headers.get('Content-Length', 0)
-  if util.is_int(length) and int(length) > MAX_HTTP_RESPONSE_SIZE:
-    resp.status_code = HTTP_REQUEST_REFUSED_STATUS_CODE
-    resp._text = resp._content = ('Content-Length %s is larger than our limit %s.' %
-                                  (length, MAX_HTTP_RESPONSE_SIZE))
 
-  return resp
+def close_response(resp):
+  """Closes a streamed requests.Response and releases its connection.
+
+  Needed when we stop reading a streamed response before the end, since
+  requests only releases the connection once the body is fully read. Also
+  releases the host_limit() slot of a response from requests_get(stream=True).
+  """
+  semaphore = getattr(resp, '_host_semaphore', None)
+  if semaphore:
+    resp._host_semaphore = None
+    semaphore.release()
+
+  raw = getattr(resp, 'raw', None)
+  if raw is not None:
+    raw.close()
+    release_conn = getattr(raw, 'release_conn', None)
+    if release_conn:
+      release_conn()
+
+
+def requests_post(url, **kwargs):
+  """Wraps requests.post with our user agent and per-host limit.
+
+  Outbound POSTs should use this, just like GETs should use requests_get().
+  """
+  kwargs.setdefault('headers', {}).update(USER_AGENT_HEADER)
+  with host_limit(url):
+    return util.requests_post(url, **kwargs)
+
+
+class WebmentionSend(send.WebmentionSend):
+  """webmentiontools' WebmentionSend with cheaper endpoint discovery.
+
+  Checks the Link header first, and doesn't download the body at all if it has
+  an endpoint or if the response isn't HTML. Otherwise, streams the HTML and
+  stops at the end of <head> if the endpoint is there, or after
+  MAX_HTTP_RESPONSE_SIZE bytes.
+
+  Attributes:
+    full_html: boolean, whether to keep reading after </head> even if it has an
+      endpoint, e.g. to look for other things in the HTML afterward
+    html: string HTML that discovery read, possibly truncated
+  """
+  full_html = False
+  html = None
+
+  def _discoverEndpoint(self):
+    kwargs = dict(self.requests_kwargs)
+    kwargs.setdefault('headers', {}).update(USER_AGENT_HEADER)
+    with host_limit(self.target_url):
+      resp = requests.get(self.target_url, stream=True, verify=False, **kwargs)
+      try:
+        self._discover_in_response(resp)
+      finally:
+        close_response(resp)
+
+  def _notifyReceiver(self):
+    # webmentiontools' WebmentionSend is an old-style class, so no super()
+    with host_limit(self.receiver_endpoint):
+      return send.WebmentionSend._notifyReceiver(self)
+
+  def _discover_in_response(self, resp):
+    if resp.status_code != 200:
+      self.error = {
+        'code': 'BAD_TARGET_URL',
+        'error_description': 'Unable to get target URL.',
+        'request': 'GET %s' % self.target_url,
+        'http_status': resp.status_code,
+      }
+      return
+
+    for link in resp.headers.get('link', '').split(','):
+      match = self.LINK_HEADER_RE.search(link)
+      if match:
+        self.receiver_endpoint = urlparse.urljoin(self.target_url, match.group(1))
+        return
+
+    content_type = resp.headers.get('content-type')
+    if content_type and content_type.split(';')[0].strip() not in (
+        'text/html', 'application/xhtml+xml'):
+      self.error = {
+        'code': 'BAD_TARGET_URL',
+        'error_description': 'Target is %s, not HTML.' % content_type,
+        'request': 'GET %s' % self.target_url,
+        'http_status': 204,  # so that we skip it
+      }
+      return
+
+    html = ''
+    # once we've searched <head>, the index where the rest of the HTML starts,
+    # so that we don't parse <head> twice
+    body_start = 0
+    found = False
+    for chunk in resp.iter_content(HTTP_CHUNK_SIZE):
+      start = max(len(html) - len('</head >'), 0)
+      html += chunk
+      if not body_start and not self.full_html:
+        head_end = HEAD_END_RE.search(html, start)
+        if head_end:
+          body_start = head_end.end()
+          found = self._find_endpoint(html[:body_start])
+          if found:
+            break
+      if len(html) >= MAX_HTTP_RESPONSE_SIZE:
+        logging.info('Stopped reading %s after %s bytes', self.target_url,
+                     len(html))
+        break
+
+    self.html = html
+    if not found and not self._find_endpoint(html[body_start:]):
+      self.error = {
+        'code': 'NO_ENDPOINT',
+        'error_description': 'Unable to discover webmention endpoint.'
+      }
+
+  def _find_endpoint(self, html):
+    """Looks for a rel=webmention link or a tag in HTML.
+
+    Sets self.receiver_endpoint and returns True if found, False otherwise.
+    """
+    soup = bs4.BeautifulSoup(html)
+    for name, rel in itertools.product(('link', 'a'),
+                                       ('webmention', 'http://webmention.org/')):
+      tag = soup.find(name, attrs={'rel': rel})
+      if tag and tag.get('href'):
+        # add the base scheme and host to relative endpoints
+        self.receiver_endpoint = urlparse.urljoin(self.target_url, tag['href'])
+        return True
+    return False
+
+
+class RedirectCache(object):
+  """Caches follow_redirects() results in this process, in front of memcache.
+
+  Implements the subset of the memcache API that webutil's follow_redirects()
+  uses. The in-process LRU stores each result's final URL, status code, and
+  headers, and returns a new requests.Response for every hit, so that callers
+  don't share them.
+
+  get() and get_multi() remember which keys were and weren't cached, and get()
+  then returns the hits directly and skips memcache for the misses.
+
+  Failures are only cached in memcache and the LRU for REDIRECT_FAIL_TIME after
+  they're resolved. We can't tell how long a failure from memcache has left,
+  so those don't go into the LRU, which would extend their lifetime.
+  """
+
+  def __init__(self):
+    self.hits = {}
+    self.misses = set()
+
+  @staticmethod
+  def clear_lru():
+    """Clears the in-process cache. Mostly for unit tests."""
+    with _redirect_lru_lock:
+      _redirect_lru.clear()
+
+  @staticmethod
+  def _now():
+    return time.time()
+
+  def get(self, key):
+    resolved = self.hits.get(key) or self._get_lru(key)
+    if resolved is None and key not in self.misses:
+      resolved = memcache.get(key)
+      if resolved is not None:
+        self._set_lru(self._successes({key: resolved}))
+      else:
+        self.misses.add(key)
+    return resolved
+
+  def get_multi(self, keys):
+    """Looks up many keys at once, with at most one memcache call.
+
+    Returns: dict mapping key to requests.Response. Misses aren't included.
+    """
+    found = {}
+    for key in keys:
+      resolved = self._get_lru(key)
+      if resolved is not None:
+        found[key] = resolved
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+      hits = memcache.get_multi(missing)
+      self._set_lru(self._successes(hits))
+      found.update(hits)
+      self.misses.update(key for key in missing if key not in hits)
+
+    self.hits.update(found)
+    return found
+
+  def set_multi(self, mapping, time=0):
+    memcache.set_multi(mapping, time=time)
+    self._set_lru(mapping)
+    self.hits.update(mapping)
+    self.misses.difference_update(mapping)
+
+  @staticmethod
+  def _successes(mapping):
+    return dict((key, resolved) for key, resolved in mapping.items()
+                if resolved.status_code // 100 == 2)
+
+  def _get_lru(self, key):
+    with _redirect_lru_lock:
+      cached = _redirect_lru.pop(key, None)
+      if cached and cached[0] > self._now():
+        _redirect_lru[key] = cached  # move to the end
+        url, status_code, headers = cached[1]
+        resolved = requests.Response()
+        resolved.url = url
+        resolved.status_code = status_code
+        resolved.headers.update(headers)
+        return resolved
+
+  def _set_lru(self, mapping):
+    now = self._now()
+    with _redirect_lru_lock:
+      for key, resolved in mapping.items():
+        ttl = (REDIRECT_LRU_TIME if resolved.status_code // 100 == 2
+               else REDIRECT_FAIL_TIME)
+        _redirect_lru.pop(key, None)
+        _redirect_lru[key] = (now + ttl, (resolved.url, resolved.status_code,
+                                          dict(resolved.headers)))
+      while len(_redirect_lru) > REDIRECT_LRU_SIZE:
+        _redirect_lru.popitem(last=False)
 
 
 def follow_redirects(url, cache=True):
   """Wraps granary.source.follow_redirects and injects our settings.
 
-  ...specifically memcache and USER_AGENT_HEADER.
+  ...specifically RedirectCache and USER_AGENT_HEADER.
+
+  Only takes a host_limit() slot on a cache miss, since hits don't make an HTTP
+  request.
+
+  Args:
+    url: string
+    cache: boolean, whether to use a RedirectCache, or a RedirectCache to use
   """
-  return util.follow_redirects(url, cache=memcache if cache else None,
-                               headers=USER_AGENT_HEADER)
+  if cache is True:
+    cache = RedirectCache()
+  if cache:
+    resolved = cache.get('R ' + url)
+    if resolved is not None:
+      return resolved
+
+  with host_limit(url):
+    return util.follow_redirects(url, cache=cache or None,
+                                 fail_cache_time_secs=REDIRECT_FAIL_TIME,
+                                 headers=USER_AGENT_HEADER)
 
 
-def get_webmention_target(url, resolve=True, replace_test_domains=True):
+def get_webmention_target(url, resolve=True, replace_test_domains=True,
+                          cache=True):
   """Resolves a URL and decides whether we should try to send it a webmention.
 
   Note that this ignores failed HTTP requests, ie the boolean in the returned
@@ -193,6 +895,7 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
     url: string
     resolve: whether to follow redirects
     replace_test_domains: whether to replace test user domains with localhost
+    cache: passed through to follow_redirects()
 
   Returns: (string url, string pretty domain, boolean) tuple. The boolean is
     True if we should send a webmention, False otherwise, e.g. if it's a bad
@@ -208,7 +911,7 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
   send = True
   if resolve:
     # this follows *all* redirects, until the end
-    resolved = follow_redirects(url, cache=memcache)
+    resolved = follow_redirects(url, cache=cache)
     send = resolved.headers.get('content-type', '').startswith('text/html')
     url, domain, _ = get_webmention_target(
       resolved.url, resolve=False, replace_test_domains=replace_test_domains)
@@ -219,6 +922,45 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
   return url, domain, send
 
 
+def get_webmention_targets(urls, resolve=True, replace_test_domains=True):
+  """Batch version of get_webmention_target().
+
+  Looks up all of the URLs' cached redirects at once, then resolves the rest
+  concurrently. host_limit() keeps that from piling onto any single host. URLs
+  that don't need an HTTP request are handled inline, without threads.
+
+  Args:
+    urls: sequence of string URLs
+    resolve: boolean, or sequence of booleans, one per URL
+    replace_test_domains: whether to replace test user domains with localhost
+
+  Returns: list of (string url, string pretty domain, boolean) tuples, in the
+    same order as urls. See get_webmention_target().
+  """
+  urls = list(urls)
+  if isinstance(resolve, bool):
+    resolve = [resolve] * len(urls)
+
+  cache = RedirectCache()
+  cached = cache.get_multi(set('R ' + util.clean_url(url)
+                               for url, r in zip(urls, resolve) if r))
+
+  def target(url, r):
+    return get_webmention_target(
+      url, resolve=r, replace_test_domains=replace_test_domains, cache=cache)
+
+  unique = list(collections.OrderedDict.fromkeys(zip(urls, resolve)))
+  fetch = [(url, r) for url, r in unique
+           if r and 'R ' + util.clean_url(url) not in cached]
+  results = dict(zip(fetch, run_in_threads(
+    [lambda url=url, r=r: target(url, r) for url, r in fetch])))
+  for url, r in unique:
+    if (url, r) not in results:
+      results[(url, r)] = target(url, r)
+
+  return [results[(url, r)] for url, r in zip(urls, resolve)]
+
+
 def in_webmention_blacklist(domain):
   """Returns True if the domain or its root domain is in BLACKLIST."""
   return util.domain_or_parent_in(domain.lower(), BLACKLIST)
@@ -271,6 +1013,28 @@ def prune_response(response):
   return trim_nulls({k: v for k, v in response.items() if k not in drop})
 
 
+def response_fingerprint(response):
+  """Returns a stable hash of the parts of a response that can meaningfully change.
+
+  Covers the same fields, on both the response and its object, that
+  granary's Source.activity_changed() compares, so responses with the same
+  fingerprint are unchanged as far as activity_changed() is concerned. The
+  fields are null-trimmed first, so a response and its prune_response()ed
+  version have the same fingerprint.
+
+  Args:
+    response: ActivityStreams response object
+
+  Returns: string
+  """
+  obj = response.get('object')
+  if not isinstance(obj, dict):
+    obj = {}
+  fields = [trim_nulls({f: r.get(f) for f in ACTIVITY_CHANGED_FIELDS})
+            for r in (response, obj)]
+  return hashlib.md5(json.dumps(fields, sort_keys=True)).hexdigest()
+
+
 def replace_test_domains_with_localhost(url):
   """Replace domains in LOCALHOST_TEST_DOMAINS with localhost for local
   testing when in DEBUG mode.
@@ -613,11 +1377,155 @@ def beautifulsoup_parse(html):
   return bs4.BeautifulSoup(html)
 
 
-def mf2py_parse(input, url):
-  """Uses mf2py to parse an input HTML string or BeautifulSoup input."""
+class ParsedHtml(object):
+  """An HTML document parsed with mf2py, and with BeautifulSoup when needed.
+
+  doc is the BeautifulSoup document. If mf2 came from Mf2Cache, doc isn't
+  parsed until it's first used. Either way, it has the changes mf2py makes in
+  place, e.g. backward compatible mf2 classes, so it's the same on cache hits
+  and misses.
+
+  Attributes:
+    mf2: dict, mf2py result
+    doc: BeautifulSoup document or tag
+  """
+
+  def __init__(self, mf2, doc=None, html=None):
+    self.mf2 = mf2
+    self._doc = doc
+    self._html = html
+
+  @property
+  def doc(self):
+    if self._doc is None:
+      self._doc = beautifulsoup_parse(self._html)
+      # the same changes mf2py.parse() makes
+      mf2py_temp_fixes.apply_rules(self._doc)
+      mf2py_backcompat.apply_rules(self._doc)
+    return self._doc
+
+
+def parse_html(input, url=None):
+  """Parses HTML at most once, with BeautifulSoup and then mf2py on the tree.
+
+  Looks up the mf2 in Mf2Cache first. On a hit, nothing is parsed until the
+  returned ParsedHtml's doc is used.
+
+  mf2['rels'] has the document's rel values, e.g. shortlink, feed,
+  syndication, and webmention.
+
+  Args:
+    input: string HTML, requests.Response, or BeautifulSoup document or tag
+    url: string, base URL. Defaults to the response's final URL.
+
+  Returns: ParsedHtml
+  """
+  if isinstance(input, requests.Response):
+    url = url or input.url
+    # .text is decoded unicode string, .content is raw bytes. if the HTTP
+    # headers didn't specify a charset, pass raw bytes to BeautifulSoup so it
+    # can look for a <meta> tag with a charset and decode.
+    input = (input.text if 'charset' in input.headers.get('content-type', '')
+             else input.content)
+
+  if not isinstance(input, basestring):
+    return ParsedHtml(mf2py_parse(input, url), doc=input)
+
+  key = Mf2Cache.key(input, url)
+  mf2 = Mf2Cache.get(key)
+  if mf2 is not None:
+    return ParsedHtml(mf2, html=input)
+
+  doc = beautifulsoup_parse(input)
+  mf2 = mf2py.parse(url=url, doc=doc)
+  Mf2Cache.set(key, mf2)
+  return ParsedHtml(mf2, doc=doc)
+
+
+class Mf2Cache(object):
+  """Caches mf2py results by URL and a hash of the HTML.
+
+  Stores JSON in memcache and an in-process LRU in front of it, and returns a
+  new dict for every hit, so that callers can modify them.
+  """
+
+  @staticmethod
+  def clear_lru():
+    """Clears the in-process cache. Mostly for unit tests."""
+    global _mf2_lru_bytes
+    with _mf2_lru_lock:
+      _mf2_lru.clear()
+      _mf2_lru_bytes = 0
+
+  @staticmethod
+  def key(html, url):
+    url, html = [val.encode('utf-8') if isinstance(val, unicode) else val
+                 for val in (url, html)]
+    return 'MF2 ' + hashlib.sha1('%s %s' % (url, html)).hexdigest()
+
+  @staticmethod
+  def get(key):
+    with _mf2_lru_lock:
+      cached = _mf2_lru.pop(key, None)
+      if cached is not None:
+        _mf2_lru[key] = cached  # move to the end
+
+    if cached is None:
+      cached = memcache.get(key)
+      if cached is not None:
+        Mf2Cache._set_lru(key, cached)
+
+    return json.loads(cached) if cached is not None else None
+
+  @staticmethod
+  def set(key, parsed):
+    cached = json.dumps(parsed)
+    Mf2Cache._set_lru(key, cached)
+    try:
+      memcache.set(key, cached, time=MF2_CACHE_TIME)
+    except ValueError:
+      logging.info('mf2 for %s is too big for memcache', key, exc_info=True)
+
+  @staticmethod
+  def _set_lru(key, cached):
+    global _mf2_lru_bytes
+    if len(cached) > MF2_LRU_BYTES:
+      return
+
+    with _mf2_lru_lock:
+      _mf2_lru_bytes -= len(_mf2_lru.pop(key, ''))
+      _mf2_lru[key] = cached
+      _mf2_lru_bytes += len(cached)
+      while _mf2_lru_bytes > MF2_LRU_BYTES:
+        _, evicted = _mf2_lru.popitem(last=False)
+        _mf2_lru_bytes -= len(evicted)
+
+
+def mf2py_parse(input, url, html=None):
+  """Uses mf2py to parse an input HTML string or BeautifulSoup input.
+
+  Results for HTML strings are cached in Mf2Cache.
+
+  Args:
+    input: string HTML or BeautifulSoup document or tag
+    url: string, base URL
+    html: optional string HTML that input was parsed from. If provided, used
+      to cache the result when input is a BeautifulSoup document.
+  """
+  if isinstance(input, basestring):
+    html = input
+  key = Mf2Cache.key(html, url) if html is not None else None
+  if key:
+    parsed = Mf2Cache.get(key)
+    if parsed is not None:
+      return parsed
+
   if isinstance(input, basestring):
     input = beautifulsoup_parse(input)
 
   # instrumenting, disabled for now:
   # with cache_time('mf2py', 1):
-  return mf2py.parse(url=url, doc=input)
+  parsed = mf2py.parse(url=url, doc=input)
+  if key:
+    Mf2Cache.set(key, parsed)
+  return parsed
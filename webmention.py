@@ -41,15 +41,17 @@ class WebmentionHandler(WebmentionGetHandler):
   Attributes:
     source: the Source for this webmention
     entity: the Publish or Webmention entity for this webmention
+    parsed: util.ParsedHtml of the fetched source page (set in fetch_mf2)
   """
   source = None
   entity = None
+  parsed = None
 
   def fetch_mf2(self, url):
     """Fetches a URL and extracts its mf2 data.
 
-    Side effects: sets self.entity.html on success, calls self.error() on
-    errors.
+    Side effects: sets self.parsed and self.entity.html on success, calls
+    self.error() on errors.
 
     Args:
       url: string
@@ -67,34 +69,27 @@ class WebmentionHandler(WebmentionGetHandler):
     if self.entity:
       self.entity.html = fetched.text
 
-    # .text is decoded unicode string, .content is raw bytes. if the HTTP
-    # headers didn't specify a charset, pass raw bytes to BeautifulSoup so it
-    # can look for a <meta> tag with a charset and decode.
-    text = (fetched.text if 'charset' in fetched.headers.get('content-type', '')
-            else fetched.content)
-    doc = util.beautifulsoup_parse(text)
-
     # parse microformats, convert to ActivityStreams
-    data = util.mf2py_parse(doc, fetched.url)
+    self.parsed = util.parse_html(fetched)
+    data = self.parsed.mf2
 
     # special case tumblr's markup: div#content > div.post > div.copy
-    # convert to mf2 and re-parse
+    # convert to mf2 and re-run mf2py on just that part of the same tree
     if not data.get('items'):
-      contents = doc.find_all(id='content')
+      contents = self.parsed.doc.find_all(id='content')
       if contents:
         post = contents[0].find_next(class_='post')
         if post:
-          post['class'] = 'h-entry'
+          post['class'] = ['h-entry']
           copy = post.find_next(class_='copy')
           if copy:
-            copy['class'] = 'e-content'
+            copy['class'] = ['e-content']
           photo = post.find_next(class_='photo-wrapper')
           if photo:
             img = photo.find_next('img')
             if img:
-              img['class'] = 'u-photo'
-          doc = unicode(post)
-          data = util.mf2py_parse(doc, fetched.url)
+              img['class'] = ['u-photo']
+          data = util.mf2py_parse(post, fetched.url)
 
     logging.debug('Parsed microformats2: %s', json.dumps(data, indent=2))
     items = data.get('items', [])
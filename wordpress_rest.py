@@ -185,7 +185,9 @@ class WordPress(models.Source):
 
   @staticmethod
   def urlopen(auth_entity, url, **kwargs):
-    resp = auth_entity.urlopen(url, **kwargs).read()
+    kwargs.setdefault('headers', {}).update(util.USER_AGENT_HEADER)
+    with util.host_limit(url):
+      resp = auth_entity.urlopen(url, **kwargs).read()
     logging.debug(resp)
     return json.loads(resp)
 